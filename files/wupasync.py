@@ -0,0 +1,729 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# asyncio version of wupclient. any number of coroutines can share one
+# session: requests are pipelined up to max_inflight on servers that take
+# framed requests (one at a time on the stock wupserver) and callers wait
+# for a free slot, so a single event loop can drive a whole rack:
+#   async def backup(ip):
+#       async with wupasyncclient(ip) as w:
+#           await w.dl('/vol/system/config/sys_prod.xml', ip + '_sys_prod.xml')
+#   asyncio.run(asyncio.gather(*[backup(ip) for ip in ips]))
+import asyncio
+import os
+import socket
+import struct
+from collections import deque
+
+from wupclient import (FRAMED_REQUEST, MAX_READ_SIZE, MAX_WRITE_SIZE, TRANSFER_BLOCK_SIZE, U32,
+    FSA_STAT_WORDS, MCP_INSTALL_INFO, MCP_INSTALL_PROGRESS, FSA_PATH, FSA_PATH_FLAGS, FSA_PATH_PATH,
+    FSA_HANDLE, FSA_MOUNT, FSA_SET_POS, FSA_READ_WRITE, FSA_CHANGE_MODE, FSA_FORMAT, MCP_PATH,
+    MCP_DELETE_PATH, MCP_WORD, fsa_stat, fsa_dir_entry, get_string)
+
+class wupasyncclient:
+    def __init__(self, ip='10.0.0.74', port=1337, pipeline=True, max_inflight=32):
+        self.ip = ip
+        self.port = port
+        self.pipeline = pipeline
+        self.max_inflight = max_inflight
+        self.reader = None
+        self.writer = None
+        self.handles = {}
+        # volume -> device for what this client mounted
+        self.mounts = {}
+        self.cwd = '/vol/storage_mlc01'
+        # set once the receive task is gone, requests fail straight away
+        self.error = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.disconnect()
+
+    async def connect(self, timeout=None):
+        self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.ip, self.port), timeout)
+        self.writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.framed = False
+        if self.pipeline:
+            # a framed zero-length read is a no-op on servers that support framing
+            self.writer.write(struct.pack('>III', FRAMED_REQUEST | (8 << 8) | 1, 0, 0))
+            self.framed = U32.unpack(await asyncio.wait_for(self.reader.readexactly(4), timeout))[0] == 0
+        # (future, reply size) of every request on the wire, in order
+        self.pending = deque()
+        self.window = asyncio.Semaphore(self.max_inflight if self.framed else 1)
+        self.drain_lock = asyncio.Lock()
+        # idle IOS buffers by power-of-two size class
+        self.free_buffers = {}
+        self.handles = {}
+        self.handle_lock = asyncio.Lock()
+        self.error = None
+        self.receiver = asyncio.ensure_future(self.receive())
+        return self
+
+    async def disconnect(self):
+        if self.writer is None:
+            return
+        try:
+            # only what this session mounted is undone, and only over a
+            # connection that still works
+            if self.error is None:
+                for volume in list(self.mounts):
+                    await self.unmount(volume)
+                for handle in self.handles.values():
+                    await self.close(handle)
+                for buffers in self.free_buffers.values():
+                    for address in buffers:
+                        await self.svc(0x29, [0xCAFF, address])
+        finally:
+            self.handles = {}
+            self.free_buffers = {}
+            self.receiver.cancel()
+            self.writer.close()
+            self.writer = None
+
+    # fundamental comms
+    async def receive(self):
+        try:
+            while True:
+                header = await self.reader.readexactly(4)
+                fut, size = self.pending[0]
+                ret = U32.unpack(header)[0]
+                # the server only sends the 4 byte error code when a request fails
+                data = await self.reader.readexactly(size) if ret == 0 and size > 0 else b''
+                self.pending.popleft()
+                self.window.release()
+                if not fut.done():
+                    fut.set_result((ret, data))
+        except (asyncio.IncompleteReadError, OSError):
+            pass
+        finally:
+            # nothing will answer from here on: fail whatever is still
+            # waiting and give its window slots back so nobody blocks on them
+            self.error = ConnectionError('wupserver closed the connection')
+            for (fut, _) in self.pending:
+                if not fut.done():
+                    fut.set_exception(self.error)
+                    # callers give up at the first failed part of a
+                    # transfer, the rest are never awaited
+                    fut.exception()
+                self.window.release()
+            self.pending.clear()
+
+    # sends a request once there is room in the window and returns a future
+    # for its (ret, data). requests are answered in the order they are sent
+    async def request(self, command, *parts, size=0):
+        if self.error is not None:
+            raise self.error
+        await self.window.acquire()
+        if self.error is not None:
+            self.window.release()
+            raise self.error
+        if self.framed:
+            command |= FRAMED_REQUEST | (sum(len(p) for p in parts) << 8)
+        fut = asyncio.get_running_loop().create_future()
+        self.pending.append((fut, size))
+        self.writer.writelines([U32.pack(command)] + list(parts))
+        if self.writer.transport.get_write_buffer_size() > 0x10000:
+            async with self.drain_lock:
+                await self.writer.drain()
+        return fut
+
+    async def send(self, command, data, size=0):
+        return await (await self.request(command, data, size=size))
+
+    # core commands. the queue_ variants return as soon as everything is on
+    # the wire, with a task that finishes once the replies are in
+    async def queue_read(self, addr, len):
+        parts = []
+        for k in range(0, len, MAX_READ_SIZE):
+            n = min(MAX_READ_SIZE, len - k)
+            parts.append((k, n, await self.request(1, struct.pack('>II', addr + k, n), size=n)))
+        return asyncio.ensure_future(self.collect_read(parts, len))
+
+    async def collect_read(self, parts, len):
+        data = bytearray(len)
+        failed = None
+        for (k, n, fut) in parts:
+            ret, chunk = await fut
+            if ret != 0:
+                failed = ret
+            else:
+                data[k:k + n] = chunk
+        if failed is not None:
+            print('read error : %08X' % failed)
+            return None
+        return data
+
+    async def read(self, addr, len):
+        return await (await self.queue_read(addr, len))
+
+    async def queue_write(self, addr, data):
+        view = memoryview(data)
+        futs = []
+        for k in range(0, len(view), MAX_WRITE_SIZE):
+            futs.append(await self.request(0, U32.pack(addr + k), view[k:k + MAX_WRITE_SIZE]))
+        return asyncio.ensure_future(self.collect_write(futs))
+
+    async def collect_write(self, futs):
+        ret = 0
+        for fut in futs:
+            r, _ = await fut
+            if r != 0:
+                ret = r
+        if ret == 0:
+            return ret
+        print('write error : %08X' % ret)
+
+    async def write(self, addr, data):
+        return await (await self.queue_write(addr, data))
+
+    async def queue_svc(self, svc_id, arguments):
+        fut = await self.request(2, struct.pack('>%dI' % (len(arguments) + 1), svc_id, *arguments), size=4)
+        return asyncio.ensure_future(self.collect_svc(fut))
+
+    async def collect_svc(self, fut):
+        ret, data = await fut
+        if ret == 0:
+            return U32.unpack(data)[0]
+        print('svc error : %08X' % ret)
+
+    async def svc(self, svc_id, arguments):
+        return await (await self.queue_svc(svc_id, arguments))
+
+    async def kill(self):
+        ret, _ = await self.send(3, bytearray())
+        return ret
+
+    async def memcpy(self, dst, src, len):
+        ret, _ = await self.send(4, struct.pack('>III', dst, src, len))
+        if ret == 0:
+            return ret
+        print('memcpy error : %08X' % ret)
+
+    async def repeatwrite(self, dst, val, n):
+        ret, _ = await self.send(5, struct.pack('>III', dst, val, n))
+        if ret == 0:
+            return ret
+        print('repeatwrite error : %08X' % ret)
+
+    # derivatives
+    async def alloc(self, size, align=None):
+        if size == 0:
+            return 0
+        if align is None:
+            return await self.svc(0x27, [0xCAFF, size])
+        return await self.svc(0x28, [0xCAFF, size, align])
+
+    async def free(self, address):
+        if address == 0:
+            return 0
+        return await self.svc(0x29, [0xCAFF, address])
+
+    # 0x40 aligned IOS buffers kept between calls, up to 8 idle per class
+    async def get_buffer(self, size):
+        size_class = max(0x400, 1 << (size - 1).bit_length())
+        buffers = self.free_buffers.get(size_class)
+        if buffers:
+            return (buffers.pop(), size_class)
+        return (await self.alloc(size_class, 0x40), size_class)
+
+    def put_buffer(self, address, size_class):
+        buffers = self.free_buffers.setdefault(size_class, [])
+        if len(buffers) < 8:
+            buffers.append(address)
+        else:
+            asyncio.ensure_future(self.free(address))
+
+    async def load_buffer(self, b, align=None):
+        if len(b) == 0:
+            return 0
+        address = await self.alloc(len(b), align)
+        await self.write(address, b)
+        return address
+
+    async def load_string(self, s, align=None):
+        return await self.load_buffer(bytearray(s + '\0', 'ascii'), align)
+
+    async def open(self, device, mode):
+        address = await self.load_string(device)
+        handle = await self.svc(0x33, [address, mode])
+        await self.free(address)
+        return handle
+
+    # device handles are opened on first use and kept for the session
+    async def handle(self, device):
+        handle = self.handles.get(device)
+        if handle is not None:
+            return handle
+        async with self.handle_lock:
+            handle = self.handles.get(device)
+            if handle is None:
+                handle = await self.open(device, 0)
+                if handle & 0x80000000:
+                    print('open error : %s (%s)' % (device, hex(handle)))
+                    return handle
+                self.handles[device] = handle
+        return handle
+
+    async def fsa(self):
+        return await self.handle('/dev/fsa')
+
+    # mounts a volume unless this client already did
+    async def mount(self, device_path, volume_path, flags=2):
+        if volume_path in self.mounts:
+            return 0
+        ret = await self.FSA_Mount(await self.fsa(), device_path, volume_path, flags)
+        if ret == 0:
+            self.mounts[volume_path] = device_path
+        return ret
+
+    async def unmount(self, volume_path, flags=2):
+        ret = await self.FSA_Unmount(await self.fsa(), volume_path, flags)
+        self.mounts.pop(volume_path, None)
+        return ret
+
+    async def close(self, handle):
+        return await self.svc(0x34, [handle])
+
+    # lays the input buffers, iovecs and output buffers out in one pooled
+    # IOS buffer and sends write, svc and read requests back to back
+    async def queue_ioctlv(self, handle, cmd, inbufs, outbuf_sizes, inbufs_ptr=[], outbufs_ptr=[], svc_id=0x39):
+        offsets = []
+        offset = 0
+        for b in inbufs:
+            offsets.append(offset)
+            offset = (offset + len(b) + 0x3F) & ~0x3F
+        iovecs_offset = offset
+        if svc_id == 0x39:
+            offset = (offset + 0xC * (len(inbufs) + len(inbufs_ptr) + len(outbufs_ptr) + len(outbuf_sizes)) + 0x3F) & ~0x3F
+        input_size = offset
+        for size in outbuf_sizes:
+            offsets.append(offset)
+            offset = (offset + size + 0x3F) & ~0x3F
+        base, size_class = await self.get_buffer(max(offset, 1))
+        image = bytearray(input_size)
+        for (o, b) in zip(offsets, inbufs):
+            image[o:o + len(b)] = b
+        out_addresses = [base + o for o in offsets[len(inbufs):]]
+        if svc_id == 0x39:
+            vecs = [(base + o, len(b)) for (o, b) in zip(offsets, inbufs)] + inbufs_ptr + outbufs_ptr + list(zip(out_addresses, outbuf_sizes))
+            for j, (a, s) in enumerate(vecs):
+                struct.pack_into('>III', image, iovecs_offset + 0xC * j, a, s, 0)
+            arguments = [handle, cmd, len(inbufs) + len(inbufs_ptr), len(outbuf_sizes) + len(outbufs_ptr), base + iovecs_offset]
+        else:
+            in_size = len(inbufs[0]) if len(inbufs) > 0 else 0
+            arguments = [handle, cmd, base if in_size > 0 else 0, in_size, out_addresses[0] if outbuf_sizes[0] > 0 else 0, outbuf_sizes[0]]
+        written = await self.queue_write(base, image) if input_size > 0 else None
+        ret = await self.queue_svc(svc_id, arguments)
+        outs = [await self.queue_read(a, s) for (a, s) in zip(out_addresses, outbuf_sizes) if s > 0]
+        return asyncio.ensure_future(self.collect_ioctl(written, ret, outs, base, size_class))
+
+    async def collect_ioctl(self, written, ret, outs, base, size_class):
+        if written is not None:
+            await written
+        ret = await ret
+        outs = [await o for o in outs]
+        self.put_buffer(base, size_class)
+        return (ret, outs)
+
+    async def ioctlv(self, handle, cmd, inbufs, outbuf_sizes, inbufs_ptr=[], outbufs_ptr=[]):
+        return await (await self.queue_ioctlv(handle, cmd, inbufs, outbuf_sizes, inbufs_ptr, outbufs_ptr))
+
+    async def queue_ioctl(self, handle, cmd, inbuf, outbuf_size):
+        return await self.queue_ioctlv(handle, cmd, [inbuf] if len(inbuf) > 0 else [], [outbuf_size], svc_id=0x38)
+
+    async def ioctl(self, handle, cmd, inbuf, outbuf_size):
+        (ret, outs) = await (await self.queue_ioctl(handle, cmd, inbuf, outbuf_size))
+        return (ret, outs[0] if len(outs) > 0 else bytearray())
+
+    # fsa
+    async def FSA_Mount(self, handle, device_path, volume_path, flags):
+        inbuffer = FSA_MOUNT.build(device_path, volume_path, flags)
+        (ret, _) = await self.ioctlv(handle, 0x01, [inbuffer, bytearray()], [0x293])
+        return ret
+
+    async def FSA_Unmount(self, handle, path, flags):
+        (ret, _) = await self.ioctl(handle, 0x02, FSA_PATH_FLAGS.build(path, flags), 0x293)
+        return ret
+
+    async def FSA_RawOpen(self, handle, device):
+        (ret, data) = await self.ioctl(handle, 0x6A, FSA_PATH.build(device), 0x293)
+        return (ret, U32.unpack_from(data, 4)[0])
+
+    async def FSA_OpenDir(self, handle, path):
+        (ret, data) = await self.ioctl(handle, 0x0A, FSA_PATH.build(path), 0x293)
+        return (ret, U32.unpack_from(data, 4)[0])
+
+    async def FSA_ReadDir(self, handle, dir_handle):
+        (ret, data) = await self.ioctl(handle, 0x0B, FSA_HANDLE.build(dir_handle), 0x293)
+        if ret == 0:
+            return (ret, fsa_dir_entry(get_string(data, 0x68), (data[4] & 128) != 128, data[4:0x68]))
+        return (ret, None)
+
+    async def FSA_CloseDir(self, handle, dir_handle):
+        (ret, _) = await self.ioctl(handle, 0x0D, FSA_HANDLE.build(dir_handle), 0x293)
+        return ret
+
+    async def FSA_OpenFile(self, handle, path, mode):
+        (ret, data) = await self.ioctl(handle, 0x0E, FSA_PATH_PATH.build(path, mode), 0x293)
+        return (ret, U32.unpack_from(data, 4)[0])
+
+    async def FSA_MakeDir(self, handle, path, flags):
+        (ret, _) = await self.ioctl(handle, 0x07, FSA_PATH_FLAGS.build(path, flags), 0x293)
+        return ret
+
+    async def FSA_ReadFile(self, handle, file_handle, size, cnt):
+        inbuffer = FSA_READ_WRITE.build(size, cnt, file_handle)
+        (ret, data) = await self.ioctlv(handle, 0x0F, [inbuffer], [size * cnt, 0x293])
+        return (ret, data[0])
+
+    async def FSA_WriteFile(self, handle, file_handle, data):
+        inbuffer = FSA_READ_WRITE.build(1, len(data), file_handle)
+        (ret, _) = await self.ioctlv(handle, 0x10, [inbuffer, data], [0x293])
+        return ret
+
+    async def queue_FSA_ReadFilePtr(self, handle, file_handle, size, cnt, ptr):
+        inbuffer = FSA_READ_WRITE.build(size, cnt, file_handle)
+        return await self.queue_ioctlv(handle, 0x0F, [inbuffer], [0x293], [], [(ptr, size*cnt)])
+
+    async def FSA_ReadFilePtr(self, handle, file_handle, size, cnt, ptr):
+        (ret, data) = await (await self.queue_FSA_ReadFilePtr(handle, file_handle, size, cnt, ptr))
+        return (ret, data[0])
+
+    async def queue_FSA_WriteFilePtr(self, handle, file_handle, size, cnt, ptr):
+        inbuffer = FSA_READ_WRITE.build(size, cnt, file_handle)
+        return await self.queue_ioctlv(handle, 0x10, [inbuffer], [0x293], [(ptr, size*cnt)], [])
+
+    async def FSA_WriteFilePtr(self, handle, file_handle, size, cnt, ptr):
+        (ret, _) = await (await self.queue_FSA_WriteFilePtr(handle, file_handle, size, cnt, ptr))
+        return ret
+
+    async def FSA_GetPosFile(self, handle, file_handle):
+        (ret, data) = await self.ioctl(handle, 0x11, FSA_HANDLE.build(file_handle), 0x293)
+        return (ret, U32.unpack_from(data, 4)[0])
+
+    async def FSA_SetPosFile(self, handle, file_handle, position):
+        (ret, _) = await self.ioctl(handle, 0x12, FSA_SET_POS.build(file_handle, position), 0x293)
+        return ret
+
+    async def FSA_GetStatFile(self, handle, file_handle):
+        (ret, data) = await self.ioctl(handle, 0x14, FSA_HANDLE.build(file_handle), 0x64)
+        return (ret, fsa_stat(FSA_STAT_WORDS.unpack(data)))
+
+    async def FSA_CloseFile(self, handle, file_handle):
+        (ret, _) = await self.ioctl(handle, 0x15, FSA_HANDLE.build(file_handle), 0x293)
+        return ret
+
+    async def FSA_ChangeMode(self, handle, path, mode, mask=0x777):
+        (ret, _) = await self.ioctl(handle, 0x20, FSA_CHANGE_MODE.build(path, mode, mask), 0x293)
+        return ret
+
+    async def FSA_Rename(self, handle, oldpath, newpath):
+        (ret, _) = await self.ioctl(handle, 0x09, FSA_PATH_PATH.build(oldpath, newpath), 0x293)
+        return ret
+
+    async def FSA_Remove(self, handle, path):
+        (ret, _) = await self.ioctl(handle, 0x08, FSA_PATH.build(path), 0x293)
+        return ret
+
+    async def FSA_FlushVolume(self, handle, path):
+        (ret, _) = await self.ioctl(handle, 0x1B, FSA_PATH.build(path), 0x293)
+        return ret
+
+    async def FSA_Format(self, handle, device_path, filesystem, flags):
+        (ret, _) = await self.ioctl(handle, 0x69, FSA_FORMAT.build(device_path, filesystem, flags), 0x293)
+        return ret
+
+    async def FSA_GetInfoByQuery(self, handle, path, type):
+        (ret, data) = await self.ioctl(handle, 0x18, FSA_PATH_FLAGS.build(path, type), 0x64)
+        return (ret, FSA_STAT_WORDS.unpack(data))
+
+    # mcp
+    async def MCP_InstallGetInfo(self, handle, path):
+        (ret, data) = await self.ioctlv(handle, 0x80, [MCP_PATH.build(path)], [0x16])
+        return (ret, MCP_INSTALL_INFO.unpack(data[0]))
+
+    async def MCP_Install(self, handle, path):
+        (ret, _) = await self.ioctlv(handle, 0x81, [MCP_PATH.build(path)], [])
+        return ret
+
+    async def MCP_InstallGetProgress(self, handle):
+        (ret, data) = await self.ioctl(handle, 0x82, [], 0x24)
+        return (ret, MCP_INSTALL_PROGRESS.unpack(data))
+
+    async def MCP_DeleteTitle(self, handle, path, flush):
+        (ret, _) = await self.ioctlv(handle, 0x83, [MCP_DELETE_PATH.build(path), MCP_WORD.build(flush)], [])
+        return ret
+
+    async def MCP_CopyTitle(self, handle, path, dst_device_id, flush):
+        (ret, _) = await self.ioctlv(handle, 0x85, [MCP_PATH.build(path), MCP_WORD.build(dst_device_id), MCP_WORD.build(flush)], [])
+        return ret
+
+    async def MCP_InstallSetTargetDevice(self, handle, device):
+        (ret, _) = await self.ioctl(handle, 0x8D, MCP_WORD.build(device), 0)
+        return ret
+
+    async def MCP_InstallSetTargetUsb(self, handle, device):
+        (ret, _) = await self.ioctl(handle, 0xF1, MCP_WORD.build(device), 0)
+        return ret
+
+    # file management
+    def abspath(self, path):
+        if path[0] != '/':
+            return self.cwd + '/' + path
+        return path
+
+    async def cd(self, path):
+        path = self.abspath(path)
+        ret, dir_handle = await self.FSA_OpenDir(await self.fsa(), path)
+        if ret == 0:
+            self.cwd = path
+            await self.FSA_CloseDir(await self.fsa(), dir_handle)
+            return 0
+        print('cd error : path does not exist (%s)' % (path))
+        return -1
+
+    def pwd(self):
+        return self.cwd
+
+    async def ls(self, path=None, return_data=False):
+        path = self.abspath(path) if path is not None else self.cwd
+        ret, dir_handle = await self.FSA_OpenDir(await self.fsa(), path)
+        if ret != 0x0:
+            print('opendir error : ' + hex(ret))
+            return [] if return_data else None
+        entries = []
+        while True:
+            ret, data = await self.FSA_ReadDir(await self.fsa(), dir_handle)
+            if ret != 0:
+                break
+            entries.append(data)
+        await self.FSA_CloseDir(await self.fsa(), dir_handle)
+        if return_data:
+            return entries
+        for data in entries:
+            if data['is_file']:
+                print('     %s' % data['name'])
+            else:
+                print('     %s/' % data['name'])
+
+    async def mkdir(self, path, flags):
+        path = self.abspath(path)
+        ret = await self.FSA_MakeDir(await self.fsa(), path, flags)
+        if ret == 0:
+            return 0
+        print('mkdir error (%s, %08X)' % (path, ret))
+        return ret
+
+    async def stat(self, filename):
+        filename = self.abspath(filename)
+        ret, file_handle = await self.FSA_OpenFile(await self.fsa(), filename, 'r')
+        if ret != 0x0:
+            print('stat error : could not open ' + filename)
+            return
+        (ret, stats) = await self.FSA_GetStatFile(await self.fsa(), file_handle)
+        await self.FSA_CloseFile(await self.fsa(), file_handle)
+        if ret != 0x0:
+            print('stat error : ' + hex(ret))
+            return
+        return stats
+
+    async def rm(self, filename):
+        filename = self.abspath(filename)
+        ret = await self.FSA_Remove(await self.fsa(), filename)
+        if ret != 0x0:
+            print('rm error : ' + filename + ' (' + hex(ret) + ')')
+        return ret
+
+    # the entries of a directory are removed concurrently
+    async def rmdir(self, path):
+        path = self.abspath(path)
+        entries = await self.ls(path, True)
+        await asyncio.gather(*[self.rm(path + '/' + e.name) if e.is_file else self.rmdir(path + '/' + e.name) for e in entries])
+        ret = await self.FSA_Remove(await self.fsa(), path)
+        if ret != 0x0:
+            print('rmdir error : ' + path + ' (' + hex(ret) + ')')
+        return ret
+
+    async def mv(self, srcpath, dstpath):
+        srcpath = self.abspath(srcpath)
+        dstpath = self.abspath(dstpath)
+        ret = await self.FSA_Rename(await self.fsa(), srcpath, dstpath)
+        if ret != 0x0:
+            print('moving ' + srcpath + ' to ' + dstpath + ' failed : ' + hex(ret))
+        return ret
+
+    # reads size bytes from an open file through two pooled IOS buffers,
+    # the next block is read on the console while the current one is on
+    # the wire. sink gets each block as it arrives
+    async def read_file_blocks(self, file_handle, sink, size):
+        buffers = [await self.get_buffer(TRANSFER_BLOCK_SIZE) for _ in range(2)]
+        inflight = deque()
+        pos = 0
+        k = 0
+        failed = False
+        while pos < size or len(inflight) > 0:
+            if pos < size and len(inflight) < 2:
+                n = min(TRANSFER_BLOCK_SIZE, size - pos)
+                ptr = buffers[k % 2][0]
+                ret = await self.queue_FSA_ReadFilePtr(await self.fsa(), file_handle, 0x1, n, ptr)
+                inflight.append((ret, await self.queue_read(ptr, n), n))
+                pos += n
+                k += 1
+                continue
+            ret, data, n = inflight.popleft()
+            (ret, _) = await ret
+            data = await data
+            if ret != n or data is None:
+                print('read error : %08X' % (ret if ret is not None else 0))
+                failed = True
+                size = pos
+                continue
+            sink(data)
+        for (address, size_class) in buffers:
+            self.put_buffer(address, size_class)
+        return not failed
+
+    # stages blocks into two pooled IOS buffers and commits them with
+    # FSA_WriteFilePtr, the next block is sent while the previous one is
+    # being written
+    async def write_file_blocks(self, file_handle, source):
+        buffers = [await self.get_buffer(TRANSFER_BLOCK_SIZE) for _ in range(2)]
+        inflight = deque()
+        # files are read a block at a time, so only the blocks in flight are
+        # ever held in memory. the reads go to the default executor, a large
+        # local file would hold up every other coroutine otherwise
+        loop = asyncio.get_running_loop()
+        if hasattr(source, 'read'):
+            async def next_block(pos):
+                return await loop.run_in_executor(None, source.read, TRANSFER_BLOCK_SIZE)
+        else:
+            view = memoryview(source)
+            async def next_block(pos):
+                return view[pos:pos + TRANSFER_BLOCK_SIZE]
+        failed = False
+        k = 0
+        pos = 0
+        while True:
+            block = await next_block(pos)
+            if len(block) == 0:
+                break
+            if len(inflight) == 2:
+                failed |= not await self.wait_written(*inflight.popleft())
+            ptr = buffers[k % 2][0]
+            written = await self.queue_write(ptr, block)
+            inflight.append((written, await self.queue_FSA_WriteFilePtr(await self.fsa(), file_handle, 0x1, len(block), ptr), len(block)))
+            k += 1
+            pos += len(block)
+        while len(inflight) > 0:
+            failed |= not await self.wait_written(*inflight.popleft())
+        for (address, size_class) in buffers:
+            self.put_buffer(address, size_class)
+        return not failed
+
+    async def wait_written(self, written, ret, n):
+        await written
+        (ret, _) = await ret
+        if ret != n:
+            print('write error : %08X' % (ret if ret is not None else 0))
+            return False
+        return True
+
+    async def fr(self, filename, offset, size):
+        filename = self.abspath(filename)
+        ret, file_handle = await self.FSA_OpenFile(await self.fsa(), filename, 'r')
+        if ret != 0x0:
+            print('fr error : could not open ' + filename)
+            return
+        if offset != 0:
+            await self.FSA_SetPosFile(await self.fsa(), file_handle, offset)
+        buffer = bytearray()
+        await self.read_file_blocks(file_handle, buffer.extend, size)
+        await self.FSA_CloseFile(await self.fsa(), file_handle)
+        return buffer
+
+    async def fw(self, filename, offset, buffer):
+        filename = self.abspath(filename)
+        ret, file_handle = await self.FSA_OpenFile(await self.fsa(), filename, 'r+')
+        if ret != 0x0:
+            print('fw error : could not open ' + filename)
+            return
+        if offset != 0:
+            await self.FSA_SetPosFile(await self.fsa(), file_handle, offset)
+        await self.write_file_blocks(file_handle, buffer)
+        await self.FSA_CloseFile(await self.fsa(), file_handle)
+
+    async def dl(self, filename, local_filename=None):
+        filename = self.abspath(filename)
+        if local_filename is None:
+            local_filename = filename[filename.rindex('/') + 1:]
+        ret, file_handle = await self.FSA_OpenFile(await self.fsa(), filename, 'r')
+        if ret != 0x0:
+            print('dl error : could not open ' + filename)
+            return -1
+        ret, stats = await self.FSA_GetStatFile(await self.fsa(), file_handle)
+        with open(local_filename, 'wb') as f:
+            ok = await self.read_file_blocks(file_handle, f.write, stats.size if ret == 0 else 0)
+        await self.FSA_CloseFile(await self.fsa(), file_handle)
+        return 0 if ok else -1
+
+    async def up(self, local_filename, filename=None):
+        if filename is None:
+            filename = os.path.basename(local_filename)
+        filename = self.abspath(filename)
+        with open(local_filename, 'rb') as f:
+            ret, file_handle = await self.FSA_OpenFile(await self.fsa(), filename, 'w')
+            if ret != 0x0:
+                print('up error : could not open ' + filename)
+                return -1
+            ok = await self.write_file_blocks(file_handle, f)
+        await self.FSA_CloseFile(await self.fsa(), file_handle)
+        return 0 if ok else -1
+
+    # copies on the console, each block is read and written back in the
+    # same burst without crossing the network
+    async def cp(self, filename_in, filename_out):
+        filename_in = self.abspath(filename_in)
+        filename_out = self.abspath(filename_out)
+        ret, in_file_handle = await self.FSA_OpenFile(await self.fsa(), filename_in, 'r')
+        if ret != 0x0:
+            print('cp error : could not open ' + filename_in)
+            return -1
+        ret, stats = await self.FSA_GetStatFile(await self.fsa(), in_file_handle)
+        size = stats.size if ret == 0 else 0
+        ret, out_file_handle = await self.FSA_OpenFile(await self.fsa(), filename_out, 'w')
+        if ret != 0x0:
+            print('cp error : could not open ' + filename_out)
+            await self.FSA_CloseFile(await self.fsa(), in_file_handle)
+            return -1
+        buffers = [await self.get_buffer(TRANSFER_BLOCK_SIZE) for _ in range(2)]
+        inflight = deque()
+        failed = False
+        for k, pos in enumerate(range(0, size, TRANSFER_BLOCK_SIZE)):
+            n = min(TRANSFER_BLOCK_SIZE, size - pos)
+            if len(inflight) == 2:
+                failed |= not await self.wait_copied(*inflight.popleft())
+            ptr = buffers[k % 2][0]
+            read = await self.queue_FSA_ReadFilePtr(await self.fsa(), in_file_handle, 0x1, n, ptr)
+            inflight.append((read, await self.queue_FSA_WriteFilePtr(await self.fsa(), out_file_handle, 0x1, n, ptr), n))
+        while len(inflight) > 0:
+            failed |= not await self.wait_copied(*inflight.popleft())
+        for (address, size_class) in buffers:
+            self.put_buffer(address, size_class)
+        await self.FSA_CloseFile(await self.fsa(), out_file_handle)
+        await self.FSA_CloseFile(await self.fsa(), in_file_handle)
+        return -1 if failed else 0
+
+    async def wait_copied(self, read, written, n):
+        (ret, _) = await read
+        if ret != n:
+            print('cp error : read returned %08X' % (ret if ret is not None else 0))
+            await written
+            return False
+        (ret, _) = await written
+        if ret != n:
+            print('cp error : write returned %08X' % (ret if ret is not None else 0))
+            return False
+        return True
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# benchmarks wupclient operations against wupserver_emu with injected
+# latency, e.g. to compare a transport change against the previous client:
+#   python3 wupbench.py --rtt 0 0.002 0.01 --output after.json --compare before.json
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import wupclient
+from wupserver_emu import wupserver_emu
+
+# name -> list of file sizes placed in the benchmark title tree
+DISTRIBUTIONS = {
+    'small': [0x400 * (1 + i % 8) for i in range(64)],
+    'mixed': [0x100, 0x1000, 0x8000, 0x20000, 0x80000] * 4,
+    'large': [0x100000] * 4,
+}
+
+OPERATIONS = ['ls', 'dl', 'up', 'cp', 'dldir', 'rmdir', 'remove_system_titles']
+
+# the source tree lives outside the system titles so remove_system_titles
+# can be run against copies of it
+BENCH_TITLE = '/vol/storage_mlc01/usr/title/00050000/10100000'
+BENCH_REGION = 'USA'
+BENCH_TITLES = 4
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    if len(samples) == 0:
+        return 0.0
+    return samples[min(len(samples) - 1, int(round(p * (len(samples) - 1))))]
+
+# lays files out as <path>/code/NNNN.bin and <path>/meta/NNNN.bin
+def make_tree(host_path, sizes, seed=0):
+    rng = random.Random(seed)
+    files = []
+    for i, size in enumerate(sizes):
+        name = '%s/%04d.bin' % ('code' if i % 2 == 0 else 'meta', i)
+        os.makedirs(os.path.join(host_path, os.path.dirname(name)), exist_ok=True)
+        with open(os.path.join(host_path, name), 'wb') as f:
+            f.write(rng.randbytes(size) if hasattr(rng, 'randbytes') else os.urandom(size))
+        files.append((name, size))
+    return files
+
+def title_paths(count):
+    return [wupclient.STORAGE_MLC + t.replace('-', '/') for t in wupclient.SYSTEM_TITLES[BENCH_REGION][:count]]
+
+class bench:
+    def __init__(self, root, work, w, emu, sizes):
+        self.root = root
+        self.work = work
+        self.w = w
+        self.emu = emu
+        self.sizes = sizes
+        self.title = BENCH_TITLE
+        self.files = make_tree(self.host(self.title), sizes)
+        for (name, size) in self.files:
+            shutil.copyfile(self.host(self.title + '/' + name), os.path.join(work, os.path.basename(name)))
+        os.makedirs(self.host('/vol/storage_sdcard/bench'), exist_ok=True)
+
+    def host(self, path):
+        return os.path.join(self.root, path.lstrip('/'))
+
+    # each step is (setup, op, bytes), setup runs outside the timed region
+    def steps(self, name):
+        w = self.w
+        src = self.title
+        dst = '/vol/storage_sdcard/bench'
+        if name == 'ls':
+            return [(w.cache.clear, lambda d=d: w.ls(src + '/' + d, True), 0) for d in ('code', 'meta')]
+        if name == 'dl':
+            return [(None, lambda f=f: w.dl(src + '/' + f, None, None, False), size) for (f, size) in self.files]
+        if name == 'up':
+            return [(None, lambda f=f: w.up(os.path.basename(f), dst + '/' + os.path.basename(f)), size) for (f, size) in self.files]
+        if name == 'cp':
+            return [(None, lambda f=f: w.cp(src + '/' + f, dst + '/' + os.path.basename(f), False), size) for (f, size) in self.files]
+        total = sum(self.sizes)
+        if name == 'dldir':
+            return [(None, lambda: w.dldir(src), total)]
+        if name == 'rmdir':
+            def setup():
+                shutil.copytree(self.host(src), self.host('/vol/storage_sdcard/bench_rm'))
+                w.cache.clear()
+            return [(setup, lambda: w.rmdir('/vol/storage_sdcard/bench_rm'), total)]
+        if name == 'remove_system_titles':
+            titles = title_paths(BENCH_TITLES)
+            checkpoint = os.path.join(self.work, 'checkpoint.txt')
+            def setup():
+                for t in titles:
+                    if not os.path.exists(self.host(t)):
+                        shutil.copytree(self.host(src), self.host(t))
+                w.cache.clear()
+            return [(setup, lambda: wupclient.remove_system_titles(BENCH_REGION, checkpoint=checkpoint), total * len(titles))]
+        raise ValueError('unknown operation ' + name)
+
+    def run(self, name, repeat):
+        latencies = []
+        nbytes = 0
+        requests = 0
+        round_trips = 0
+        for _ in range(repeat):
+            for (setup, op, size) in self.steps(name):
+                if setup is not None:
+                    setup()
+                requests -= self.emu.stats['requests']
+                round_trips -= self.w.round_trips
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    op()
+                latencies.append(time.perf_counter() - start)
+                requests += self.emu.stats['requests']
+                round_trips += self.w.round_trips
+                nbytes += size
+        elapsed = max(sum(latencies), 1e-9)
+        n = max(len(latencies), 1)
+        return {
+            'ops': len(latencies),
+            'bytes': nbytes,
+            'seconds': elapsed,
+            'ops_per_s': len(latencies) / elapsed,
+            'mb_per_s': nbytes / elapsed / 1e6,
+            'requests_per_op': requests / float(n),
+            'round_trips_per_op': round_trips / float(n),
+            'p50_ms': percentile(latencies, 0.50) * 1000.0,
+            'p99_ms': percentile(latencies, 0.99) * 1000.0,
+        }
+
+def run_config(rtt, bandwidth, distribution, operations, repeat, stock):
+    root = tempfile.mkdtemp(prefix='wupbench-root-')
+    work = tempfile.mkdtemp(prefix='wupbench-work-')
+    cwd = os.getcwd()
+    argv0 = sys.argv[0]
+    emu = wupserver_emu(root, rtt, bandwidth, not stock, stock)
+    for d in ('vol/storage_mlc01/sys/title', 'vol/storage_sdcard'):
+        os.makedirs(os.path.join(root, d))
+    results = []
+    try:
+        port = emu.start()
+        w = wupclient.wupclient('127.0.0.1', port)
+        wupclient.w = w
+        os.chdir(work)
+        # dldir saves next to the running script
+        sys.argv[0] = os.path.join(work, 'wupbench.py')
+        b = bench(root, work, w, emu, DISTRIBUTIONS[distribution])
+        for name in operations:
+            r = b.run(name, repeat)
+            r.update({'op': name, 'rtt': rtt, 'bandwidth': bandwidth, 'distribution': distribution, 'framed': w.framed})
+            results.append(r)
+            print('%-22s rtt %6.1fms %-6s %6d ops %9.1f ops/s %8.2f MB/s %7.1f req/op %7.1f rt/op p50 %8.2fms p99 %8.2fms' % (
+                name, rtt * 1000.0, distribution, r['ops'], r['ops_per_s'], r['mb_per_s'],
+                r['requests_per_op'], r['round_trips_per_op'], r['p50_ms'], r['p99_ms']))
+        w.disconnect()
+    finally:
+        os.chdir(cwd)
+        sys.argv[0] = argv0
+        emu.stop()
+        shutil.rmtree(root, ignore_errors=True)
+        shutil.rmtree(work, ignore_errors=True)
+    return results
+
+def compare(results, baseline_file):
+    with open(baseline_file, 'r') as f:
+        baseline = json.load(f)['results']
+    key = lambda r: (r['op'], r['rtt'], r['bandwidth'], r['distribution'])
+    old = dict((key(r), r) for r in baseline)
+    for r in results:
+        o = old.get(key(r))
+        if o is None:
+            continue
+        print('%-22s rtt %6.1fms %-6s ops/s x%.2f, round trips/op %.1f -> %.1f, p99 %.2fms -> %.2fms' % (
+            r['op'], r['rtt'] * 1000.0, r['distribution'], r['ops_per_s'] / max(o['ops_per_s'], 1e-9),
+            o['round_trips_per_op'], r['round_trips_per_op'], o['p99_ms'], r['p99_ms']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark wupclient against the local wupserver emulator')
+    parser.add_argument('--rtt', type=float, nargs='+', default=[0.0, 0.001, 0.005], help='round trip times in seconds')
+    parser.add_argument('--bandwidth', type=int, default=0, help='reply bandwidth in bytes/s (0 = unlimited)')
+    parser.add_argument('--distribution', nargs='+', default=sorted(DISTRIBUTIONS), choices=sorted(DISTRIBUTIONS))
+    parser.add_argument('--op', nargs='+', default=OPERATIONS, choices=OPERATIONS)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--stock', action='store_true', help='emulate the stock wupserver (no framing, one client at a time)')
+    parser.add_argument('--output', default=None, help='JSON results file (default wupbench-<time>.json)')
+    parser.add_argument('--compare', default=None, help='earlier JSON results file to compare against')
+    args = parser.parse_args()
+    results = []
+    for rtt in args.rtt:
+        for distribution in args.distribution:
+            results += run_config(rtt, args.bandwidth, distribution, args.op, args.repeat, args.stock)
+    output = args.output or time.strftime('wupbench-%Y%m%d-%H%M%S.json')
+    with open(output, 'w') as f:
+        json.dump({
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'stock': args.stock,
+            'repeat': args.repeat,
+            'results': results,
+        }, f, indent=2)
+    print('results written to ' + output)
+    if args.compare is not None:
+        compare(results, args.compare)
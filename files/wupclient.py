@@ -2,16 +2,49 @@
 # encoding: utf-8
 
 # may or may not be inspired by plutoo's ctrrpc
-import codecs
+import csv
 import errno
+import hashlib
+import json
+import mmap
 import os
+import re
+import shutil
 import socket
 import struct
 import sys
-from time import sleep
+import threading
+import xml.parsers.expat
+from array import array
+from collections import OrderedDict, deque
+from queue import Queue
+from time import monotonic, perf_counter, sleep, strftime
 
 STORAGE_MLC = '/vol/storage_mlc01/sys/title/'
 
+# local state that belongs to one console (caches, checkpoints) goes into
+# a directory per console under this one, see wupclient.state_path
+STATE_DIR = 'wupclient_state'
+
+# wupserver handles one request per recv() into a 0x600 byte buffer, so the
+# stock protocol can't tell two back-to-back requests apart. setting this bit
+# in the command word (with the payload length in bits 8-23) marks a request as
+# length-framed; servers that understand it can take pipelined requests, stock
+# servers answer with an unknown command error and we stay in lockstep.
+FRAMED_REQUEST = 0x80000000
+
+# largest read/write payloads that fit the stock wupserver's 0x600 byte
+# command buffer; writes also have to fit in a single TCP segment since the
+# server can't reassemble them
+MAX_READ_SIZE = 0x5FC
+MAX_WRITE_SIZE = 0x5A0
+
+# size of the IOS side staging buffers used for file transfers
+TRANSFER_BLOCK_SIZE = 0x10000
+
+# FSA error for a path that isn't there, as the unsigned word ioctls return
+FSA_STATUS_NOT_FOUND = -0x30017 & 0xFFFFFFFF
+
 SYSTEM_TITLES = {
     'JPN':[
         '00050010-10040000',
@@ -118,8 +151,144 @@ SYSTEM_TITLES = {
     ]
 }
 
+# system titles of the different regions only differ in the region digit of
+# the low word (0 JPN, 1 USA, 2 EUR), the id with that digit masked out is
+# the title's function slot
+TITLE_REGION_MASK = 0xF00
+TITLE_SLOT_NAMES = {
+    0x0005001010040000: 'Wii U Menu',
+    0x0005001010047000: 'System Settings',
+}
+
+# one half of a title id as it appears in a directory name
+TITLE_ID_WORD = re.compile(r'^[0-9a-fA-F]{8}$')
+
+def title_id(t):
+    return int(t.replace('-', ''), 16) if isinstance(t, str) else t
+
+def title_name(tid):
+    return '%08x-%08x' % (tid >> 32, tid & 0xFFFFFFFF)
+
+def title_path(tid, root=STORAGE_MLC):
+    return root + '%08x/%08x' % (tid >> 32, tid & 0xFFFFFFFF)
+
+# SYSTEM_TITLES packed into arrays of 64 bit ids with every lookup and
+# every region to region diff worked out up front. ids can be passed as
+# ints or as '00050010-10040100' strings
+class title_table:
+    def __init__(self, titles):
+        self.regions = list(titles)
+        self.ids = array('Q')
+        self.region_of = array('B')
+        self.slot_of = array('H')
+        self.slots = array('Q')
+        slot_index = {}
+        for (r, region) in enumerate(self.regions):
+            for t in titles[region]:
+                tid = title_id(t)
+                slot = tid & ~TITLE_REGION_MASK
+                if slot not in slot_index:
+                    slot_index[slot] = len(self.slots)
+                    self.slots.append(slot)
+                self.ids.append(tid)
+                self.region_of.append(r)
+                self.slot_of.append(slot_index[slot])
+        self.index = dict((tid, i) for (i, tid) in enumerate(self.ids))
+        self.slot_index = slot_index
+        # slot x region -> title id, 0 where a region has no such title
+        self.by_slot = array('Q', bytes(8 * len(self.slots) * len(self.regions)))
+        for i, tid in enumerate(self.ids):
+            self.by_slot[self.slot_of[i] * len(self.regions) + self.region_of[i]] = tid
+        # titles in SYSTEM_TITLES order, which is the order they are removed in
+        self.by_region = {}
+        self.sets = {}
+        for (r, region) in enumerate(self.regions):
+            self.by_region[region] = array('Q', (tid for (i, tid) in enumerate(self.ids) if self.region_of[i] == r))
+            self.sets[region] = frozenset(self.by_region[region])
+        self.diffs = dict(((a, b), self.make_diff(a, b)) for a in self.regions for b in self.regions if a != b)
+
+    def __contains__(self, t):
+        return title_id(t) in self.index
+
+    def region(self, t):
+        i = self.index.get(title_id(t))
+        return None if i is None else self.regions[self.region_of[i]]
+
+    def slot(self, t):
+        i = self.index.get(title_id(t))
+        return None if i is None else self.slots[self.slot_of[i]]
+
+    def slot_name(self, t):
+        slot = self.slot(t)
+        if slot is None:
+            return None
+        return TITLE_SLOT_NAMES.get(slot, title_name(slot)[:14] + 'x' + title_name(slot)[15:])
+
+    # the title with the same function in another region
+    def counterpart(self, t, region):
+        i = self.index.get(title_id(t))
+        if i is None or region not in self.sets:
+            return None
+        tid = self.by_slot[self.slot_of[i] * len(self.regions) + self.regions.index(region)]
+        return tid if tid != 0 else None
+
+    def titles(self, region):
+        return self.by_region[region]
+
+    def names(self, region):
+        return [title_name(tid) for tid in self.by_region[region]]
+
+    def paths(self, region, root=STORAGE_MLC):
+        return [title_path(tid, root) for tid in self.by_region[region]]
+
+    # going from region a to b: (a title, b title) pairs with the same
+    # function, titles only a has and titles only b has
+    def make_diff(self, a, b):
+        ra = self.regions.index(a)
+        rb = self.regions.index(b)
+        n = len(self.regions)
+        replace = []
+        remove = []
+        for tid in self.by_region[a]:
+            other = self.by_slot[self.slot_of[self.index[tid]] * n + rb]
+            if other != 0:
+                replace.append((tid, other))
+            else:
+                remove.append(tid)
+        add = [tid for tid in self.by_region[b] if self.by_slot[self.slot_of[self.index[tid]] * n + ra] == 0]
+        return {'replace': replace, 'remove': remove, 'add': add}
+
+    def diff(self, a, b):
+        return self.diffs[(a, b)]
+
+TITLES = title_table(SYSTEM_TITLES)
+
+# where installed titles live, <root>/<high>/<low>
+TITLE_ROOTS = {
+    'mlc': ['/vol/storage_mlc01/sys/title', '/vol/storage_mlc01/usr/title'],
+    'usb': ['/vol/storage_usb01/usr/title'],
+    'sd': ['/vol/storage_sdcard/usr/title'],
+}
+
+U32 = struct.Struct('>I')
+FSA_STAT_WORDS = struct.Struct('>25I')
+FSA_ENTRY_STAT_WORDS = struct.Struct('>24I')
+MCP_INSTALL_INFO = struct.Struct('>IIIIIH')
+MCP_INSTALL_PROGRESS = struct.Struct('>9I')
+
+SYS_PROD_XML = '/vol/system/config/sys_prod.xml'
+DRC_CFG_XML = '/vol/system/proc/prefs/DRCCfg.xml'
+PRODUCT_AREAS = {'JPN': 1, 'USA': 2, 'EUR': 4}
+
+# ticket layout, tickets can be packed back to back in one .tik file
+TICKET_PATH = '/vol/system/rights/ticket/apps'
+TICKET_MAGIC = 0x00010004
+TICKET_HALF = struct.Struct('>H')
+TICKET_KEY = struct.Struct('16s')
+TICKET_TITLE_ID = struct.Struct('>Q')
+
 def buffer(size):
-    return bytearray([0x00] * size)
+    return bytearray(size)
 
 def copy_string(buffer, s, offset):
     s += '\0'
@@ -134,71 +303,966 @@ def get_string(buffer, offset):
         return s[:s.index(b'\x00')].decode('utf-8')
     return s.decode('utf-8')
 
+# layout of a command's input buffer. build() copies the zeroed template
+# and patches in only the listed fields, strings are NUL terminated
+class request_template:
+    __slots__ = ('fields', 'template')
+
+    def __init__(self, size, *fields):
+        self.fields = fields
+        self.template = bytes(size)
+
+    def build(self, *values):
+        b = bytearray(self.template)
+        for (offset, kind), v in zip(self.fields, values):
+            if kind is str:
+                v = v.encode('utf-8') + b'\x00'
+                b[offset:offset + len(v)] = v
+            else:
+                U32.pack_into(b, offset, v)
+        return b
+
+FSA_PATH = request_template(0x520, (0x004, str))
+FSA_PATH_FLAGS = request_template(0x520, (0x004, str), (0x284, int))
+FSA_PATH_PATH = request_template(0x520, (0x004, str), (0x284, str))
+FSA_HANDLE = request_template(0x520, (0x004, int))
+FSA_MOUNT = request_template(0x520, (0x004, str), (0x284, str), (0x504, int))
+FSA_SET_POS = request_template(0x520, (0x004, int), (0x008, int))
+FSA_READ_WRITE = request_template(0x520, (0x008, int), (0x00C, int), (0x014, int))
+FSA_CHANGE_MODE = request_template(0x520, (0x004, str), (0x284, int), (0x288, int))
+FSA_FORMAT = request_template(0x520, (0x004, str), (0x284, str), (0x28F, int))
+MCP_PATH = request_template(0x27F, (0x000, str))
+MCP_DELETE_PATH = request_template(0x38, (0x000, str))
+MCP_WORD = request_template(0x4, (0x000, int))
+
+# FSA_GetStatFile result. indexing gives the raw words (0 is the status
+# word, as returned by older versions), the known fields are named
+class fsa_stat:
+    __slots__ = ('words',)
+
+    def __init__(self, words):
+        self.words = words
+
+    def __getitem__(self, i):
+        return self.words[i]
+
+    def __len__(self):
+        return len(self.words)
+
+    def __iter__(self):
+        return iter(self.words)
+
+    @property
+    def flags(self):
+        return self.words[1]
+
+    @property
+    def is_file(self):
+        return (self.words[1] & 0x80000000) == 0
+
+    @property
+    def mode(self):
+        return self.words[2]
+
+    @property
+    def owner(self):
+        return self.words[3]
+
+    @property
+    def group(self):
+        return self.words[4]
+
+    @property
+    def size(self):
+        return self.words[5]
+
+    @property
+    def alloc_size(self):
+        return self.words[6]
+
+    @property
+    def entry_id(self):
+        return self.words[9]
+
+    @property
+    def created(self):
+        return (self.words[10] << 32) | self.words[11]
+
+    @property
+    def modified(self):
+        return (self.words[12] << 32) | self.words[13]
+
+# FSA_ReadDir result, still indexable by the old dict keys
+class fsa_dir_entry:
+    __slots__ = ('name', 'is_file', 'unk')
+
+    def __init__(self, name, is_file, unk):
+        self.name = name
+        self.is_file = is_file
+        self.unk = unk
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    @property
+    def stat(self):
+        return fsa_stat((0,) + FSA_ENTRY_STAT_WORDS.unpack_from(self.unk))
+
+# reads a local file on a background thread so disk reads overlap with
+# the transfer. blocks are read into a ring of preallocated buffers that is
+# large enough for everything queued plus the two blocks the consumer may
+# still hold on to
+def read_ahead(f, block_size, depth=4):
+    q = Queue(depth)
+    buffers = [bytearray(block_size) for _ in range(depth + 3)]
+
+    def reader():
+        try:
+            i = 0
+            while True:
+                if hasattr(f, 'readinto'):
+                    data = memoryview(buffers[i])[:f.readinto(buffers[i])]
+                    i = (i + 1) % len(buffers)
+                else:
+                    data = f.read(block_size)
+                q.put(data)
+                if not data:
+                    break
+        except Exception as e:
+            q.put(e)
+
+    threading.Thread(target=reader, daemon=True).start()
+    while True:
+        data = q.get()
+        if isinstance(data, Exception):
+            raise data
+        if not data:
+            return
+        yield data
+
+# splits a file-like object or anything supporting the buffer protocol
+# into blocks, buffers are sliced through a memoryview instead of copied
+def iter_blocks(source, block_size):
+    if hasattr(source, 'read'):
+        return read_ahead(source, block_size)
+    data = memoryview(source).cast('B')
+    return (data[k:k + block_size] for k in range(0, len(data), block_size))
+
+# client side cache of directory listings ('ls'), entry stats ('stat') and
+# known directories ('dir'), keyed by absolute path. entries expire after
+# ttl seconds and the least recently used ones are dropped past max_entries.
+# the client invalidates whatever its own mutating operations touch
+class wupcache:
+    def __init__(self, ttl=30.0, max_entries=4096):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    @staticmethod
+    def key(path):
+        while '//' in path:
+            path = path.replace('//', '/')
+        if len(path) > 1:
+            path = path.rstrip('/')
+        return path
+
+    def get(self, kind, path):
+        key = (kind, self.key(path))
+        e = self.entries.get(key)
+        if e is None:
+            return None
+        if monotonic() - e[0] > self.ttl:
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return e[1]
+
+    def put(self, kind, path, value):
+        key = (kind, self.key(path))
+        self.entries[key] = (monotonic(), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def put_listing(self, path, entries):
+        path = self.key(path)
+        self.put('ls', path, entries)
+        self.put('dir', path, True)
+        for e in entries:
+            self.put('stat', path + '/' + e.name, e.stat)
+            if not e.is_file:
+                self.put('dir', path + '/' + e.name, True)
+
+    # drops path, everything below it and its parent's listing
+    def invalidate(self, path):
+        path = self.key(path)
+        prefix = path.rstrip('/') + '/'
+        for key in [k for k in self.entries if k[1] == path or k[1].startswith(prefix)]:
+            del self.entries[key]
+        parent = path[:path.rfind('/')] or '/'
+        self.entries.pop(('ls', parent), None)
+
+    def clear(self):
+        self.entries.clear()
+
+# latency histogram with power-of-two microsecond buckets
+class wuphistogram:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * 40
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.buckets[min(int(seconds * 1e6).bit_length(), len(self.buckets) - 1)] += 1
+
+    # upper bound of the bucket holding the p-th sample, in seconds
+    def percentile(self, p):
+        target = p * self.count
+        seen = 0
+        for k, n in enumerate(self.buckets):
+            seen += n
+            if n > 0 and seen >= target:
+                return min((1 << k) / 1e6, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'total_s': self.total,
+            'mean_ms': self.total / max(self.count, 1) * 1e3,
+            'p50_ms': self.percentile(0.50) * 1e3,
+            'p99_ms': self.percentile(0.99) * 1e3,
+            'max_ms': self.max * 1e3,
+        }
+
+# opt-in per session instrumentation, see wupclient.instrument(). every
+# request is tagged with the command/svc/ioctl it carries, the FSA_/MCP_
+# wrapper that issued it and the outermost wupclient function on the stack
+# (e.g. cpdir or get_tik_keys). connections opened by wuptransfer share the
+# instance of the client they came from
+class wupstats:
+    COMMANDS = {0: 'write', 1: 'read', 2: 'svc', 3: 'kill', 4: 'memcpy', 5: 'repeatwrite'}
+
+    def __init__(self, trace=False, max_events=1000000):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.start = perf_counter()
+        self.commands = {}
+        self.svcs = {}
+        self.ioctls = {}
+        # op -> [requests, round trips, bytes out, bytes in]
+        self.ops = {}
+        self.requests = 0
+        self.round_trips = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.events = [] if trace else None
+        self.max_events = max_events
+        self.connections = {}
+
+    def context(self):
+        op = getattr(self.local, 'op', None)
+        outer = None
+        wrapper = None
+        f = sys._getframe(2)
+        while f is not None:
+            if f.f_code.co_filename == __file__ and f.f_code.co_name[0] != '<':
+                outer = f.f_code.co_name
+                if wrapper is None and outer[:4] in ('FSA_', 'MCP_'):
+                    wrapper = outer
+            f = f.f_back
+        return (op if op is not None else outer, wrapper)
+
+    def tag(self, r):
+        r.op, r.wrapper = self.context()
+
+    def op_counters(self, op):
+        c = self.ops.get(op)
+        if c is None:
+            c = self.ops[op] = [0, 0, 0, 0]
+        return c
+
+    def round_trip(self, r):
+        with self.lock:
+            self.round_trips += 1
+            self.op_counters(r.op)[1] += 1
+
+    def histogram(self, table, key):
+        h = table.get(key)
+        if h is None:
+            h = table[key] = wuphistogram()
+        return h
+
+    def reply(self, client, r):
+        elapsed = perf_counter() - r.sent
+        bytes_out = sum(len(p) for p in r.request)
+        bytes_in = 4 + (len(r.data) if r.data is not None else 0)
+        name = self.COMMANDS.get(r.command & 0xFF, 'command %d' % (r.command & 0xFF))
+        with self.lock:
+            self.requests += 1
+            self.bytes_out += bytes_out
+            self.bytes_in += bytes_in
+            c = self.op_counters(r.op)
+            c[0] += 1
+            c[2] += bytes_out
+            c[3] += bytes_in
+            self.histogram(self.commands, name).add(elapsed)
+            if r.tag is not None:
+                self.histogram(self.svcs, 'svc 0x%02X' % r.tag[0]).add(elapsed)
+                if r.tag[1] is not None:
+                    name = 'ioctl 0x%02X' % r.tag[1]
+                    if r.wrapper is not None:
+                        name += ' ' + r.wrapper
+                    self.histogram(self.ioctls, name).add(elapsed)
+                else:
+                    name = 'svc 0x%02X' % r.tag[0]
+            if self.events is not None and len(self.events) < self.max_events:
+                tid = self.connections.setdefault(id(client), len(self.connections) + 1)
+                self.events.append({
+                    'name': name, 'cat': self.COMMANDS.get(r.command & 0xFF, 'command'), 'ph': 'X', 'pid': 1, 'tid': tid,
+                    'ts': (r.sent - self.start) * 1e6, 'dur': elapsed * 1e6,
+                    'args': {'op': r.op, 'ret': r.ret, 'bytes_out': bytes_out, 'bytes_in': bytes_in},
+                })
+
+    def summary(self):
+        with self.lock:
+            table = lambda t: dict((k, h.summary()) for (k, h) in t.items())
+            return {
+                'seconds': perf_counter() - self.start,
+                'requests': self.requests,
+                'round_trips': self.round_trips,
+                'bytes_out': self.bytes_out,
+                'bytes_in': self.bytes_in,
+                'commands': table(self.commands),
+                'svcs': table(self.svcs),
+                'ioctls': table(self.ioctls),
+                'ops': dict((op, {'requests': c[0], 'round_trips': c[1], 'bytes_out': c[2], 'bytes_in': c[3]}) for (op, c) in self.ops.items()),
+            }
+
+    def write_trace(self, filename):
+        with self.lock:
+            events = list(self.events or [])
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+def print_stats(summary):
+    print('%d requests, %d round trips, %d bytes out, %d bytes in over %.2fs' % (
+        summary['requests'], summary['round_trips'], summary['bytes_out'], summary['bytes_in'], summary['seconds']))
+    for section in ('commands', 'svcs', 'ioctls'):
+        print('%-32s %8s %9s %9s %9s %9s' % (section, 'count', 'mean ms', 'p50 ms', 'p99 ms', 'max ms'))
+        for (name, h) in sorted(summary[section].items(), key=lambda i: -i[1]['total_s']):
+            print('  %-30s %8d %9.3f %9.3f %9.3f %9.3f' % (name, h['count'], h['mean_ms'], h['p50_ms'], h['p99_ms'], h['max_ms']))
+    print('%-32s %8s %9s %9s %9s' % ('ops', 'requests', 'rtrips', 'out', 'in'))
+    for (name, c) in sorted(summary['ops'].items(), key=lambda i: -i[1]['requests']):
+        print('  %-30s %8d %9d %9d %9d' % (name, c['requests'], c['round_trips'], c['bytes_out'], c['bytes_in']))
+
+class wupreply:
+    __slots__ = ('command', 'request', 'size', 'into', 'ret', 'data', 'tag', 'op', 'wrapper', 'sent')
+
+    def __init__(self, command, request, size, into=None):
+        self.command = command
+        # list of buffers making up the request, sent without joining them
+        self.request = request
+        self.size = size
+        # optional writable buffer the reply data is received into
+        self.into = into
+        self.ret = None
+        self.data = None
+        # (svc id, ioctl number or None) for svc requests
+        self.tag = None
+        self.op = None
+        self.wrapper = None
+        self.sent = None
+
+class wupresult:
+    __slots__ = ('ret', 'data')
+
+    def __init__(self):
+        self.ret = None
+        self.data = None
+
+# collects ioctl/ioctlv calls, lays all of their buffers and iovecs out in a
+# single IOS allocation and runs them as one pipelined burst of
+# write/svc/read commands:
+#   with w.batch() as b:
+#       r = b.ioctl(w.fsa_handle, 0x08, inbuffer, 0x293)
+#   print(hex(r.ret))
+class wupbatch:
+    def __init__(self, client):
+        self.client = client
+        self.inputs = []
+        self.outputs = []
+        self.ops = []
+        # (op, wrapper) of each call when instrumented, the requests are
+        # only queued later by submit()
+        self.contexts = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.flush()
+
+    def add_input(self, data):
+        if len(data) == 0:
+            return None
+        self.inputs.append(data)
+        return len(self.inputs) - 1
+
+    def add_output(self, size):
+        if size == 0:
+            return None
+        self.outputs.append(size)
+        return len(self.outputs) - 1
+
+    def ioctl(self, handle, cmd, inbuf, outbuf_size):
+        r = wupresult()
+        self.ops.append(('ioctl', r, handle, cmd, self.add_input(inbuf), len(inbuf), self.add_output(outbuf_size), outbuf_size))
+        if self.client.instrumentation is not None:
+            self.contexts.append(self.client.instrumentation.context())
+        return r
+
+    def ioctlv(self, handle, cmd, inbufs, outbuf_sizes, inbufs_ptr=[], outbufs_ptr=[]):
+        r = wupresult()
+        inbufs = [(self.add_input(b), len(b)) for b in inbufs]
+        outbufs = [(self.add_output(s), s) for s in outbuf_sizes]
+        # the iovec array itself is an input, its contents are only known
+        # once the batch has an address so it gets packed in place on submit.
+        # the range only stands in for its size
+        iovecs = self.add_input(range(0xC * (len(inbufs) + len(inbufs_ptr) + len(outbufs_ptr) + len(outbufs))))
+        self.ops.append(('ioctlv', r, handle, cmd, inbufs, outbufs, inbufs_ptr, outbufs_ptr, iovecs))
+        if self.client.instrumentation is not None:
+            self.contexts.append(self.client.instrumentation.context())
+        return r
+
+    def layout(self):
+        offset = 0
+        input_offsets = []
+        for data in self.inputs:
+            input_offsets.append(offset)
+            offset = (offset + len(data) + 0x3F) & ~0x3F
+        input_size = offset
+        output_offsets = []
+        for size in self.outputs:
+            output_offsets.append(offset)
+            offset = (offset + size + 0x3F) & ~0x3F
+        return (input_offsets, input_size, output_offsets, offset)
+
+    def submit(self):
+        # queues the whole batch on the client, results are filled in by
+        # the client's next flush()
+        if len(self.ops) == 0:
+            return
+        w = self.client
+        input_offsets, input_size, output_offsets, size = self.layout()
+        base = w.pool.get(size)
+        if base == 0 or base is None:
+            print('batch error : could not allocate %X bytes' % size)
+            self.ops = []
+            self.contexts = []
+            return
+        address = lambda i, offsets: 0 if i is None else base + offsets[i]
+        image = bytearray(input_size)
+        for i, data in enumerate(self.inputs):
+            if not isinstance(data, range):
+                image[input_offsets[i]:input_offsets[i] + len(data)] = data
+        for op in self.ops:
+            if op[0] == 'ioctlv':
+                (_, r, handle, cmd, inbufs, outbufs, inbufs_ptr, outbufs_ptr, iovecs) = op
+                vecs = [(address(i, input_offsets), s) for (i, s) in inbufs] + inbufs_ptr + outbufs_ptr + [(address(i, output_offsets), s) for (i, s) in outbufs]
+                for j, (a, s) in enumerate(vecs):
+                    struct.pack_into('>III', image, input_offsets[iovecs] + 0xC * j, a, s, 0)
+        view = memoryview(image)
+        for k in range(0, input_size, MAX_WRITE_SIZE):
+            w.queue_write(base + k, view[k:k + MAX_WRITE_SIZE])
+        replies = []
+        for op in self.ops:
+            if op[0] == 'ioctl':
+                (_, r, handle, cmd, i, in_size, o, out_size) = op
+                svc = w.queue_svc(0x38, [handle, cmd, address(i, input_offsets), in_size, address(o, output_offsets), out_size])
+                out = w.queue_read_into(address(o, output_offsets), bytearray(out_size)) if o is not None else None
+            else:
+                (_, r, handle, cmd, inbufs, outbufs, inbufs_ptr, outbufs_ptr, iovecs) = op
+                svc = w.queue_svc(0x39, [handle, cmd, len(inbufs + inbufs_ptr), len(outbufs + outbufs_ptr), address(iovecs, input_offsets)])
+                out = [w.queue_read_into(address(o, output_offsets), bytearray(s)) for (o, s) in outbufs]
+            if len(self.contexts) == len(self.ops):
+                svc.op, svc.wrapper = self.contexts[len(replies)]
+            replies.append((r, svc, out))
+        last = w.queued[-1]
+        w.pool.put(base)
+        w.finalizers.append((last, lambda: self.collect(replies)))
+        self.inputs = []
+        self.outputs = []
+        self.ops = []
+        self.contexts = []
+
+    def flush(self):
+        self.submit()
+        self.client.flush()
+
+    def collect(self, replies):
+        for (r, svc, out) in replies:
+            r.ret = struct.unpack_from('>I', svc.data)[0] if svc.ret == 0 else None
+            r.data = out
+
+# keeps IOS heap buffers alive between calls instead of going through
+# svc 0x27/0x29 every time. buffers are 0x40 aligned and grouped by
+# power-of-two size class, up to max_free idle buffers per class
+class wuppool:
+    def __init__(self, client, min_size=0x400, max_free=4):
+        self.client = client
+        self.min_size = min_size
+        self.max_free = max_free
+        self.idle = {}
+        self.owned = {}
+
+    def size_class(self, size):
+        c = self.min_size
+        while c < size:
+            c <<= 1
+        return c
+
+    def get(self, size):
+        c = self.size_class(size)
+        idle = self.idle.get(c)
+        if idle:
+            return idle.pop()
+        address = self.client.alloc(c, 0x40)
+        if not address:
+            # the 0xCAFF heap is small, give back everything idle and retry
+            self.trim()
+            address = self.client.alloc(c, 0x40)
+            if not address:
+                return 0
+        self.owned[address] = c
+        return address
+
+    def put(self, address):
+        c = self.owned[address]
+        idle = self.idle.setdefault(c, [])
+        if len(idle) < self.max_free:
+            idle.append(address)
+        else:
+            del self.owned[address]
+            self.client.queue_svc(0x29, [0xCAFF, address])
+
+    def trim(self):
+        for c, idle in self.idle.items():
+            for address in idle:
+                del self.owned[address]
+                self.client.queue_svc(0x29, [0xCAFF, address])
+        self.idle = {}
+        self.client.flush()
+
+    # the buffers went away with the session
+    def forget(self):
+        self.idle = {}
+        self.owned = {}
+
+    def release(self):
+        self.trim()
+        for address in self.owned:
+            self.client.queue_svc(0x29, [0xCAFF, address])
+        self.owned = {}
+        self.client.flush()
+
 class wupclient:
     s=None
 
-    def __init__(self, ip='10.0.0.74', port=1337):
-        self.s=socket.socket()
-        self.s.connect((ip, port))
-        self.fsa_handle = self.open('/dev/fsa', 0)
+    # nothing goes over the wire until the first request: the connection is
+    # made then, device handles when a device is first used. timeout is for
+    # connecting, io_timeout for every request after that (calls that can
+    # take minutes go through untimed). lazy=False connects right away and
+    # raises if the console doesn't answer
+    def __init__(self, ip='10.0.0.74', port=1337, pipeline=True, max_inflight=32, timeout=10.0, io_timeout=30.0, lazy=True):
+        self.ip = ip
+        self.port = port
+        self.pipeline = pipeline
+        self.pipeline_depth = max_inflight
+        self.timeout = timeout
+        self.io_timeout = io_timeout
+        # whether the server takes more than one connection at a time,
+        # None until a parallel transfer found out
+        self.parallel = None
+        self.cache = wupcache()
+        self.instrumentation = None
+        # requests sent, and bursts sent to an idle connection (each of
+        # those costs a full round trip)
+        self.requests = 0
+        self.round_trips = 0
         self.cwd = '/vol/storage_mlc01'
-
+        self.pool = wuppool(self)
+        self.reset()
+        # volume -> device for what this client mounted, pending ones are
+        # mounted along with the first /dev/fsa handle
+        self.mounts = {}
+        self.pending_mounts = {}
+        if not lazy:
+            self.connect()
+
+    def connect(self):
+        self.s = socket.create_connection((self.ip, self.port), self.timeout)
+        try:
+            self.setup(self.pipeline, self.pipeline_depth)
+        except:
+            self.s.close()
+            self.s = None
+            raise
+        self.s.settimeout(self.io_timeout)
+
+    def setup(self, pipeline, max_inflight):
+        self.s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.rx_buffer = bytearray(0x20000)
+        self.rx_view = memoryview(self.rx_buffer)
+        self.rx_pos = 0
+        self.rx_end = 0
+        self.rx_header = memoryview(bytearray(4))
+        self.reset()
+        if pipeline and self.probe_framing():
+            self.framed = True
+            self.max_inflight = max_inflight
+
+    # state that belongs to one session: requests, handles and IOS buffers
+    def reset(self):
+        self.queued = deque()
+        self.inflight = deque()
+        # (reply, callback) pairs, callbacks run once their reply is in
+        self.finalizers = deque()
+        self.framed = False
+        self.max_inflight = 1
+        self.handles = {}
+        self.pool.forget()
+
+    # undoes the mounts this client made, nothing else
     def __del__(self):
-        self.FSA_Unmount(self.fsa_handle, '/vol/storage_sdcard', 2)
-        self.close(self.fsa_handle)
+        if self.s is None:
+            return
+        for volume in list(self.mounts):
+            self.unmount(volume)
+        for handle in self.handles.values():
+            self.close(handle)
+        self.pool.release()
+
+    # opens another session to the same server, None if it doesn't answer
+    # within timeout (the stock wupserver serves one client at a time)
+    def connect_again(self, timeout=1.0):
+        try:
+            c = wupclient(self.ip, self.port, self.pipeline, max(self.max_inflight, 32), timeout, self.io_timeout, False)
+        except OSError:
+            return None
+        c.instrumentation = self.instrumentation
+        return c
+
+    # device handles are opened on first use and kept for the session
+    def handle(self, device):
+        handle = self.handles.get(device)
+        if handle is None:
+            handle = self.open(device, 0)
+            if handle & 0x80000000:
+                print('open error : %s (%s)' % (device, hex(handle)))
+                return handle
+            self.handles[device] = handle
+            if device == '/dev/fsa':
+                for (volume, device_path) in list(self.pending_mounts.items()):
+                    ret = self.mount(device_path, volume)
+                    if ret != 0:
+                        print('mount error : %s on %s (%s)' % (device_path, volume, hex(ret)))
+        return handle
 
-    # fundamental comms
-    def send(self, command, data):
-        request = struct.pack('>I', command) + data
+    @property
+    def fsa_handle(self):
+        return self.handle('/dev/fsa')
+
+    @property
+    def mcp_handle(self):
+        return self.handle('/dev/mcp')
 
-        self.s.send(request)
-        response = self.s.recv(0x600)
+    @property
+    def nim_handle(self):
+        return self.handle('/dev/nim')
 
-        ret = struct.unpack('>I', response[:4])[0]
-        return (ret, response[4:])
+    # mounts a volume unless this client already did. lazy only records it
+    # and returns None, it is mounted once something opens /dev/fsa and an
+    # error is printed then
+    def mount(self, device_path, volume_path, flags=2, lazy=False):
+        if volume_path in self.mounts:
+            return 0
+        if lazy and '/dev/fsa' not in self.handles:
+            self.pending_mounts[volume_path] = device_path
+            return None
+        self.pending_mounts.pop(volume_path, None)
+        ret = self.FSA_Mount(self.fsa_handle, device_path, volume_path, flags)
+        if ret == 0:
+            self.mounts[volume_path] = device_path
+        return ret
+
+    def unmount(self, volume_path, flags=2):
+        if self.pending_mounts.pop(volume_path, None) is not None:
+            return 0
+        ret = self.FSA_Unmount(self.fsa_handle, volume_path, flags)
+        self.mounts.pop(volume_path, None)
+        self.cache.invalidate(volume_path)
+        return ret
+
+    # replaces a dropped connection with a new one to the same server. the
+    # handles and IOS buffers of the old session are gone with it
+    def reconnect(self, timeout=10.0):
+        if self.s is not None:
+            try:
+                self.s.close()
+            except OSError:
+                pass
+        self.s = None
+        self.cache.clear()
+        connect_timeout = self.timeout
+        self.timeout = timeout
+        try:
+            self.connect()
+        finally:
+            self.timeout = connect_timeout
+
+    # runs fn(*args) with no io_timeout, for requests the console may sit
+    # on for minutes (installs, title copies and deletes, formats)
+    def untimed(self, fn, *args):
+        if self.s is None:
+            self.connect()
+        self.s.settimeout(None)
+        try:
+            return fn(*args)
+        finally:
+            if self.s is not None:
+                self.s.settimeout(self.io_timeout)
+
+    # gives up on a session whose replies can't be matched to its requests
+    # anymore (a timeout or a dropped connection halfway through one), the
+    # next request connects again
+    def drop(self):
+        if self.s is not None:
+            try:
+                self.s.close()
+            except OSError:
+                pass
+        self.s = None
+        self.reset()
+
+    # a path for local state about this console, runs against different
+    # consoles from the same directory keep apart
+    def state_path(self, name):
+        directory = os.path.join(STATE_DIR, '%s-%d' % (self.ip, self.port))
+        mkdir_p(directory)
+        return os.path.join(directory, name)
+
+    # closes this session without touching any mounts
+    def disconnect(self):
+        if self.s is None:
+            return
+        for handle in self.handles.values():
+            self.close(handle)
+        self.pool.release()
+        self.s.close()
+        self.s = None
+        self.reset()
+
+    # fundamental comms
+    def probe_framing(self):
+        # a framed zero-length read is a no-op on servers that support framing
+        self.s.sendall(struct.pack('>III', FRAMED_REQUEST | (8 << 8) | 1, 0, 0))
+        self.recv_into(self.rx_header)
+        return struct.unpack_from('>I', self.rx_header)[0] == 0
+
+    def recv_into(self, view):
+        # fills view from the socket. whatever was read ahead comes out of
+        # the receive buffer, large remainders are received in place
+        n = len(view)
+        k = min(n, self.rx_end - self.rx_pos)
+        view[:k] = self.rx_view[self.rx_pos:self.rx_pos + k]
+        self.rx_pos += k
+        while k < n:
+            if n - k >= len(self.rx_buffer) // 2:
+                got = self.s.recv_into(view[k:])
+                if got == 0:
+                    raise ConnectionError('wupserver closed the connection')
+                k += got
+                continue
+            if self.rx_pos == self.rx_end:
+                self.rx_pos = self.rx_end = 0
+            elif self.rx_end == len(self.rx_buffer):
+                remaining = self.rx_end - self.rx_pos
+                self.rx_view[:remaining] = self.rx_view[self.rx_pos:self.rx_end]
+                self.rx_pos = 0
+                self.rx_end = remaining
+            got = self.s.recv_into(self.rx_view[self.rx_end:])
+            if got == 0:
+                raise ConnectionError('wupserver closed the connection')
+            self.rx_end += got
+            m = min(n - k, self.rx_end - self.rx_pos)
+            view[k:k + m] = self.rx_view[self.rx_pos:self.rx_pos + m]
+            self.rx_pos += m
+            k += m
+
+    def recv_exact(self, size):
+        data = bytearray(size)
+        self.recv_into(memoryview(data))
+        return data
+
+    def frame(self, command, *parts):
+        size = sum(len(p) for p in parts)
+        if self.framed:
+            command |= FRAMED_REQUEST | (size << 8)
+        return [struct.pack('>I', command)] + list(parts)
+
+    def queue(self, command, *parts, size=0, into=None):
+        if self.s is None:
+            self.connect()
+        # size is the amount of reply data expected after the return code
+        r = wupreply(command, self.frame(command, *parts), size, into)
+        if self.instrumentation is not None:
+            self.instrumentation.tag(r)
+        self.queued.append(r)
+        return r
+
+    def recv_reply(self):
+        r = self.inflight.popleft()
+        self.recv_into(self.rx_header)
+        r.ret = struct.unpack_from('>I', self.rx_header)[0]
+        # the server only sends the 4 byte error code when a request fails
+        if r.ret != 0:
+            r.data = b''
+        elif r.into is not None:
+            self.recv_into(r.into)
+            r.data = r.into
+        else:
+            r.data = self.recv_exact(r.size)
+        if self.instrumentation is not None:
+            self.instrumentation.reply(self, r)
+        return r
+
+    def run_finalizers(self):
+        while len(self.finalizers) > 0 and self.finalizers[0][0].ret is not None:
+            self.finalizers.popleft()[1]()
+
+    def sendmsg(self, parts):
+        if hasattr(self.s, 'sendmsg'):
+            # gather write straight from the request buffers
+            sent = self.s.sendmsg(parts)
+            total = sum(len(p) for p in parts)
+            if sent == total:
+                return
+            parts = [b''.join(parts)[sent:]]
+        self.s.sendall(b''.join(parts))
+
+    def flush(self, keep=0):
+        # keep lets the caller leave up to that many requests outstanding,
+        # e.g. to prepare the next block while the current one is in flight
+        while len(self.queued) + len(self.inflight) > keep:
+            burst = []
+            idle = len(self.inflight) == 0
+            first = len(self.inflight)
+            while len(self.queued) > 0 and len(self.inflight) < self.max_inflight:
+                r = self.queued.popleft()
+                self.inflight.append(r)
+                burst += r.request
+                self.requests += 1
+            try:
+                if len(burst) > 0:
+                    if self.instrumentation is not None:
+                        sent = perf_counter()
+                        for k in range(first, len(self.inflight)):
+                            self.inflight[k].sent = sent
+                        if idle:
+                            self.instrumentation.round_trip(self.inflight[first])
+                    self.sendmsg(burst)
+                    if idle:
+                        self.round_trips += 1
+                self.recv_reply()
+            except BaseException:
+                # a late reply would be taken for the next request's
+                self.drop()
+                raise
+            self.run_finalizers()
+
+    def send(self, command, data, size=0):
+        r = self.queue(command, data, size=size)
+        self.flush()
+        return (r.ret, r.data)
 
     # core commands
+    def queue_read(self, addr, len):
+        return self.queue(1, struct.pack('>II', addr, len), size=len)
+
+    def queue_read_into(self, addr, out):
+        # reads len(out) bytes into out, split into chunks the server can handle
+        view = memoryview(out)
+        for k in range(0, len(view), MAX_READ_SIZE):
+            chunk = view[k:k + MAX_READ_SIZE]
+            self.queue(1, struct.pack('>II', addr + k, len(chunk)), size=len(chunk), into=chunk)
+        return out
+
+    def read_into(self, addr, out):
+        first = len(self.queued)
+        self.queue_read_into(addr, out)
+        replies = list(self.queued)[first:]
+        self.flush()
+        for r in replies:
+            if r.ret != 0:
+                print('read error : %08X' % r.ret)
+                return False
+        return True
+
     def read(self, addr, len):
-        data = struct.pack('>II', addr, len)
-        ret, data = self.send(1, data)
-        if ret == 0:
+        data = bytearray(len)
+        if self.read_into(addr, data):
             return data
-        print('read error : %08X' % ret)
 
     def send_and_exit(self, command, data):
-        request = struct.pack('>I', command) + data
-        self.s.send(request)
+        self.flush()
+        self.s.sendall(b''.join(self.frame(command, data)))
         self.s.close()
         self.s = None
-        self.fsa_handle = None
+        self.reset()
         exit()
 
+    def queue_write(self, addr, data):
+        return self.queue(0, struct.pack('>I', addr), data)
+
     def write(self, addr, data):
-        data = struct.pack('>I', addr) + data
-        ret, data = self.send(0, data)
+        r = self.queue_write(addr, data)
+        self.flush()
+        ret = r.ret
         if ret == 0:
             return ret
         print('write error : %08X' % ret)
 
+    def queue_svc(self, svc_id, arguments):
+        r = self.queue(2, struct.pack('>%dI' % (len(arguments) + 1), svc_id, *arguments), size=4)
+        if self.instrumentation is not None:
+            # ioctl and ioctlv both take (handle, request, ...)
+            r.tag = (svc_id, arguments[1] if svc_id in (0x38, 0x39) else None)
+        return r
+
     def svc(self, svc_id, arguments):
-        data = struct.pack('>I', svc_id)
-        for a in arguments:
-            data += struct.pack('>I', a)
-        ret, data = self.send(2, data)
+        r = self.queue_svc(svc_id, arguments)
+        self.flush()
+        ret, data = r.ret, r.data
         if ret == 0:
-            return struct.unpack('>I', data)[0]
+            return struct.unpack_from('>I', data)[0]
         print('svc error : %08X' % ret)
 
     def svc_and_exit(self, svc_id, arguments):
-        data = struct.pack('>I', svc_id)
-        for a in arguments:
-            data += struct.pack('>I', a)
-        self.send_and_exit(2, data)
+        self.send_and_exit(2, struct.pack('>%dI' % (len(arguments) + 1), svc_id, *arguments))
 
     def kill(self):
         ret, _ = self.send(3, bytearray())
         return ret
 
+    def queue_memcpy(self, dst, src, len):
+        return self.queue(4, struct.pack('>III', dst, src, len))
+
     def memcpy(self, dst, src, len):
         data = struct.pack('>III', dst, src, len)
         ret, data = self.send(4, data)
@@ -224,12 +1288,19 @@ class wupclient:
     def free(self, address):
         if address == 0:
             return 0
+        if address in self.pool.owned:
+            self.pool.put(address)
+            self.flush()
+            return 0
         return self.svc(0x29, [0xCAFF, address])
 
     def load_buffer(self, b, align=None):
         if len(b) == 0:
             return 0
-        address = self.alloc(len(b), align)
+        if align is None or align <= 0x40:
+            address = self.pool.get(len(b))
+        else:
+            address = self.alloc(len(b), align)
         self.write(address, b)
         return address
 
@@ -245,245 +1316,203 @@ class wupclient:
     def close(self, handle):
         return self.svc(0x34, [handle])
 
+    def batch(self):
+        return wupbatch(self)
+
+    # turns on request instrumentation for this session (and connections
+    # opened from it), trace also keeps a timeline for write_trace()
+    def instrument(self, trace=False):
+        if self.instrumentation is None:
+            self.instrumentation = wupstats(trace)
+        return self.instrumentation
+
+    def stats(self, show=True):
+        if self.instrumentation is None:
+            print('stats error : instrumentation is off, call instrument() first')
+            return None
+        summary = self.instrumentation.summary()
+        if show:
+            print_stats(summary)
+        return summary
+
+    # chrome://tracing / Perfetto compatible JSON
+    def write_trace(self, filename):
+        if self.instrumentation is None or self.instrumentation.events is None:
+            print('trace error : call instrument(trace=True) first')
+            return
+        self.instrumentation.write_trace(filename)
+
     def ioctl(self, handle, cmd, inbuf, outbuf_size):
-        in_address = self.load_buffer(inbuf)
-        out_data = None
-        if outbuf_size > 0:
-            out_address = self.alloc(outbuf_size)
-            ret = self.svc(0x38, [handle, cmd, in_address, len(inbuf), out_address, outbuf_size])
-            out_data = self.read(out_address, outbuf_size)
-            self.free(out_address)
-        else:
-            ret = self.svc(0x38, [handle, cmd, in_address, len(inbuf), 0, 0])
-        self.free(in_address)
-        return (ret, out_data)
+        b = self.batch()
+        r = b.ioctl(handle, cmd, inbuf, outbuf_size)
+        b.flush()
+        return (r.ret, r.data)
 
     def iovec(self, vecs):
-        data = bytearray()
-        for (a, s) in vecs:
-            data += struct.pack('>III', a, s, 0)
+        data = bytearray(0xC * len(vecs))
+        for i, (a, s) in enumerate(vecs):
+            struct.pack_into('>III', data, 0xC * i, a, s, 0)
         return self.load_buffer(data)
 
     def ioctlv(self, handle, cmd, inbufs, outbuf_sizes, inbufs_ptr=[], outbufs_ptr=[]):
-        inbufs = [(self.load_buffer(b, 0x40), len(b)) for b in inbufs]
-        outbufs = [(self.alloc(s, 0x40), s) for s in outbuf_sizes]
-        iovecs = self.iovec(inbufs + inbufs_ptr + outbufs_ptr + outbufs)
-        out_data = []
-        ret = self.svc(0x39, [handle, cmd, len(inbufs + inbufs_ptr), len(outbufs + outbufs_ptr), iovecs])
-        for (a, s) in outbufs:
-            out_data += [self.read(a, s)]
-        for (a, _) in (inbufs + outbufs):
-            self.free(a)
-        self.free(iovecs)
-        return (ret, out_data)
+        b = self.batch()
+        r = b.ioctlv(handle, cmd, inbufs, outbuf_sizes, inbufs_ptr, outbufs_ptr)
+        b.flush()
+        return (r.ret, r.data)
 
     # fsa
     def FSA_Mount(self, handle, device_path, volume_path, flags):
-        inbuffer = buffer(0x520)
-        copy_string(inbuffer, device_path, 0x0004)
-        copy_string(inbuffer, volume_path, 0x0284)
-        copy_word(inbuffer, flags, 0x0504)
+        inbuffer = FSA_MOUNT.build(device_path, volume_path, flags)
         (ret, _) = self.ioctlv(handle, 0x01, [inbuffer, bytearray()], [0x293])
+        self.cache.invalidate(volume_path)
         return ret
 
     def FSA_Unmount(self, handle, path, flags):
-        inbuffer = buffer(0x520)
-        copy_string(inbuffer, path, 0x4)
-        copy_word(inbuffer, flags, 0x284)
-        (ret, _) = self.ioctl(handle, 0x02, inbuffer, 0x293)
+        (ret, _) = self.ioctl(handle, 0x02, FSA_PATH_FLAGS.build(path, flags), 0x293)
+        self.cache.invalidate(path)
         return ret
 
     def FSA_RawOpen(self, handle, device):
-        inbuffer = buffer(0x520)
-        copy_string(inbuffer, device, 0x4)
-        (ret, data) = self.ioctl(handle, 0x6A, inbuffer, 0x293)
-        return (ret, struct.unpack('>I', data[4:8])[0])
+        (ret, data) = self.ioctl(handle, 0x6A, FSA_PATH.build(device), 0x293)
+        return (ret, U32.unpack_from(data, 4)[0])
 
     def FSA_OpenDir(self, handle, path):
-        inbuffer = buffer(0x520)
-        copy_string(inbuffer, path, 0x4)
-        (ret, data) = self.ioctl(handle, 0x0A, inbuffer, 0x293)
-        return (ret, struct.unpack('>I', data[4:8])[0])
+        (ret, data) = self.ioctl(handle, 0x0A, FSA_PATH.build(path), 0x293)
+        return (ret, U32.unpack_from(data, 4)[0])
 
     def FSA_ReadDir(self, handle, dir_handle):
-        inbuffer = buffer(0x520)
-        copy_word(inbuffer, dir_handle, 0x4)
-        (ret, data) = self.ioctl(handle, 0x0B, inbuffer, 0x293)
-        data = bytearray(data[4:])
-        unk = data[:0x64]
+        (ret, data) = self.ioctl(handle, 0x0B, FSA_HANDLE.build(dir_handle), 0x293)
         if ret == 0:
-            return (ret, {'name': get_string(data, 0x64), 'is_file': (unk[0] & 128) != 128, 'unk': unk})
+            return (ret, fsa_dir_entry(get_string(data, 0x68), (data[4] & 128) != 128, data[4:0x68]))
         return (ret, None)
 
     def FSA_CloseDir(self, handle, dir_handle):
-        inbuffer = buffer(0x520)
-        copy_word(inbuffer, dir_handle, 0x4)
-        (ret, data) = self.ioctl(handle, 0x0D, inbuffer, 0x293)
+        (ret, data) = self.ioctl(handle, 0x0D, FSA_HANDLE.build(dir_handle), 0x293)
         return ret
 
     def FSA_OpenFile(self, handle, path, mode):
-        inbuffer = buffer(0x520)
-        copy_string(inbuffer, path, 0x4)
-        copy_string(inbuffer, mode, 0x284)
-        (ret, data) = self.ioctl(handle, 0x0E, inbuffer, 0x293)
-        return (ret, struct.unpack('>I', data[4:8])[0])
+        (ret, data) = self.ioctl(handle, 0x0E, FSA_PATH_PATH.build(path, mode), 0x293)
+        return (ret, U32.unpack_from(data, 4)[0])
 
     def FSA_MakeDir(self, handle, path, flags):
-        inbuffer = buffer(0x520)
-        copy_string(inbuffer, path, 0x4)
-        copy_word(inbuffer, flags, 0x284)
-        (ret, _) = self.ioctl(handle, 0x07, inbuffer, 0x293)
+        (ret, _) = self.ioctl(handle, 0x07, FSA_PATH_FLAGS.build(path, flags), 0x293)
         return ret
 
     def FSA_ReadFile(self, handle, file_handle, size, cnt):
-        inbuffer = buffer(0x520)
-        copy_word(inbuffer, size, 0x08)
-        copy_word(inbuffer, cnt, 0x0C)
-        copy_word(inbuffer, file_handle, 0x14)
+        inbuffer = FSA_READ_WRITE.build(size, cnt, file_handle)
         (ret, data) = self.ioctlv(handle, 0x0F, [inbuffer], [size * cnt, 0x293])
         return (ret, data[0])
 
     def FSA_WriteFile(self, handle, file_handle, data):
-        inbuffer = buffer(0x520)
-        copy_word(inbuffer, 1, 0x08) # size
-        copy_word(inbuffer, len(data), 0x0C) # cnt
-        copy_word(inbuffer, file_handle, 0x14)
+        inbuffer = FSA_READ_WRITE.build(1, len(data), file_handle)
         (ret, data) = self.ioctlv(handle, 0x10, [inbuffer, data], [0x293])
         return (ret)
 
-    def FSA_ReadFilePtr(self, handle, file_handle, size, cnt, ptr):
-        inbuffer = buffer(0x520)
-        copy_word(inbuffer, size, 0x08)
-        copy_word(inbuffer, cnt, 0x0C)
-        copy_word(inbuffer, file_handle, 0x14)
+    def FSA_ReadFilePtr(self, handle, file_handle, size, cnt, ptr, batch=None):
+        inbuffer = FSA_READ_WRITE.build(size, cnt, file_handle)
+        if batch is not None:
+            return batch.ioctlv(handle, 0x0F, [inbuffer], [0x293], [], [(ptr, size*cnt)])
         (ret, data) = self.ioctlv(handle, 0x0F, [inbuffer], [0x293], [], [(ptr, size*cnt)])
         return (ret, data[0])
 
-    def FSA_WriteFilePtr(self, handle, file_handle, size, cnt, ptr):
-        inbuffer = buffer(0x520)
-        copy_word(inbuffer, size, 0x08)
-        copy_word(inbuffer, cnt, 0x0C)
-        copy_word(inbuffer, file_handle, 0x14)
+    def FSA_WriteFilePtr(self, handle, file_handle, size, cnt, ptr, batch=None):
+        inbuffer = FSA_READ_WRITE.build(size, cnt, file_handle)
+        if batch is not None:
+            return batch.ioctlv(handle, 0x10, [inbuffer], [0x293], [(ptr, size*cnt)], [])
         (ret, data) = self.ioctlv(handle, 0x10, [inbuffer], [0x293], [(ptr, size*cnt)], [])
         return (ret)
 
+    def FSA_GetPosFile(self, handle, file_handle):
+        (ret, data) = self.ioctl(handle, 0x11, FSA_HANDLE.build(file_handle), 0x293)
+        return (ret, U32.unpack_from(data, 4)[0])
+
+    def FSA_SetPosFile(self, handle, file_handle, position):
+        (ret, _) = self.ioctl(handle, 0x12, FSA_SET_POS.build(file_handle, position), 0x293)
+        return ret
+
     def FSA_GetStatFile(self, handle, file_handle):
-        inbuffer = buffer(0x520)
-        copy_word(inbuffer, file_handle, 0x4)
-        (ret, data) = self.ioctl(handle, 0x14, inbuffer, 0x64)
-        return (ret, struct.unpack('>IIIIIIIIIIIIIIIIIIIIIIIII', data))
+        (ret, data) = self.ioctl(handle, 0x14, FSA_HANDLE.build(file_handle), 0x64)
+        return (ret, fsa_stat(FSA_STAT_WORDS.unpack(data)))
 
     def FSA_CloseFile(self, handle, file_handle):
-        inbuffer = buffer(0x520)
-        copy_word(inbuffer, file_handle, 0x4)
-        (ret, data) = self.ioctl(handle, 0x15, inbuffer, 0x293)
+        (ret, data) = self.ioctl(handle, 0x15, FSA_HANDLE.build(file_handle), 0x293)
         return ret
 
     def FSA_ChangeMode(self, handle, path, mode, mask=0x777):
-        inbuffer = buffer(0x520)
-        copy_string(inbuffer, path, 0x0004)
-        copy_word(inbuffer, mode, 0x0284)
-        copy_word(inbuffer, mask, 0x0288)
-        (ret, _) = self.ioctl(handle, 0x20, inbuffer, 0x293)
+        (ret, _) = self.ioctl(handle, 0x20, FSA_CHANGE_MODE.build(path, mode, mask), 0x293)
         return ret
 
     def FSA_Rename(self, handle, oldpath, newpath):
-        inbuffer = buffer(0x520)
-        copy_string(inbuffer, oldpath, 0x4)
-        copy_string(inbuffer, newpath, 0x284)
-        (ret, _) = self.ioctl(handle, 0x09, inbuffer, 0x293)
+        (ret, _) = self.ioctl(handle, 0x09, FSA_PATH_PATH.build(oldpath, newpath), 0x293)
         return ret
 
-    def FSA_Remove(self, handle, path):
-        inbuffer = buffer(0x520)
-        copy_string(inbuffer, path, 0x04)
-        (ret, _) = self.ioctl(handle, 0x08, inbuffer, 0x293)
+    def FSA_Remove(self, handle, path, batch=None):
+        if batch is not None:
+            return batch.ioctl(handle, 0x08, FSA_PATH.build(path), 0x293)
+        (ret, _) = self.ioctl(handle, 0x08, FSA_PATH.build(path), 0x293)
         return ret
 
     def FSA_FlushVolume(self, handle, path):
-        inbuffer = buffer(0x520)
-        copy_string(inbuffer, path, 0x04)
-        (ret, _) = self.ioctl(handle, 0x1B, inbuffer, 0x293)
+        (ret, _) = self.ioctl(handle, 0x1B, FSA_PATH.build(path), 0x293)
         return ret
 
     def FSA_Format(self, handle, device_path, filesystem, flags):
-        inbuffer = buffer(0x520)
-        copy_string(inbuffer, device_path, 0x0004)
-        copy_string(inbuffer, filesystem,  0x0284)
-        copy_word(inbuffer, flags, 0x028F)
-        (ret, _) = self.ioctl(handle, 0x69, inbuffer, 0x293)
+        (ret, _) = self.untimed(self.ioctl, handle, 0x69, FSA_FORMAT.build(device_path, filesystem, flags), 0x293)
+        self.cache.clear()
         return ret
 
     def FSA_GetInfoByQuery(self, handle, path, type):
-        inbuffer = buffer(0x520)
-        copy_string(inbuffer, path, 0x0004)
-        copy_word(inbuffer, type, 0x0284)
-        (ret, data) = self.ioctl(handle, 0x18, inbuffer, 0x64)
-        return (ret, struct.unpack('>IIIIIIIIIIIIIIIIIIIIIIIII', data))
+        (ret, data) = self.ioctl(handle, 0x18, FSA_PATH_FLAGS.build(path, type), 0x64)
+        return (ret, FSA_STAT_WORDS.unpack(data))
 
     # mcp
     def MCP_InstallGetInfo(self, handle, path):
-        inbuffer = buffer(0x27F)
-        copy_string(inbuffer, path, 0x0)
-        (ret, data) = self.ioctlv(handle, 0x80, [inbuffer], [0x16])
-        return (ret, struct.unpack('>IIIIIH', data[0]))
+        (ret, data) = self.ioctlv(handle, 0x80, [MCP_PATH.build(path)], [0x16])
+        return (ret, MCP_INSTALL_INFO.unpack(data[0]))
 
     def MCP_Install(self, handle, path):
-        inbuffer = buffer(0x27F)
-        copy_string(inbuffer, path, 0x0)
-        (ret, _) = self.ioctlv(handle, 0x81, [inbuffer], [])
+        (ret, _) = self.untimed(self.ioctlv, handle, 0x81, [MCP_PATH.build(path)], [])
+        self.cache.clear()
         return ret
 
     def MCP_InstallGetProgress(self, handle):
         (ret, data) = self.ioctl(handle, 0x82, [], 0x24)
-        return (ret, struct.unpack('>IIIIIIIII', data))
+        return (ret, MCP_INSTALL_PROGRESS.unpack(data))
 
     def MCP_DeleteTitle(self, handle, path, flush):
-        inbuffer = buffer(0x38)
-        copy_string(inbuffer, path, 0x0)
-        inbuffer2 = buffer(0x4)
-        copy_word(inbuffer2, flush, 0x0)
-        (ret, _) = self.ioctlv(handle, 0x83, [inbuffer, inbuffer2], [])
+        (ret, _) = self.untimed(self.ioctlv, handle, 0x83, [MCP_DELETE_PATH.build(path), MCP_WORD.build(flush)], [])
+        self.cache.invalidate(path)
         return ret
 
     def MCP_CopyTitle(self, handle, path, dst_device_id, flush):
-        inbuffer = buffer(0x27F)
-        copy_string(inbuffer, path, 0x0)
-        inbuffer2 = buffer(0x4)
-        copy_word(inbuffer2, dst_device_id, 0x0)
-        inbuffer3 = buffer(0x4)
-        copy_word(inbuffer3, flush, 0x0)
-        (ret, _) = self.ioctlv(handle, 0x85, [inbuffer, inbuffer2, inbuffer3], [])
+        (ret, _) = self.untimed(self.ioctlv, handle, 0x85, [MCP_PATH.build(path), MCP_WORD.build(dst_device_id), MCP_WORD.build(flush)], [])
+        self.cache.clear()
         return ret
 
     def MCP_InstallSetTargetDevice(self, handle, device):
-        inbuffer = buffer(0x4)
-        copy_word(inbuffer, device, 0x0)
-        (ret, _) = self.ioctl(handle, 0x8D, inbuffer, 0)
+        (ret, _) = self.ioctl(handle, 0x8D, MCP_WORD.build(device), 0)
         return ret
 
     def MCP_InstallSetTargetUsb(self, handle, device):
-        inbuffer = buffer(0x4)
-        copy_word(inbuffer, device, 0x0)
-        (ret, _) = self.ioctl(handle, 0xF1, inbuffer, 0)
+        (ret, _) = self.ioctl(handle, 0xF1, MCP_WORD.build(device), 0)
         return ret
 
     # syslog (tmp)
     def dump_syslog(self):
         syslog_address = struct.unpack('>I', self.read(0x05095ECC, 4))[0] + 0x10
-        block_size = 0x400
-        for i in range(0, 0x40000, block_size):
-            data = self.read(syslog_address + i, 0x400)
-            # if 0 in data:
-            #     print(data[:data.index(0)].decode('ascii'))
-            #     break
-            # else:
-            print(data.decode('ascii'))
+        # one pipelined read for the whole log, decoded once
+        data = self.read(syslog_address, 0x40000)
+        if data is None:
+            return
+        # if 0 in data:
+        #     data = data[:data.index(0)]
+        print(data.decode('ascii', 'replace'))
 
     def mkdir(self, path, flags):
         if path[0] != '/':
             path = self.cwd + '/' + path
-        ret = w.FSA_MakeDir(self.fsa_handle, path, flags)
+        ret = self.FSA_MakeDir(self.fsa_handle, path, flags)
+        self.cache.invalidate(path)
         if ret == 0:
             return 0
         print('mkdir error (%s, %08X)' % (path, ret))
@@ -492,111 +1521,401 @@ class wupclient:
     def chmod(self, filename, flags):
         if filename[0] != '/':
             filename = self.cwd + '/' + filename
-        ret = w.FSA_ChangeMode(self.fsa_handle, filename, flags)
+        ret = self.FSA_ChangeMode(self.fsa_handle, filename, flags)
+        self.cache.invalidate(filename)
         print('chmod returned : ' + hex(ret))
 
     def cd(self, path):
         if path[0] != '/' and self.cwd[0] == '/':
             return self.cd(self.cwd + '/' + path)
+        if self.cache.get('dir', path) is not None:
+            self.cwd = path
+            return 0
         ret, dir_handle = self.FSA_OpenDir(self.fsa_handle, path if path is not None else self.cwd)
         if ret == 0:
             self.cwd = path
             self.FSA_CloseDir(self.fsa_handle, dir_handle)
+            self.cache.put('dir', path, True)
             return 0
         print('cd error : path does not exist (%s)' % (path))
         return -1
 
-    def ls(self, path=None, return_data=False):
-        if path is not None and path[0] != '/':
-            path = self.cwd + '/' + path
-        ret, dir_handle = self.FSA_OpenDir(self.fsa_handle, path if path is not None else self.cwd)
+    # returns (ret, entries) for an absolute path, from the cache if possible
+    def listdir(self, path):
+        entries = self.cache.get('ls', path)
+        if entries is not None:
+            return (0, list(entries))
+        ret, dir_handle = self.FSA_OpenDir(self.fsa_handle, path)
         if ret != 0x0:
-            print('opendir error : ' + hex(ret))
-            return [] if return_data else None
+            return (ret, None)
         entries = []
         while True:
             ret, data = self.FSA_ReadDir(self.fsa_handle, dir_handle)
             if ret != 0:
                 break
-            if not(return_data):
-                if data['is_file']:
-                    print('     %s' % data['name'])
-                else:
-                    print('     %s/' % data['name'])
-            else:
-                entries += [data]
+            entries += [data]
         ret = self.FSA_CloseDir(self.fsa_handle, dir_handle)
-        return entries if return_data else None
+        self.cache.put_listing(path, entries)
+        return (0, list(entries))
 
-    def dldir(self, path):
-        if path[0] != '/':
+    def ls(self, path=None, return_data=False):
+        if path is not None and path[0] != '/':
             path = self.cwd + '/' + path
-        entries = self.ls(path, True)
-        for e in entries:
-            if e['is_file']:
-                print(e['name'])
-                self.dl(path + '/' + e['name'],path[1:])
+        ret, entries = self.listdir(path if path is not None else self.cwd)
+        if ret != 0x0:
+            print('opendir error : ' + hex(ret))
+            return [] if return_data else None
+        if return_data:
+            return entries
+        for data in entries:
+            if data['is_file']:
+                print('     %s' % data['name'])
             else:
-                print(e['name'] + '/')
-                self.dldir(path + '/' + e['name'])
-
-    def cpdir(self, srcpath, dstpath):
-        entries = self.ls(srcpath, True)
-        q = [(srcpath, dstpath, e) for e in entries]
+                print('     %s/' % data['name'])
+
+    # lists a remote tree, returns its directories (parents first) and its
+    # files, as (path, size) or with stats as (path, fsa_stat) straight
+    # from the directory listing
+    def walk(self, path, stats=False):
+        dirs = []
+        files = []
+        q = deque([path])
         while len(q) > 0:
-            _srcpath, _dstpath, e = q.pop()
-            _srcpath += '/' + e['name']
-            _dstpath += '/' + e['name']
-            if e['is_file']:
-                print(e['name'])
-                self.cp(_srcpath, _dstpath)
-            else:
-                self.mkdir(_dstpath, 0x600)
-                entries = self.ls(_srcpath, True)
-                q += [(_srcpath, _dstpath, e) for e in entries]
+            d = q.popleft()
+            for e in self.ls(d, True):
+                if e['is_file']:
+                    files.append((d + '/' + e['name'], e.stat if stats else e.stat.size))
+                else:
+                    dirs.append(d + '/' + e['name'])
+                    q.append(d + '/' + e['name'])
+        return (dirs, files)
+
+    def dldir(self, path, connections=4):
+        if path[0] != '/':
+            path = self.cwd + '/' + path
+        dirs, files = self.walk(path)
+        jobs = []
+        for (f, size) in files:
+            d = f[:f.rindex('/')]
+            jobs.append((size, f, lambda c, f=f, d=d: c.dl(f, d[1:], None, False)))
+        errors = wuptransfer(self, connections).run(jobs)
+        report_failures('dldir', errors)
+        return errors
+
+    def cpdir(self, srcpath, dstpath, connections=4):
+        if srcpath[0] != '/':
+            srcpath = self.cwd + '/' + srcpath
+        if dstpath[0] != '/':
+            dstpath = self.cwd + '/' + dstpath
+        device = title_copy_device(srcpath, dstpath)
+        if device is not None:
+            # whole titles moving between mlc and usb are left to mcp
+            ret = self.MCP_CopyTitle(self.mcp_handle, srcpath, device, 0)
+            self.cache.invalidate(dstpath)
+            if ret == 0x0:
+                print('cpdir : copied title ' + srcpath + ' with MCP_CopyTitle')
+                return []
+            print('cpdir : MCP_CopyTitle returned ' + hex(ret) + ', copying files instead')
+        dirs, files = self.walk(srcpath)
+        for d in dirs:
+            self.mkdir(dstpath + d[len(srcpath):], 0x600)
+        jobs = []
+        for (f, size) in files:
+            jobs.append((size, f, lambda c, f=f: c.cp(f, dstpath + f[len(srcpath):], False)))
+        errors = wuptransfer(self, connections).run(jobs)
+        # the copies may have run on other connections
+        self.cache.invalidate(dstpath)
+        report_failures('cpdir', errors)
+        return errors
+
+    # removes paths in the given order, up to batch_size FSA_Remove requests
+    # in flight. the server handles them in order so a plan listing children
+    # before their parents stays valid. returns the ret of each remove
+    def remove_all(self, paths, batch_size=32):
+        rets = []
+        for i in range(0, len(paths), batch_size):
+            with self.batch() as b:
+                results = [self.FSA_Remove(self.fsa_handle, p, batch=b) for p in paths[i:i + batch_size]]
+            rets += [r.ret for r in results]
+        return rets
+
+    # chunked, checksummed transfers that pick up where an interrupted one
+    # stopped, see wupresume
+    def dl_resume(self, filename, local_filename=None, chunk_size=0x100000, verify=True, retries=5):
+        if filename[0] != '/':
+            filename = self.cwd + '/' + filename
+        if local_filename is None:
+            local_filename = filename[filename.rindex('/') + 1:]
+        return wupresume(self, chunk_size, verify, retries).dl(filename, local_filename)
+
+    def up_resume(self, local_filename, filename=None, chunk_size=0x100000, verify=True, retries=5):
+        if filename is None:
+            filename = os.path.basename(local_filename)
+        if filename[0] != '/':
+            filename = self.cwd + '/' + filename
+        return wupresume(self, chunk_size, verify, retries).up(local_filename, filename)
+
+    def cp_resume(self, filename_in, filename_out, chunk_size=0x100000, verify=True, retries=5):
+        if filename_in[0] != '/':
+            filename_in = self.cwd + '/' + filename_in
+        if filename_out[0] != '/':
+            filename_out = self.cwd + '/' + filename_out
+        return wupresume(self, chunk_size, verify, retries).cp(filename_in, filename_out)
+
+    def backup(self, path, directory='backup', connections=4):
+        if path[0] != '/':
+            path = self.cwd + '/' + path
+        return wupbackup(self, directory).run(path, connections)
+
+    def scan_titles(self, devices=None, connections=4, catalog_file='titles.json'):
+        catalog = wuptitles(self, catalog_file)
+        catalog.scan(devices, connections)
+        return catalog
 
     def pwd(self):
         return self.cwd
 
-    def cp(self, filename_in, filename_out):
+    # copies on the console without moving the data over the network. each
+    # block is one batch with a FSA_ReadFilePtr and a FSA_WriteFilePtr on the
+    # same IOS buffer and the next block goes out before the current one is
+    # done, so the console always has the next read queued behind a write
+    def cp(self, filename_in, filename_out, show_progress=True, block_size=0x40000):
+        if filename_in[0] != '/':
+            filename_in = self.cwd + '/' + filename_in
+        if filename_out[0] != '/':
+            filename_out = self.cwd + '/' + filename_out
         ret, in_file_handle = self.FSA_OpenFile(self.fsa_handle, filename_in, 'r')
         if ret != 0x0:
             print('cp error : could not open ' + filename_in)
-            return
+            return -1
+        ret, stats = self.FSA_GetStatFile(self.fsa_handle, in_file_handle)
+        if ret != 0x0:
+            print('cp error : could not stat ' + filename_in)
+            self.FSA_CloseFile(self.fsa_handle, in_file_handle)
+            return -1
         ret, out_file_handle = self.FSA_OpenFile(self.fsa_handle, filename_out, 'w')
+        self.cache.invalidate(filename_out)
         if ret != 0x0:
             print('cp error : could not open ' + filename_out)
-            return
-        block_size = 0x10000
-        buffer = self.alloc(block_size, 0x40)
+            self.FSA_CloseFile(self.fsa_handle, in_file_handle)
+            return -1
+        size = stats.size
+        buffers, block_size = self.get_block_buffers(min(block_size, max(size, 0x10000)))
+        pending = deque()
         k = 0
-        while True:
-            ret, _ = self.FSA_ReadFilePtr(self.fsa_handle, in_file_handle, 0x1, block_size, buffer)
-            k += ret
-            ret = self.FSA_WriteFilePtr(self.fsa_handle, out_file_handle, 0x1, ret, buffer)
-            sys.stdout.write(hex(k) + '\r'); sys.stdout.flush();
-            if ret < block_size:
+        error = None
+        shown = monotonic()
+        for i, pos in enumerate(range(0, size, block_size)):
+            n = min(block_size, size - pos)
+            outstanding = len(self.queued) + len(self.inflight)
+            b = self.batch()
+            rd = self.FSA_ReadFilePtr(self.fsa_handle, in_file_handle, 0x1, n, buffers[i % 2], b)
+            wr = self.FSA_WriteFilePtr(self.fsa_handle, out_file_handle, 0x1, n, buffers[i % 2], b)
+            b.submit()
+            pending.append((rd, wr, n))
+            # everything but this block has to be done before its buffer
+            # comes around again
+            self.flush(len(self.queued) + len(self.inflight) - outstanding)
+            while len(pending) > 0 and pending[0][1].ret is not None:
+                rd, wr, n = pending.popleft()
+                if rd.ret != n or wr.ret != n:
+                    error = (rd.ret, wr.ret)
+                    break
+                k += n
+            if error is not None:
                 break
-        self.free(buffer)
+            if show_progress and monotonic() - shown > 0.5:
+                shown = monotonic()
+                sys.stdout.write(hex(k) + '\r'); sys.stdout.flush();
+        self.flush()
+        for (rd, wr, n) in pending:
+            if error is None and (rd.ret != n or wr.ret != n):
+                error = (rd.ret, wr.ret)
+        if error is not None:
+            print('cp error : read %s, write %s' % (hex(error[0] or 0), hex(error[1] or 0)))
+        self.put_block_buffers(buffers)
         ret = self.FSA_CloseFile(self.fsa_handle, out_file_handle)
         ret = self.FSA_CloseFile(self.fsa_handle, in_file_handle)
-
-    def df(self, filename_out, src, size):
+        return -1 if error is not None else 0
+
+    # two pooled IOS buffers of up to block_size bytes, smaller ones if the
+    # IOS heap can't spare that much
+    def get_block_buffers(self, block_size):
+        buffers = [self.pool.get(block_size), self.pool.get(block_size)]
+        while not (buffers[0] and buffers[1]) and block_size > 0x10000:
+            self.put_block_buffers(buffers)
+            self.pool.trim()
+            block_size >>= 1
+            buffers = [self.pool.get(block_size), self.pool.get(block_size)]
+        return (buffers, block_size)
+
+    def put_block_buffers(self, buffers):
+        for b in buffers:
+            if b:
+                self.pool.put(b)
+
+    # stages memory into a file on the console: memcpy into an IOS buffer
+    # and FSA_WriteFilePtr from it, one batch per block with the next block
+    # going out while the current one is written
+    def df(self, filename_out, src, size, show_progress=True, block_size=0x40000):
         ret, out_file_handle = self.FSA_OpenFile(self.fsa_handle, filename_out, 'w')
+        self.cache.invalidate(filename_out)
         if ret != 0x0:
             print('df error : could not open ' + filename_out)
-            return
-        block_size = 0x10000
-        buffer = self.alloc(block_size, 0x40)
+            return -1
+        buffers, block_size = self.get_block_buffers(min(block_size, max(size, 0x10000)))
+        pending = deque()
         k = 0
-        while k < size:
-            cur_size = min(size - k, block_size)
-            self.memcpy(buffer, src + k, cur_size)
-            k += cur_size
-            ret = self.FSA_WriteFilePtr(self.fsa_handle, out_file_handle, 0x1, cur_size, buffer)
-            sys.stdout.write(hex(k) + ' (%f) ' % (float(k * 100) / size) + '\r'); sys.stdout.flush();
-        self.free(buffer)
+        error = None
+        shown = monotonic()
+        for i, pos in enumerate(range(0, size, block_size)):
+            n = min(block_size, size - pos)
+            outstanding = len(self.queued) + len(self.inflight)
+            cp = self.queue_memcpy(buffers[i % 2], src + pos, n)
+            b = self.batch()
+            wr = self.FSA_WriteFilePtr(self.fsa_handle, out_file_handle, 0x1, n, buffers[i % 2], b)
+            b.submit()
+            pending.append((cp, wr, n))
+            self.flush(len(self.queued) + len(self.inflight) - outstanding)
+            while len(pending) > 0 and pending[0][1].ret is not None:
+                cp, wr, n = pending.popleft()
+                if cp.ret != 0 or wr.ret != n:
+                    error = (cp.ret, wr.ret)
+                    break
+                k += n
+            if error is not None:
+                break
+            if show_progress and monotonic() - shown > 0.5:
+                shown = monotonic()
+                sys.stdout.write(hex(k) + ' (%f) ' % (float(k * 100) / size) + '\r'); sys.stdout.flush();
+        self.flush()
+        for (cp, wr, n) in pending:
+            if error is None and (cp.ret != 0 or wr.ret != n):
+                error = (cp.ret, wr.ret)
+            elif error is None:
+                k += n
+        if error is not None:
+            print('df error : memcpy %s, write %s' % (hex(error[0] or 0), hex(error[1] or 0)))
+        self.put_block_buffers(buffers)
         ret = self.FSA_CloseFile(self.fsa_handle, out_file_handle)
+        return k if error is None else -1
+
+    # reads memory straight into an mmap of the output file. reads are
+    # queued a window at a time and the next window is on the wire while
+    # the current one is being received
+    def dump(self, addr, size, filename, show_progress=True, window=0x40000):
+        # connect first so nothing past this point leaves a slice of the
+        # mmap behind in a traceback
+        if self.s is None:
+            self.connect()
+        with open(filename, 'w+b') as f:
+            f.truncate(size)
+            if size == 0:
+                return 0
+            with mmap.mmap(f.fileno(), size) as m, memoryview(m) as view:
+                sent = []
+                pending = deque()
+                error = None
+                shown = monotonic()
+                k = 0
+                try:
+                    for pos in range(0, size, window):
+                        first = len(self.queued)
+                        self.queue_read_into(addr + pos, view[pos:pos + window])
+                        replies = list(self.queued)[first:]
+                        sent += replies
+                        pending.append(replies)
+                        # everything before this window is in after this
+                        self.flush(len(replies))
+                        while len(pending) > 1:
+                            for r in pending.popleft():
+                                if r.ret != 0 and error is None:
+                                    error = r.ret
+                                k += len(r.into)
+                        if error is not None:
+                            break
+                        if show_progress and monotonic() - shown > 0.5:
+                            shown = monotonic()
+                            sys.stdout.write(hex(k) + ' (%f) ' % (float(k * 100) / size) + '\r'); sys.stdout.flush();
+                    self.flush()
+                    for replies in pending:
+                        for r in replies:
+                            if r.ret != 0 and error is None:
+                                error = r.ret
+                finally:
+                    # the mmap can only be closed once nothing points into
+                    # it, otherwise a BufferError would replace whatever
+                    # went wrong
+                    for r in sent:
+                        r.into.release()
+        if error is not None:
+            print('dump error : %08X' % error)
+            return -1
+        return size
+
+    # for large regions: stages the memory in a file on the console with df
+    # and downloads that in bulk
+    def dump_staged(self, addr, size, filename, staging='/vol/storage_sdcard/dump.bin', keep=False, show_progress=True):
+        if self.df(staging, addr, size, show_progress) != size:
+            return -1
+        ret = self.dl(staging, None, filename, show_progress)
+        if not keep:
+            self.FSA_Remove(self.fsa_handle, staging)
+            self.cache.invalidate(staging)
+        return size if ret == 0 else -1
+
+    # streams an open file through two IOS buffers: the FSA read of the next
+    # block is queued together with pulling the current one over the socket.
+    # sink gets a view of every block as it arrives, only valid until it
+    # returns. returns the number of bytes read, -1 if reading failed
+    def read_file_blocks(self, file_handle, sink, size=None, show_progress=True):
+        if size == 0:
+            return 0
+        block_size = TRANSFER_BLOCK_SIZE
+        buffers = [self.pool.get(block_size), self.pool.get(block_size)]
+        if not (buffers[0] and buffers[1]):
+            print('read error : out of IOS memory')
+            self.put_block_buffers(buffers)
+            return -1
+        block = memoryview(bytearray(block_size))
+
+        def submit(i, k):
+            cur_size = block_size if size is None else min(block_size, size - k)
+            b = self.batch()
+            r = self.FSA_ReadFilePtr(self.fsa_handle, file_handle, 0x1, cur_size, buffers[i], b)
+            b.submit()
+            return (r, cur_size)
+
+        k = 0
+        i = 0
+        error = False
+        pending = submit(i, k)
+        self.flush()
+        while True:
+            r, cur_size = pending
+            if r.ret is None or r.ret > cur_size:
+                print('read error : ' + hex(r.ret or 0))
+                error = True
+                break
+            done = r.ret < cur_size or (size is not None and k + r.ret >= size)
+            if not done:
+                pending = submit(i ^ 1, k + r.ret)
+            if r.ret > 0:
+                if not self.read_into(buffers[i], block[:r.ret]):
+                    error = True
+                    break
+                sink(block[:r.ret])
+            k += r.ret
+            if show_progress:
+                sys.stdout.write(hex(k) + '\r'); sys.stdout.flush();
+            if done:
+                break
+            i ^= 1
+        # a read queued before an error still lands in one of the buffers
+        self.flush()
+        self.pool.put(buffers[0])
+        self.pool.put(buffers[1])
+        return -1 if error else k
 
     def dl_buf(self, filename, show_progress = True):
         if filename[0] != '/':
@@ -606,37 +1925,95 @@ class wupclient:
             print('dl error : could not open ' + filename)
             return None
         buf = bytearray()
-        block_size = 0x400
-        while True:
-            ret, data = self.FSA_ReadFile(self.fsa_handle, file_handle, 0x1, block_size)
-            buf += data[:ret]
-            if show_progress:
-                sys.stdout.write(hex(len(buf)) + '\r')
-                sys.stdout.flush()
-            if ret < block_size:
-                break
+        got = self.read_file_blocks(file_handle, buf.extend, None, show_progress)
         self.FSA_CloseFile(self.fsa_handle, file_handle)
+        if got < 0:
+            print('dl error : could not read ' + filename)
+            return None
         return buf
 
-    def dl(self, filename, directorypath=None, local_filename=None):
-        buf = self.dl_buf(filename)
-        if buf is None:
-            return -1
+    def dl(self, filename, directorypath=None, local_filename=None, show_progress=True):
         if local_filename is None:
             if '/' in filename:
                 local_filename = filename[[i for i, x in enumerate(filename) if x == '/'][-1]+1:]
             else:
                 local_filename = filename
-        if directorypath is None:
-            open(local_filename, 'wb').write(buf)
-        else:
+        if filename[0] != '/':
+            filename = self.cwd + '/' + filename
+        ret, file_handle = self.FSA_OpenFile(self.fsa_handle, filename, 'r')
+        if ret != 0x0:
+            print('dl error : could not open ' + filename)
+            return -1
+        if directorypath is not None:
             dir_path = os.path.dirname(os.path.abspath(sys.argv[0])).replace('\\','/')
             fullpath = dir_path + '/' + directorypath + '/'
             fullpath = fullpath.replace('//','/')
             mkdir_p(fullpath)
-            open(fullpath + local_filename, 'wb').write(buf)
+            local_filename = fullpath + local_filename
+        with open(local_filename, 'wb') as f:
+            got = -1
+            try:
+                got = self.read_file_blocks(file_handle, f.write, None, show_progress)
+            finally:
+                # no truncated copy that looks like a good one
+                if got < 0:
+                    f.close()
+                    os.remove(local_filename)
+        self.FSA_CloseFile(self.fsa_handle, file_handle)
+        if got < 0:
+            print('dl error : could not read ' + filename)
+            return -1
         return 0
 
+    # stages blocks from source (a file-like object or any buffer) into two
+    # IOS buffers with large writes and commits them with FSA_WriteFilePtr.
+    # the previous block only has to be done before the next one is queued,
+    # so one block is always in flight. returns the number of bytes written,
+    # -1 if there are no IOS buffers to stage them in
+    def write_file_blocks(self, file_handle, source, show_progress=True):
+        block_size = TRANSFER_BLOCK_SIZE
+        buffers = [self.pool.get(block_size), self.pool.get(block_size)]
+        if not (buffers[0] and buffers[1]):
+            print('write error : out of IOS memory')
+            self.put_block_buffers(buffers)
+            return -1
+        pending = deque()
+        k = 0
+        i = 0
+        error = None
+        for data in iter_blocks(source, block_size):
+            outstanding = len(self.queued) + len(self.inflight)
+            for j in range(0, len(data), MAX_WRITE_SIZE):
+                self.queue_write(buffers[i] + j, data[j:j + MAX_WRITE_SIZE])
+            b = self.batch()
+            pending.append((self.FSA_WriteFilePtr(self.fsa_handle, file_handle, 0x1, len(data), buffers[i], b), len(data)))
+            b.submit()
+            self.flush(len(self.queued) + len(self.inflight) - outstanding)
+            while len(pending) > 0 and pending[0][0].ret is not None:
+                r, size = pending.popleft()
+                if r.ret != size:
+                    error = r.ret
+                    break
+                k += size
+                if show_progress:
+                    sys.stdout.write(hex(k) + '\r'); sys.stdout.flush();
+            if error is not None:
+                break
+            i ^= 1
+        self.flush()
+        for (r, size) in pending:
+            if error is not None:
+                break
+            if r.ret != size:
+                error = r.ret
+            else:
+                k += size
+        if error is not None:
+            print('write error : ' + hex(error or 0))
+        self.pool.put(buffers[0])
+        self.pool.put(buffers[1])
+        return k
+
     def mkdir_p(path):
         try:
             os.makedirs(path)
@@ -652,52 +2029,134 @@ class wupclient:
         if ret != 0x0:
             print('fr error : could not open ' + filename)
             return
+        if offset != 0:
+            self.FSA_SetPosFile(self.fsa_handle, file_handle, offset)
         buffer = bytearray()
-        block_size = 0x400
-        while True:
-            ret, data = self.FSA_ReadFile(self.fsa_handle, file_handle, 0x1, block_size if (block_size < size) else size)
-            buffer += data[:ret]
-            sys.stdout.write(hex(len(buffer)) + '\r'); sys.stdout.flush();
-            if len(buffer) >= size:
-                break
+        got = self.read_file_blocks(file_handle, buffer.extend, size)
         ret = self.FSA_CloseFile(self.fsa_handle, file_handle)
+        if got < 0:
+            return None
         return buffer
 
     def fw(self, filename, offset, buffer):
         if filename[0] != '/':
             filename = self.cwd + '/' + filename
         ret, file_handle = self.FSA_OpenFile(self.fsa_handle, filename, 'r+')
+        self.cache.invalidate(filename)
         if ret != 0x0:
             print('fw error : could not open ' + filename)
             return
-        block_size = 0x400
-        k = 0
-        while True:
-            cur_size = min(len(buffer) - k, block_size)
-            if cur_size <= 0:
-                break
-            sys.stdout.write(hex(k) + '\r'); sys.stdout.flush();
-            ret = self.FSA_WriteFile(self.fsa_handle, file_handle, buffer[k:(k+cur_size)])
-            k += cur_size
+        if offset != 0:
+            self.FSA_SetPosFile(self.fsa_handle, file_handle, offset)
+        self.write_file_blocks(file_handle, buffer)
         ret = self.FSA_CloseFile(self.fsa_handle, file_handle)
 
-    def stat(self, filename):
+    # edits is {element: value}, element being a tag name or a path like
+    # 'sys_prod/product_area'. the file is read once and only written back
+    # if a value actually changed, then read back to check it made it
+    def patch_config(self, filename, edits, backup=True):
         if filename[0] != '/':
             filename = self.cwd + '/' + filename
-        ret, file_handle = self.FSA_OpenFile(self.fsa_handle, filename, 'r')
+        data = self.dl_buf(filename, False)
+        if data is None:
+            return -1
+        patched, changes = patch_xml(data, edits, filename)
+        if patched is None:
+            return -1
+        for (key, old, new) in changes:
+            print('%s : %s %s -> %s' % (filename, key, old, new))
+        if patched == data:
+            print('%s : unchanged' % filename)
+            return 0
+        if backup:
+            # the first backup is the true original, later ones are dated
+            name = filename[filename.rfind('/') + 1:]
+            backup_file = name + '.bak'
+            k = 0
+            while os.path.exists(backup_file):
+                k += 1
+                backup_file = '%s.%s%s.bak' % (name, strftime('%Y%m%d-%H%M%S'), '' if k == 1 else '-%d' % k)
+            with open(backup_file, 'xb') as f:
+                f.write(data)
+            print('%s : original saved as %s' % (filename, backup_file))
+        # the new file is written and checked next to the original and only
+        # then swapped in, so a failed write or a dropped connection never
+        # leaves a half written config behind
+        tmp = filename + '.tmp'
+        old = filename + '.old'
+        if not self.write_checked(tmp, patched):
+            self.FSA_Remove(self.fsa_handle, tmp)
+            self.cache.invalidate(tmp)
+            return -1
+        ret = self.FSA_Rename(self.fsa_handle, filename, old)
         if ret != 0x0:
-            print('stat error : could not open ' + filename)
-            return
-        (ret, stats) = self.FSA_GetStatFile(self.fsa_handle, file_handle)
+            print('patch error : could not move %s out of the way (%s)' % (filename, hex(ret)))
+            self.FSA_Remove(self.fsa_handle, tmp)
+            self.cache.invalidate(tmp)
+            return -1
+        ret = self.FSA_Rename(self.fsa_handle, tmp, filename)
+        for path in (filename, tmp, old):
+            self.cache.invalidate(path)
+        check = self.dl_buf(filename, False) if ret == 0x0 else None
+        if check is None or hashlib.sha256(check).digest() != hashlib.sha256(patched).digest():
+            print('patch error : %s could not be replaced (%s), restoring the original' % (filename, hex(ret)))
+            self.FSA_Remove(self.fsa_handle, filename)
+            ret = self.FSA_Rename(self.fsa_handle, old, filename)
+            self.FSA_Remove(self.fsa_handle, tmp)
+            for path in (filename, tmp, old):
+                self.cache.invalidate(path)
+            if ret != 0x0:
+                print('patch error : restoring %s failed (%s), the original is still at %s' % (filename, hex(ret), old))
+            return -1
+        self.FSA_Remove(self.fsa_handle, old)
+        self.cache.invalidate(old)
+        return len(changes)
+
+    # writes a whole file and reads it back to check it
+    def write_checked(self, filename, data):
+        ret, file_handle = self.FSA_OpenFile(self.fsa_handle, filename, 'w')
+        self.cache.invalidate(filename)
         if ret != 0x0:
-            print('stat error : ' + hex(ret))
-        else:
-            print('flags: ' + hex(stats[1]))
-            print('mode: ' + hex(stats[2]))
-            print('owner: ' + hex(stats[3]))
-            print('group: ' + hex(stats[4]))
-            print('size: ' + hex(stats[5]))
-        ret = self.FSA_CloseFile(self.fsa_handle, file_handle)
+            print('patch error : could not open ' + filename)
+            return False
+        written = self.write_file_blocks(file_handle, data, False)
+        self.FSA_CloseFile(self.fsa_handle, file_handle)
+        check = self.dl_buf(filename, False) if written == len(data) else None
+        if check is None or hashlib.sha256(check).digest() != hashlib.sha256(data).digest():
+            print('patch error : %s does not read back as written' % filename)
+            return False
+        return True
+
+    # {filename: edits} applied in one go, stops at the first file that fails
+    def patch_configs(self, patches, backup=True):
+        total = 0
+        for (filename, edits) in patches.items():
+            ret = self.patch_config(filename, edits, backup)
+            if ret < 0:
+                return -1
+            total += ret
+        return total
+
+    def stat(self, filename):
+        if filename[0] != '/':
+            filename = self.cwd + '/' + filename
+        stats = self.cache.get('stat', filename)
+        if stats is None:
+            ret, file_handle = self.FSA_OpenFile(self.fsa_handle, filename, 'r')
+            if ret != 0x0:
+                print('stat error : could not open ' + filename)
+                return
+            (ret, stats) = self.FSA_GetStatFile(self.fsa_handle, file_handle)
+            self.FSA_CloseFile(self.fsa_handle, file_handle)
+            if ret != 0x0:
+                print('stat error : ' + hex(ret))
+                return
+            self.cache.put('stat', filename, stats)
+        print('flags: ' + hex(stats[1]))
+        print('mode: ' + hex(stats[2]))
+        print('owner: ' + hex(stats[3]))
+        print('group: ' + hex(stats[4]))
+        print('size: ' + hex(stats[5]))
 
     def askyesno(self):
         yes = set(['yes', 'ye', 'y'])
@@ -714,28 +2173,29 @@ class wupclient:
     def rm(self, filename):
         if filename[0] != '/':
             filename = self.cwd + '/' + filename
-        ret, file_handle = self.FSA_OpenFile(self.fsa_handle, filename, 'r')
-        if ret != 0x0:
-            print('rm error : could not open ' + filename + ' (' + hex(ret) + ')')
-            return
-        self.FSA_CloseFile(self.fsa_handle, file_handle)
+        stats = self.cache.get('stat', filename)
+        if stats is None or not stats.is_file:
+            ret, file_handle = self.FSA_OpenFile(self.fsa_handle, filename, 'r')
+            if ret != 0x0:
+                print('rm error : could not open ' + filename + ' (' + hex(ret) + ')')
+                return
+            self.FSA_CloseFile(self.fsa_handle, file_handle)
         #print('WARNING: REMOVING A FILE CAN BRICK YOUR CONSOLE, ARE YOU SURE (Y/N)?')
         #if self.askyesno() == True:
         ret = self.FSA_Remove(self.fsa_handle, filename)
+        self.cache.invalidate(filename)
         print('rm : ' + hex(ret))
 
     # Credits to Nightkingale at https://nightkingale.com/posts/the-downgrade-of-doom
     def rmdir(self, path):
-        fsa_handle = w.fsa_handle
+        fsa_handle = self.fsa_handle
         if path[0] != '/':
             path = self.cwd + '/' + path
-        ret, dir_handle = self.FSA_OpenDir(fsa_handle, path)
+        ret, entries = self.listdir(path)
         if ret != 0x0:
             print('rmdir error : could not open ' + path + ' (' + hex(ret) + ')')
             return
-        self.FSA_CloseDir(fsa_handle, dir_handle)
-        if len(self.ls(path, True)) != 0:
-            entries = self.ls(path, True)
+        if len(entries) != 0:
             for e in entries:
                 if e['is_file']:
                     print('deleting: ' + e['name'])
@@ -744,6 +2204,7 @@ class wupclient:
                     print('deleting: ' + e['name'] + '/')
                     self.rmdir(path + '/' + e['name'])
         ret = self.FSA_Remove(fsa_handle, path)
+        self.cache.invalidate(path)
         print('rmdir : ' + hex(ret))
 
     def mv(self, srcpath, dstpath):
@@ -754,6 +2215,8 @@ class wupclient:
         print('WARNING: MOVING A FILE OR FOLDER CAN BRICK YOUR CONSOLE, ARE YOU SURE (Y/N)?')
         if self.askyesno() == True:
             ret = self.FSA_Rename(self.fsa_handle, srcpath, dstpath)
+            self.cache.invalidate(srcpath)
+            self.cache.invalidate(dstpath)
             if ret == 0x0:
                 print('moved ' + srcpath + ' to ' + dstpath)
             else:
@@ -769,185 +2232,1112 @@ class wupclient:
                 filename = local_filename
         if filename[0] != '/':
             filename = self.cwd + '/' + filename
-        f = open(local_filename, 'rb')
-        ret, file_handle = self.FSA_OpenFile(self.fsa_handle, filename, 'w')
+        with open(local_filename, 'rb') as f:
+            ret, file_handle = self.FSA_OpenFile(self.fsa_handle, filename, 'w')
+            self.cache.invalidate(filename)
+            if ret != 0x0:
+                print('up error : could not open ' + filename)
+                return
+            self.write_file_blocks(file_handle, f)
+        ret = self.FSA_CloseFile(self.fsa_handle, file_handle)
+
+# errors that mean the connection itself is gone, anything else is the
+# job's own problem
+def connection_lost(e):
+    if isinstance(e, (ConnectionError, socket.timeout)):
+        return True
+    return isinstance(e, OSError) and e.errno in (errno.ENETDOWN, errno.ENETUNREACH, errno.EHOSTDOWN, errno.EHOSTUNREACH)
+
+# lists the (name, error) pairs a wuptransfer run gave back
+def report_failures(op, errors):
+    if len(errors) == 0:
+        return
+    print('%s error : %d file(s) failed' % (op, len(errors)))
+    for (name, e) in errors:
+        print('    %s (%s)' % (name, hex(e) if isinstance(e, int) else e))
+
+# runs file transfers over several connections at once. every worker has
+# its own wupclient (and with it its own /dev/fsa handle) and its own job
+# deque; workers that run dry steal from the back of the longest deque.
+# servers that only take one client at a time get everything pipelined
+# over the original connection
+class wuptransfer:
+    def __init__(self, client, connections=4):
+        self.client = client
+        self.connections = connections
+
+    def open_workers(self):
+        workers = [self.client]
+        if self.connections > 1 and self.client.parallel is not False:
+            for _ in range(self.connections - 1):
+                c = self.client.connect_again()
+                if c is None:
+                    break
+                workers.append(c)
+            self.client.parallel = len(workers) > 1
+        return workers
+
+    # jobs are (size, name, fn) tuples, fn(client) runs the transfer on
+    # whichever connection picked the job up
+    def run(self, jobs):
+        workers = self.open_workers()
+        queues = [deque() for _ in workers]
+        for i, job in enumerate(sorted(jobs, key=lambda j: -j[0])):
+            queues[i % len(workers)].append(job)
+        lock = threading.Lock()
+        totals = [0, 0]
+        errors = []
+        alive = [len(workers)]
+
+        def take(i):
+            with lock:
+                if len(queues[i]) > 0:
+                    return queues[i].popleft()
+                victim = max(queues, key=len)
+                if len(victim) > 0:
+                    return victim.pop()
+                return None
+
+        # requests from the worker connections count towards whatever
+        # started the transfer
+        stats = self.client.instrumentation
+        op = stats.context()[0] if stats is not None else None
+
+        def work(i):
+            if stats is not None and i > 0:
+                stats.local.op = op
+            while True:
+                job = take(i)
+                if job is None:
+                    return
+                size, name, fn = job
+                try:
+                    ret = fn(workers[i])
+                except Exception as e:
+                    if not connection_lost(e):
+                        with lock:
+                            errors.append((name, e))
+                            print('transfer error : %s (%s)' % (name, e))
+                        continue
+                    # this connection is gone: its job goes back for the
+                    # others, the last one standing fails everything left.
+                    # the client starts over on its next request (that
+                    # matters for the one the transfer was started on)
+                    workers[i].drop()
+                    with lock:
+                        alive[0] -= 1
+                        if alive[0] > 0:
+                            queues[i].append(job)
+                            print('transfer : connection %d lost (%s), %s goes to another one' % (i, e, name))
+                        else:
+                            for (_, left, _) in [job] + [j for q in queues for j in q]:
+                                errors.append((left, e))
+                                print('transfer error : %s (%s)' % (left, e))
+                            for q in queues:
+                                q.clear()
+                    return
+                with lock:
+                    if isinstance(ret, int) and ret < 0:
+                        errors.append((name, ret))
+                        print('transfer error : %s (%d)' % (name, ret))
+                        continue
+                    totals[0] += 1
+                    totals[1] += size
+                    print(name)
+
+        start = monotonic()
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(1, len(workers))]
+        for t in threads:
+            t.start()
+        work(0)
+        for t in threads:
+            t.join()
+        for c in workers[1:]:
+            self.client.requests += c.requests
+            self.client.round_trips += c.round_trips
+            try:
+                c.disconnect()
+            except OSError:
+                pass
+        elapsed = max(monotonic() - start, 1e-6)
+        print('%d files, %d bytes in %.2fs (%.1f KiB/s) over %d connection(s)%s' % (totals[0], totals[1], elapsed, totals[1] / 1024.0 / elapsed, len(workers),
+            ', %d failed' % len(errors) if len(errors) > 0 else ''))
+        return errors
+
+# incremental backups of remote trees into a local directory:
+#   objects/<sha256[:2]>/<sha256>  file contents, each stored once
+#   index.json                     remote path -> size, flags, mode,
+#                                  modified, sha256 as of the last backup
+#   snapshots/<time>.json          the state of one backed up tree
+# files whose listing still matches the index are not downloaded again
+class wupbackup:
+    def __init__(self, client, directory='backup'):
+        self.client = client
+        self.directory = directory
+        self.lock = threading.Lock()
+
+    def path(self, *parts):
+        return os.path.join(self.directory, *parts)
+
+    def object_path(self, digest):
+        return self.path('objects', digest[:2], digest)
+
+    def load_index(self):
+        try:
+            with open(self.path('index.json'), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def save_json(self, filename, data):
+        tmp = filename + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+        os.replace(tmp, filename)
+
+    @staticmethod
+    def record(stats):
+        return {'size': stats.size, 'flags': stats.flags, 'mode': stats.mode, 'modified': stats.modified}
+
+    # streams one remote file into the object store, returns its sha256
+    def fetch(self, c, path, size):
+        ret, file_handle = c.FSA_OpenFile(c.fsa_handle, path, 'r')
         if ret != 0x0:
-            print('up error : could not open ' + filename)
-            return
-        progress = 0
-        block_size = 0x400
+            print('backup error : could not open ' + path)
+            return None
+        h = hashlib.sha256()
+        tmp = self.path('objects', 'tmp-%d-%d' % (os.getpid(), threading.get_ident()))
+        # whatever happens, tmp is either in the store or gone afterwards
+        try:
+            with open(tmp, 'wb') as f:
+                def sink(block):
+                    f.write(block)
+                    h.update(block)
+                got = c.read_file_blocks(file_handle, sink, size, False)
+            c.FSA_CloseFile(c.fsa_handle, file_handle)
+            if got != size:
+                print('backup error : %s is %d bytes, got %d' % (path, size, got))
+                return None
+            digest = h.hexdigest()
+            target = self.object_path(digest)
+            with self.lock:
+                if not os.path.exists(target):
+                    mkdir_p(os.path.dirname(target))
+                    os.replace(tmp, target)
+            return digest
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def run(self, path, connections=4):
+        start = monotonic()
+        mkdir_p(self.path('objects'))
+        mkdir_p(self.path('snapshots'))
+        index = self.load_index()
+        dirs, files = self.client.walk(path, True)
+        snapshot = {}
+        jobs = []
+        fetched = {}
+
+        # a failed fetch has to fail its job, or the transfer counts it
+        def fetch(c, f, size):
+            fetched[f] = self.fetch(c, f, size)
+            return -1 if fetched[f] is None else 0
+
+        for (f, stats) in files:
+            r = self.record(stats)
+            old = index.get(f)
+            if old is not None and all(old.get(k) == v for (k, v) in r.items()) and os.path.exists(self.object_path(old['sha256'])):
+                r['sha256'] = old['sha256']
+            else:
+                jobs.append((stats.size, f, lambda c, f=f, size=stats.size: fetch(c, f, size)))
+            snapshot[f] = r
+        if len(jobs) > 0:
+            wuptransfer(self.client, connections).run(jobs)
+        failed = []
+        for f in list(snapshot):
+            if 'sha256' in snapshot[f]:
+                continue
+            digest = fetched.get(f)
+            if digest is None:
+                failed.append(f)
+                del snapshot[f]
+            else:
+                snapshot[f]['sha256'] = digest
+        prefix = path.rstrip('/') + '/'
+        for f in [f for f in index if f.startswith(prefix) and f not in snapshot]:
+            del index[f]
+        index.update(snapshot)
+        self.save_json(self.path('index.json'), index)
+        name = strftime('%Y%m%d-%H%M%S')
+        k = 1
+        while os.path.exists(self.path('snapshots', name + '.json')):
+            name = strftime('%Y%m%d-%H%M%S') + '-%d' % k
+            k += 1
+        self.save_json(self.path('snapshots', name + '.json'), {'root': path, 'dirs': dirs, 'files': snapshot, 'failed': failed})
+        fetched_bytes = sum(size for (size, f, _) in jobs if fetched.get(f) is not None)
+        print('backup : %d files, %d fetched (%d bytes), %d unchanged, %d failed in %.2fs, snapshot %s' % (
+            len(files), len(jobs) - len(failed), fetched_bytes, len(files) - len(jobs), len(failed), monotonic() - start, name))
+        return name
+
+    # rebuilds the tree of a snapshot under a local directory
+    def checkout(self, name, destination):
+        with open(self.path('snapshots', name + '.json'), 'r') as f:
+            snapshot = json.load(f)
+        for d in snapshot['dirs']:
+            mkdir_p(os.path.join(destination, d.lstrip('/')))
+        for (f, r) in snapshot['files'].items():
+            target = os.path.join(destination, f.lstrip('/'))
+            mkdir_p(os.path.dirname(target))
+            shutil.copyfile(self.object_path(r['sha256']), target)
+        return len(snapshot['files'])
+
+# records the sha256 of every chunk that made it across intact, so a
+# transfer interrupted by a dropped connection or a crash continues from
+# the last verified chunk. it only applies while the source is unchanged
+class wupjournal:
+    def __init__(self, filename, key):
+        self.filename = filename
+        self.key = key
+        self.chunks = []
+        try:
+            with open(filename, 'r') as f:
+                data = json.load(f)
+            if data.get('key') == key:
+                self.chunks = data['chunks']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def add(self, digest):
+        self.chunks.append(digest)
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'key': self.key, 'chunks': self.chunks}, f)
+        os.replace(tmp, self.filename)
+
+    def truncate(self, n):
+        del self.chunks[n:]
+
+    def finish(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+# dl/up/cp in fixed size chunks. every chunk is hashed on the way in and,
+# with verify, read back from its destination (the remote file through
+# FSA_ReadFilePtr and a memory read, the local file from disk) and compared
+# before it is recorded in the journal. lost connections are reopened up to
+# retries times and the transfer continues at the first unverified chunk
+class wupresume:
+    def __init__(self, client, chunk_size=0x100000, verify=True, retries=5):
+        self.client = client
+        self.chunk_size = chunk_size
+        self.verify = verify
+        self.retries = retries
+        # chunks are read back through the same handle
+        self.write_mode = 'w+' if verify else 'w'
+
+    def remote_stat(self, path):
+        c = self.client
+        ret, file_handle = c.FSA_OpenFile(c.fsa_handle, path, 'r')
+        if ret != 0x0:
+            return None
+        ret, stats = c.FSA_GetStatFile(c.fsa_handle, file_handle)
+        c.FSA_CloseFile(c.fsa_handle, file_handle)
+        return stats if ret == 0x0 else None
+
+    def open_remote(self, path, mode, offset):
+        c = self.client
+        ret, file_handle = c.FSA_OpenFile(c.fsa_handle, path, mode)
+        if ret != 0x0:
+            raise IOError('could not open %s (%s)' % (path, hex(ret)))
+        if offset != 0:
+            c.FSA_SetPosFile(c.fsa_handle, file_handle, offset)
+        return file_handle
+
+    def read_remote(self, file_handle, n):
+        data = bytearray()
+        if self.client.read_file_blocks(file_handle, data.extend, n, False) != n:
+            raise IOError('short read')
+        return data
+
+    def write_remote(self, file_handle, offset, data):
+        c = self.client
+        if c.write_file_blocks(file_handle, data, False) != len(data):
+            raise IOError('short write')
+        if self.verify:
+            c.FSA_SetPosFile(c.fsa_handle, file_handle, offset)
+            if hashlib.sha256(self.read_remote(file_handle, len(data))).digest() != hashlib.sha256(data).digest():
+                return False
+        return True
+
+    # open(offset) -> state, chunk(state, offset, n) -> sha256 or None when
+    # the chunk didn't verify, close(state)
+    def run(self, name, journal, size, open, chunk, close):
+        c = self.client
+        start = monotonic()
+        resumed = len(journal.chunks)
+        attempts = 0
+        state = None
+        offset = len(journal.chunks) * self.chunk_size
         while True:
-            data = f.read(block_size)
-            ret = self.FSA_WriteFile(self.fsa_handle, file_handle, data)
-            progress += len(data)
-            sys.stdout.write(hex(progress) + '\r'); sys.stdout.flush();
-            if len(data) < block_size:
+            try:
+                if state is None:
+                    if c.s is None:
+                        c.reconnect()
+                    state = open(offset)
+                if offset >= size:
+                    break
+                n = min(self.chunk_size, size - offset)
+                digest = chunk(state, offset, n)
+                if digest is not None:
+                    journal.add(digest)
+                    offset += n
+                    sys.stdout.write(hex(offset) + '\r'); sys.stdout.flush();
+                    continue
+                error = 'chunk at %X failed verification' % offset
+                lost = False
+            except OSError as e:
+                error = str(e) or type(e).__name__
+                lost = True
+            attempts += 1
+            print('%s : %s (attempt %d/%d)' % (name, error, attempts, self.retries))
+            if state is not None:
+                try:
+                    close(state)
+                except OSError:
+                    lost = True
+                state = None
+            if attempts > self.retries:
+                print('%s error : giving up at %X, run it again to resume' % (name, offset))
+                return -1
+            if lost and c.s is not None:
+                # start over on a fresh connection
+                try:
+                    c.s.close()
+                except OSError:
+                    pass
+                c.s = None
+                sleep(min(attempts, 5) * 0.5)
+        close(state)
+        journal.finish()
+        print('%s : %d bytes in %.2fs (%d chunks resumed)' % (name, size, monotonic() - start, resumed))
+        return 0
+
+    def dl(self, filename, local_filename):
+        c = self.client
+        stats = self.remote_stat(filename)
+        if stats is None:
+            print('dl error : could not open ' + filename)
+            return -1
+        size = stats.size
+        journal = wupjournal(local_filename + '.journal', ['dl', filename, size, stats.modified, self.chunk_size])
+        # whatever is already on disk has to match the journal
+        done = 0
+        if os.path.exists(local_filename):
+            with open(local_filename, 'rb') as f:
+                for digest in journal.chunks:
+                    if hashlib.sha256(f.read(self.chunk_size)).hexdigest() != digest:
+                        break
+                    done += 1
+        journal.truncate(done)
+
+        def open_state(offset):
+            f = open(local_filename, 'r+b' if os.path.exists(local_filename) else 'wb')
+            f.seek(offset)
+            f.truncate()
+            try:
+                return (self.open_remote(filename, 'r', offset), f)
+            except:
+                f.close()
+                raise
+
+        def chunk(state, offset, n):
+            file_handle, f = state
+            data = self.read_remote(file_handle, n)
+            f.write(data)
+            f.flush()
+            digest = hashlib.sha256(data).hexdigest()
+            if self.verify:
+                os.fsync(f.fileno())
+                with open(local_filename, 'rb') as check:
+                    check.seek(offset)
+                    if hashlib.sha256(check.read(n)).hexdigest() != digest:
+                        f.seek(offset)
+                        f.truncate()
+                        return None
+            return digest
+
+        def close_state(state):
+            file_handle, f = state
+            f.close()
+            c.FSA_CloseFile(c.fsa_handle, file_handle)
+
+        return self.run('dl', journal, size, open_state, chunk, close_state)
+
+    def up(self, local_filename, filename):
+        c = self.client
+        st = os.stat(local_filename)
+        journal = wupjournal(local_filename + '.up.journal', ['up', filename, st.st_size, st.st_mtime_ns, self.chunk_size])
+
+        def open_state(offset):
+            f = open(local_filename, 'rb')
+            f.seek(offset)
+            try:
+                # an existing partial upload must not be truncated
+                return (self.open_remote(filename, 'r+' if offset > 0 else self.write_mode, offset), f)
+            except:
+                f.close()
+                raise
+
+        def chunk(state, offset, n):
+            file_handle, f = state
+            f.seek(offset)
+            data = f.read(n)
+            if not self.write_remote(file_handle, offset, data):
+                return None
+            return hashlib.sha256(data).hexdigest()
+
+        def close_state(state):
+            file_handle, f = state
+            f.close()
+            c.FSA_CloseFile(c.fsa_handle, file_handle)
+
+        ret = self.run('up', journal, st.st_size, open_state, chunk, close_state)
+        c.cache.invalidate(filename)
+        return ret
+
+    # the data goes through this machine so both sides can be hashed
+    def cp(self, filename_in, filename_out):
+        c = self.client
+        stats = self.remote_stat(filename_in)
+        if stats is None:
+            print('cp error : could not open ' + filename_in)
+            return -1
+        size = stats.size
+        key = ['cp', filename_in, filename_out, size, stats.modified, self.chunk_size]
+        journal = wupjournal('cp_%s.journal' % hashlib.sha1((filename_in + '\0' + filename_out).encode('utf-8')).hexdigest()[:16], key)
+
+        def open_state(offset):
+            in_handle = self.open_remote(filename_in, 'r', offset)
+            try:
+                return (in_handle, self.open_remote(filename_out, 'r+' if offset > 0 else self.write_mode, offset))
+            except:
+                c.FSA_CloseFile(c.fsa_handle, in_handle)
+                raise
+
+        def chunk(state, offset, n):
+            in_handle, out_handle = state
+            data = self.read_remote(in_handle, n)
+            if not self.write_remote(out_handle, offset, data):
+                return None
+            return hashlib.sha256(data).hexdigest()
+
+        def close_state(state):
+            in_handle, out_handle = state
+            c.FSA_CloseFile(c.fsa_handle, out_handle)
+            c.FSA_CloseFile(c.fsa_handle, in_handle)
+
+        ret = self.run('cp', journal, size, open_state, chunk, close_state)
+        c.cache.invalidate(filename_out)
+        return ret
+
+# replaces the text of leaf elements in an xml document, returns the new
+# document and [(element, old, new)] for the values that changed. expat
+# reports byte offsets, so everything outside the edited values is kept
+# exactly as it was
+def patch_xml(data, edits, name='xml'):
+    data = bytes(data)
+    parser = xml.parsers.expat.ParserCreate()
+    path = []
+    starts = []
+    spans = {}
+
+    def start(tag, attrs):
+        path.append(tag)
+        starts.append(parser.CurrentByteIndex)
+
+    def end(tag):
+        p = '/'.join(path)
+        path.pop()
+        s = starts.pop()
+        e = parser.CurrentByteIndex
+        for key in edits:
+            if key not in spans and (p == key or p.endswith('/' + key)):
+                # <tag/> has nothing between the tags to replace
+                begin = data.index(b'>', s) + 1
+                spans[key] = (begin, e) if begin <= e and data[e:e + 2] == b'</' else None
+
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    try:
+        parser.Parse(data, True)
+    except xml.parsers.expat.ExpatError as e:
+        print('patch error : %s is not valid xml (%s)' % (name, e))
+        return (None, [])
+    missing = [key for key in edits if spans.get(key) is None]
+    if len(missing) > 0:
+        print('patch error : %s has no value for %s' % (name, ', '.join(missing)))
+        return (None, [])
+    out = data
+    changes = []
+    for (key, (begin, end)) in sorted(spans.items(), key=lambda kv: -kv[1][0]):
+        old = data[begin:end].decode('utf-8')
+        new = str(edits[key])
+        if b'<' in data[begin:end]:
+            print('patch error : %s in %s is not a plain value' % (key, name))
+            return (None, [])
+        if old.strip() == new:
+            continue
+        out = out[:begin] + new.encode('utf-8') + out[end:]
+        changes.append((key, old.strip(), new))
+    return (out, changes[::-1])
+
+# text of the first element with each of the given tag names
+def xml_values(data, tags):
+    parser = xml.parsers.expat.ParserCreate()
+    values = {}
+    current = []
+
+    def start(tag, attrs):
+        current.append([tag, []] if tag in tags and tag not in values else None)
+
+    def text(t):
+        if len(current) > 0 and current[-1] is not None:
+            current[-1][1].append(t)
+
+    def end(tag):
+        e = current.pop()
+        if e is not None:
+            values[e[0]] = ''.join(e[1]).strip()
+
+    parser.StartElementHandler = start
+    parser.CharacterDataHandler = text
+    parser.EndElementHandler = end
+    try:
+        parser.Parse(bytes(data), True)
+    except xml.parsers.expat.ExpatError:
+        pass
+    return values
+
+# parses the tickets packed in one .tik file straight out of the buffer
+def parse_tickets(data, name):
+    view = memoryview(data)
+    p = 0
+    while True:
+        if len(view) - p < 0x1E4 or U32.unpack_from(view, p)[0] != TICKET_MAGIC:
+            print('Unhandled tik start at %i with ticket %s!' % (p, name))
+            return
+        yield {
+            'title_id': '%016x' % TICKET_TITLE_ID.unpack_from(view, p + 0x1DC)[0],
+            'key': TICKET_KEY.unpack_from(view, p + 0x1BF)[0].hex(),
+            'file': name,
+            'offset': p,
+        }
+        if len(view) - p <= 0x354:
+            return
+        kind = TICKET_HALF.unpack_from(view, p + 0x2B0)[0]
+        if kind == 0 and U32.unpack_from(view, p + 0x2B8)[0] == TICKET_MAGIC:
+            p += 0x2B8
+        elif kind == 1 and U32.unpack_from(view, p + 0x350)[0] == TICKET_MAGIC:
+            p += 0x350
+        else:
+            print('Unhandled packed tik at %i with ticket %s!' % (p, name))
+            return
+
+# scans the ticket store. tickets are fetched over several connections and
+# records are yielded as the files come in; files whose size and mtime match
+# the cache aren't fetched again. the client is busy until the scan is done.
+# the cache holds decrypted title keys: it is kept with the console's state
+# unless cache_file says otherwise, only readable by the owner, and
+# cache_file=False turns it off
+class wuptickets:
+    def __init__(self, client, cache_file=None):
+        self.client = client
+        self.cache_file = client.state_path('tickets_cache.json') if cache_file is None else cache_file
+
+    def load_cache(self):
+        if not self.cache_file:
+            return {}
+        try:
+            with open(self.cache_file, 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def save_cache(self, cache):
+        if not self.cache_file:
+            return
+        tmp = self.cache_file + '.tmp'
+        with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+            json.dump(cache, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.cache_file)
+        print('tickets : decrypted title keys saved to ' + self.cache_file)
+
+    def scan(self, path=TICKET_PATH, connections=4):
+        dirs, files = self.client.walk(path, True)
+        cache = self.load_cache()
+        scanned = {}
+        results = Queue()
+        jobs = []
+        for (f, stats) in files:
+            if not f.endswith('.tik'):
+                continue
+            old = cache.get(f)
+            if old is not None and old['size'] == stats.size and old['modified'] == stats.modified:
+                scanned[f] = old
+                for r in old['records']:
+                    yield r
+            else:
+                jobs.append((stats.size, f, lambda c, f=f, stats=stats: results.put((f, stats, c.dl_buf(f, False)))))
+        if len(jobs) == 0:
+            self.save_cache(scanned)
+            return
+
+        def fetch():
+            try:
+                wuptransfer(self.client, connections).run(jobs)
+            finally:
+                results.put(None)
+
+        t = threading.Thread(target=fetch)
+        t.start()
+        try:
+            while True:
+                item = results.get()
+                if item is None:
+                    break
+                f, stats, data = item
+                if data is None:
+                    continue
+                records = list(parse_tickets(data, f[f.rfind('apps/') + 5:]))
+                scanned[f] = {'size': stats.size, 'modified': stats.modified, 'records': records}
+                for r in records:
+                    yield r
+        finally:
+            t.join()
+            self.save_cache(scanned)
+
+    # .csv or .json by extension
+    @staticmethod
+    def export(records, filename):
+        records = list(records)
+        with open(filename, 'w', newline='') as f:
+            if filename.lower().endswith('.csv'):
+                out = csv.DictWriter(f, fieldnames=['title_id', 'key', 'file', 'offset'])
+                out.writeheader()
+                out.writerows(records)
+            else:
+                json.dump(records, f, indent=1)
+        return len(records)
+
+# catalog of the titles installed on the console, keyed by title id. every
+# title has one record per place it is installed with its size, file count
+# and what meta/meta.xml says about it. the catalog is kept on disk, so
+# questions about it don't need the console at all:
+#   t = wuptitles(None); t.installed('JPN'); t.duplicates()
+class wuptitles:
+    META_TAGS = ('title_version', 'product_code', 'shortname_en')
+
+    def __init__(self, client, catalog_file='titles.json'):
+        self.client = client
+        self.catalog_file = catalog_file
+        self.titles = {}
+        self.by_region = {}
+        if catalog_file is not None and os.path.exists(catalog_file):
+            with open(catalog_file, 'r') as f:
+                self.titles = json.load(f)['titles']
+        self.index()
+
+    def index(self):
+        self.by_region = dict((region, set()) for region in TITLES.regions)
+        for t in self.titles:
+            region = TITLES.region(t)
+            if region is not None:
+                self.by_region[region].add(t)
+
+    def save(self):
+        if self.catalog_file is None:
+            return
+        tmp = self.catalog_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'time': strftime('%Y-%m-%dT%H:%M:%S'), 'titles': self.titles}, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.catalog_file)
+
+    # (title id, device, path) for every <root>/<high>/<low> directory, other
+    # directories under a title root are skipped
+    def find(self, devices):
+        c = self.client
+        found = []
+        for device in devices:
+            for root in TITLE_ROOTS[device]:
+                ret, highs = c.listdir(root)
+                if ret != 0x0:
+                    continue
+                for high in highs:
+                    if high['is_file'] or not TITLE_ID_WORD.match(high['name']):
+                        continue
+                    ret, lows = c.listdir(root + '/' + high['name'])
+                    if ret != 0x0:
+                        continue
+                    for low in lows:
+                        if not low['is_file'] and TITLE_ID_WORD.match(low['name']):
+                            path = root + '/' + high['name'] + '/' + low['name']
+                            found.append(((high['name'] + '-' + low['name']).lower(), device, path))
+        return found
+
+    def describe(self, c, device, path):
+        dirs, files = c.walk(path)
+        record = {'device': device, 'path': path, 'files': len(files), 'size': sum(size for (f, size) in files)}
+        if path + '/meta/meta.xml' in dict(files):
+            meta = c.dl_buf(path + '/meta/meta.xml', False)
+            if meta is not None:
+                record.update(xml_values(meta, self.META_TAGS))
+        return record
+
+    # rescans the given devices (all by default), records for other devices
+    # are kept
+    def scan(self, devices=None, connections=4):
+        start = monotonic()
+        devices = list(TITLE_ROOTS) if devices is None else devices
+        found = self.find(devices)
+        records = {}
+        lock = threading.Lock()
+
+        def describe(c, title_id, device, path):
+            record = self.describe(c, device, path)
+            with lock:
+                records.setdefault(title_id, []).append(record)
+
+        jobs = [(0, path, lambda c, t=t, d=d, path=path: describe(c, t, d, path)) for (t, d, path) in found]
+        wuptransfer(self.client, connections).run(jobs)
+        for title_id in list(self.titles):
+            kept = [r for r in self.titles[title_id] if r['device'] not in devices]
+            if len(kept) > 0:
+                self.titles[title_id] = kept
+            else:
+                del self.titles[title_id]
+        for (title_id, found_records) in records.items():
+            self.titles.setdefault(title_id, []).extend(sorted(found_records, key=lambda r: r['path']))
+        self.index()
+        self.save()
+        print('titles : %d titles in %d places in %.2fs' % (len(self.titles), len(found), monotonic() - start))
+        return self.titles
+
+    def region(self, title_id):
+        return TITLES.region(title_id)
+
+    # system titles of a region that are still installed
+    def installed(self, region):
+        return sorted(self.by_region.get(region, ()))
+
+    def missing(self, region):
+        return [t for t in TITLES.names(region) if t not in self.titles]
+
+    # system titles that are installed for more than one region, as
+    # {function: {region: title id}}
+    def duplicates(self):
+        functions = {}
+        for (region, titles) in self.by_region.items():
+            for t in titles:
+                functions.setdefault(TITLES.slot_name(t), {})[region] = t
+        return dict((f, r) for (f, r) in functions.items() if len(r) > 1)
+
+    # titles installed in more than one place, e.g. on both mlc and usb
+    def copies(self):
+        return dict((t, r) for (t, r) in self.titles.items() if len(r) > 1)
+
+    def size(self, title_id):
+        return sum(r['size'] for r in self.titles.get(title_id, ()))
+
+def print_titles(catalog):
+    for title_id in sorted(catalog.titles):
+        region = catalog.region(title_id) or ''
+        for r in catalog.titles[title_id]:
+            print('%s %-3s %-3s %10d %5d %s %s' % (title_id, region, r['device'], r['size'], r['files'], r.get('title_version', ''), r.get('shortname_en', '')))
+    for region in sorted(catalog.by_region):
+        print('%s : %d of %d system titles installed' % (region, len(catalog.by_region[region]), len(TITLES.titles(region))))
+
+# runs installs, copies and deletes back to back on one /dev/mcp handle.
+# MCP_Install only returns once the title is in, so install progress is
+# polled over a second connection, more often while it moves and less
+# often while it doesn't. servers that take one client at a time run the
+# same queue without live progress
+class wupmcpqueue:
+    def __init__(self, client, poll_min=0.1, poll_max=2.0):
+        self.client = client
+        self.poll_min = poll_min
+        self.poll_max = poll_max
+        self.ops = []
+
+    def install(self, path, installToUsb=0):
+        if path[0] != '/':
+            path = '/vol/storage_sdcard/' + path
+        self.ops.append(('install', path, installToUsb))
+        return self
+
+    def copy(self, path, installToUsb=1, flush=0):
+        self.ops.append(('copy', path, (installToUsb, flush)))
+        return self
+
+    def delete(self, path, flush=0):
+        self.ops.append(('delete', path, flush))
+        return self
+
+    # FSA_OpenDir's ret for the source folder, 0 if it is there
+    def check_source(self, path):
+        c = self.client
+        if c.cache.get('dir', path) is not None:
+            return 0
+        ret, dir_handle = c.FSA_OpenDir(c.fsa_handle, path)
+        if ret == 0:
+            c.FSA_CloseDir(c.fsa_handle, dir_handle)
+            c.cache.put('dir', path, True)
+        return ret
+
+    def run_install(self, mcp_handle, path, installToUsb):
+        c = self.client
+        ret, data = c.MCP_InstallGetInfo(mcp_handle, path)
+        if ret != 0:
+            print('install info : ' + hex(ret))
+            return ret
+        ret = c.MCP_InstallSetTargetDevice(mcp_handle, installToUsb)
+        if ret != 0:
+            print('install set target device : ' + hex(ret))
+            return ret
+        ret = c.MCP_InstallSetTargetUsb(mcp_handle, installToUsb)
+        if ret != 0:
+            print('install set target usb : ' + hex(ret))
+            return ret
+        return c.MCP_Install(mcp_handle, path)
+
+    # polls until done is set. MCP_INSTALL_PROGRESS is in progress, title id,
+    # total size, size done, contents total and contents done. the total
+    # size of the install goes to seen['bytes']
+    def poll(self, poller, done, seen):
+        mcp_handle = poller.mcp_handle
+        interval = self.poll_min
+        last = None
+        while not done.wait(interval):
+            ret, p = poller.MCP_InstallGetProgress(mcp_handle)
+            if ret != 0:
                 break
-        ret = self.FSA_CloseFile(self.fsa_handle, file_handle)
+            total = (p[3] << 32) | p[4]
+            k = (p[5] << 32) | p[6]
+            if p[0] != 0 and total > 0:
+                seen['bytes'] = total
+                sys.stdout.write('%08x%08x %s (%f) %d/%d ' % (p[1], p[2], hex(k), float(k * 100) / total, p[8], p[7]) + '\r'); sys.stdout.flush();
+            if k == last:
+                interval = min(interval * 2, self.poll_max)
+            else:
+                interval = max(interval / 2, self.poll_min)
+            last = k
+
+    def run(self):
+        c = self.client
+        ops = self.ops
+        self.ops = []
+        # a missing source fails its op without going to mcp. this also
+        # gets our own session going before the poller's, which matters on
+        # servers that take one client at a time
+        missing = {}
+        for (op, path, _) in ops:
+            if op != 'delete' and path not in missing:
+                missing[path] = self.check_source(path)
+        mcp_handle = c.mcp_handle
+        poller = None
+        if any(op == 'install' and missing[path] == 0 for (op, path, _) in ops) and c.parallel is not False:
+            poller = c.connect_again()
+        results = []
+        start = monotonic()
+        for (op, path, args) in ops:
+            seen = {'bytes': 0}
+            t = monotonic()
+            if missing.get(path, 0) != 0:
+                ret = missing[path]
+                print('%s error : could not open %s' % (op, path))
+            elif op == 'install':
+                done = threading.Event()
+                thread = None
+                if poller is not None:
+                    thread = threading.Thread(target=self.poll, args=(poller, done, seen))
+                    thread.start()
+                try:
+                    ret = self.run_install(mcp_handle, path, args)
+                finally:
+                    done.set()
+                    if thread is not None:
+                        thread.join()
+            elif op == 'copy':
+                ret = c.MCP_CopyTitle(mcp_handle, path, args[0], args[1])
+            else:
+                ret = c.MCP_DeleteTitle(mcp_handle, path, args)
+            seconds = monotonic() - t
+            size = seen['bytes']
+            results.append({'op': op, 'path': path, 'ret': ret, 'seconds': seconds, 'bytes': size})
+            print('%-7s %s : %s in %.2fs%s' % (op, path, hex(ret), seconds,
+                ' (%.1f KiB/s)' % (size / 1024.0 / max(seconds, 1e-6)) if size > 0 and ret == 0 else ''))
+        if poller is not None:
+            c.requests += poller.requests
+            c.round_trips += poller.round_trips
+            poller.disconnect()
+        elapsed = max(monotonic() - start, 1e-6)
+        ok = [r for r in results if r['ret'] == 0]
+        nbytes = sum(r['bytes'] for r in ok)
+        print('%d of %d title operations ok, %d bytes in %.2fs (%.1f KiB/s)' % (len(ok), len(results), nbytes, elapsed, nbytes / 1024.0 / elapsed))
+        return results
+
+TITLE_PATH = re.compile(r'^/vol/storage_(mlc01|usb01)(/(?:usr|sys)/title/[0-9a-fA-F]{8}/[0-9a-fA-F]{8})/?$')
+
+# MCP_CopyTitle target device when srcpath is a title directory and dstpath
+# is the same title on the other one of mlc/usb, None otherwise
+def title_copy_device(srcpath, dstpath):
+    src = TITLE_PATH.match(srcpath)
+    dst = TITLE_PATH.match(dstpath)
+    if src is None or dst is None or src.group(1) == dst.group(1) or src.group(2) != dst.group(2):
+        return None
+    return 1 if dst.group(1) == 'usb01' else 0
 
 def mkdir_p(path):
     try:
         os.makedirs(path)
     except OSError as exc:
         if exc.errno == errno.EEXIST and os.path.isdir(path):
-            pass
+            return
         raise exc
 
-def mount_sd():
-    ret = w.FSA_Mount(w.fsa_handle, '/dev/sdcard01', '/vol/storage_sdcard', 2)
-    print(hex(ret))
+def mount_sd(lazy=False):
+    ret = w.mount('/dev/sdcard01', '/vol/storage_sdcard', 2, lazy)
+    if ret is not None:
+        print(hex(ret))
+    return ret
 
 def format_sd():
     ret = w.FSA_Format(w.fsa_handle, '/dev/sdcard01', 'fat', 0)
     print(hex(ret))
+    return ret
 
 def unmount_mlc():
-    ret = w.FSA_Unmount(w.fsa_handle, '/vol/storage_mlc01', 2)
+    ret = w.unmount('/vol/storage_mlc01', 2)
     print(hex(ret))
+    return ret
 
-def mount_mlc():
-    ret = w.FSA_Mount(w.fsa_handle, '/dev/mlc01', '/vol/storage_mlc01', 2)
-    print(hex(ret))
+def mount_mlc(lazy=False):
+    ret = w.mount('/dev/mlc01', '/vol/storage_mlc01', 2, lazy)
+    if ret is not None:
+        print(hex(ret))
+    return ret
 
 def format_mlc():
     ret = w.FSA_Format(w.fsa_handle, '/dev/mlc01', 'wfs', 0)
     print(hex(ret))
+    return ret
 
 def unmount_sd():
-    ret = w.FSA_Unmount(w.fsa_handle, '/vol/storage_sdcard', 2)
+    ret = w.unmount('/vol/storage_sdcard', 2)
     print(hex(ret))
+    return ret
 
-def mount_slccmpt01():
-    ret = w.FSA_Mount(w.fsa_handle, '/dev/slccmpt01', '/vol/storage_slccmpt01', 2)
-    print(hex(ret))
+def mount_slccmpt01(lazy=False):
+    ret = w.mount('/dev/slccmpt01', '/vol/storage_slccmpt01', 2, lazy)
+    if ret is not None:
+        print(hex(ret))
+    return ret
 
 def unmount_slccmpt01():
-    ret = w.FSA_Unmount(w.fsa_handle, '/vol/storage_slccmpt01', 2)
+    ret = w.unmount('/vol/storage_slccmpt01', 2)
     print(hex(ret))
+    return ret
 
-def mount_odd_content():
-    ret = w.FSA_Mount(w.fsa_handle, '/dev/odd03', '/vol/storage_odd_content', 2)
-    print(hex(ret))
+def mount_odd_content(lazy=False):
+    ret = w.mount('/dev/odd03', '/vol/storage_odd_content', 2, lazy)
+    if ret is not None:
+        print(hex(ret))
+    return ret
 
 def unmount_odd_content():
-    ret = w.FSA_Unmount(w.fsa_handle, '/vol/storage_odd_content', 2)
+    ret = w.unmount('/vol/storage_odd_content', 2)
     print(hex(ret))
+    return ret
 
-def mount_odd_update():
-    ret = w.FSA_Mount(w.fsa_handle, '/dev/odd02', '/vol/storage_odd_update', 2)
-    print(hex(ret))
+def mount_odd_update(lazy=False):
+    ret = w.mount('/dev/odd02', '/vol/storage_odd_update', 2, lazy)
+    if ret is not None:
+        print(hex(ret))
+    return ret
 
 def unmount_odd_update():
-    ret = w.FSA_Unmount(w.fsa_handle, '/vol/storage_odd_update', 2)
+    ret = w.unmount('/vol/storage_odd_update', 2)
     print(hex(ret))
+    return ret
 
-def mount_odd_tickets():
-    ret = w.FSA_Mount(w.fsa_handle, '/dev/odd01', '/vol/storage_odd_tickets', 2)
-    print(hex(ret))
+def mount_odd_tickets(lazy=False):
+    ret = w.mount('/dev/odd01', '/vol/storage_odd_tickets', 2, lazy)
+    if ret is not None:
+        print(hex(ret))
+    return ret
 
 def unmount_odd_tickets():
-    ret = w.FSA_Unmount(w.fsa_handle, '/vol/storage_odd_tickets', 2)
+    ret = w.unmount('/vol/storage_odd_tickets', 2)
     print(hex(ret))
+    return ret
 
-def get_tik_keys():
-    base_path = '/vol/system/rights/ticket/apps'
-    entries = w.ls(base_path, True)
-    #parse subfolder contents to get tik location
-    tikFiles = []
-    for e in entries:
-        if not e['is_file']:
-            path = base_path + '/' + e['name']
-            subentries = w.ls(path, True)
-            for se in subentries:
-                if se['is_file'] and se['name'].endswith('.tik'):
-                    tikFiles.append(path + '/' + se['name'])
-    #go through all tiks
+# the region change from docs/home.md: product_area for the new region and
+# game_region 119 (all regions)
+def set_region(region, game_region=119):
+    return w.patch_config(SYS_PROD_XML, {'product_area': PRODUCT_AREAS[region], 'game_region': game_region})
+
+def disable_drc_update_check():
+    return w.patch_config(DRC_CFG_XML, {'versionCheckFlag': 0})
+
+def get_tik_keys(output=None, connections=4, cache_file=None):
     tikList = []
-    for tikF in tikFiles:
-        tikContent = w.dl_buf(tikF, False)
-        if tikContent is None:
-            continue
-        checkTik = True
-        tikP = 0
-        while checkTik == True:
-            checkTik = False
-            curTik = tikContent[tikP:]
-            if(curTik[0:4] != b'\x00\x01\x00\x04'):
-                print('Unhandled tik start at %i with ticket %s!' % (tikP, tikF))
-                break
-            titleId = codecs.encode(curTik[0x1DC:0x1E4], 'hex').decode()
-            titleKey = codecs.encode(curTik[0x1BF:0x1CF], 'hex').decode()
-            tikFprint = tikF[tikF.rfind('apps/')+5:]
-            tikList.append(titleId + ' ' + titleKey + ' (' + tikFprint + ' @ ' + hex(tikP) + ')')
-            if(len(curTik) > 0x354):
-                if(curTik[0x2B0:0x2B2] == b'\x00\x00' and curTik[0x2B8:0x2BC] == b'\x00\x01\x00\x04'):
-                    tikP += 0x2B8
-                    checkTik = True
-                elif(curTik[0x2B0:0x2B2] == b'\x00\x01' and curTik[0x350:0x354] == b'\x00\x01\x00\x04'):
-                    tikP += 0x350
-                    checkTik = True
-                else:
-                    print('Unhandled packed tik at %i with ticket %s!' % (tikP, tikF))
+    records = []
+    for r in wuptickets(w, cache_file).scan(TICKET_PATH, connections):
+        records.append(r)
+        tikList.append(r['title_id'] + ' ' + r['key'] + ' (' + r['file'] + ' @ ' + hex(r['offset']) + ')')
     #print out all sorted and unique tiks
     uniqueTiks = sorted(set(tikList))
     print('Found %i unique tickets' % len(uniqueTiks))
     for tikCnt in uniqueTiks:
         print(tikCnt)
+    if output is not None:
+        wuptickets.export(records, output)
 
 #path=root folder of installed/extracted title, only works if title is deleted
 #on the destination device beforehand; path can also be a sd card location!
 def copy_title(path, installToUsb=0, flush=0):
-    mcp_handle = w.open('/dev/mcp', 0)
-    print(hex(mcp_handle))
-
-    ret = w.MCP_CopyTitle(mcp_handle, path, installToUsb, flush)
-    print(hex(ret))
-
-    ret = w.close(mcp_handle)
-    print(hex(ret))
+    return wupmcpqueue(w).copy(path, installToUsb, flush).run()[0]['ret']
 
 #path=path to sd card folder on device root
 def install_title(path, installToUsb=0):
-    mcp_handle = w.open('/dev/mcp', 0)
-    print(hex(mcp_handle))
-
-    ret, data = w.MCP_InstallGetInfo(mcp_handle, '/vol/storage_sdcard/' + path)
-    print('install info : ' + hex(ret), [hex(v) for v in data])
-    if ret != 0:
-        ret = w.close(mcp_handle)
-        print(hex(ret))
-        return
-
-    ret = w.MCP_InstallSetTargetDevice(mcp_handle, installToUsb)
-    print('install set target device : ' + hex(ret))
-    if ret != 0:
-        ret = w.close(mcp_handle)
-        print(hex(ret))
-        return
-
-    ret = w.MCP_InstallSetTargetUsb(mcp_handle, installToUsb)
-    print('install set target usb : ' + hex(ret))
-    if ret != 0:
-        ret = w.close(mcp_handle)
-        print(hex(ret))
-        return
-
-    ret = w.MCP_Install(mcp_handle, '/vol/storage_sdcard/' + path)
-    print('install : ' + hex(ret))
-
-    ret = w.close(mcp_handle)
-    print(hex(ret))
+    return wupmcpqueue(w).install(path, installToUsb).run()[0]['ret']
+
+# installs every title folder in a directory on the sd card in one go. with
+# a region only the system titles of that region are installed, folders
+# are matched by title id ('00050010-10040100' or '0005001010040100')
+def install_titles(directory='install', installToUsb=0, region=None):
+    path = '/vol/storage_sdcard/' + directory.strip('/')
+    ret, entries = w.listdir(path)
+    if ret != 0x0:
+        print('install error : could not open ' + path)
+        return None
+    q = wupmcpqueue(w)
+    for e in sorted(entries, key=lambda e: e['name']):
+        if e['is_file']:
+            continue
+        if region is not None:
+            try:
+                tid = title_id(e['name'])
+            except ValueError:
+                continue
+            if TITLES.region(tid) != region:
+                continue
+        q.install(path + '/' + e['name'], installToUsb)
+    return q.run()
 
 #path=full path, for example '/vol/storage_mlc01/usr/title/00050000/10179C00'
 def delete_title(path, flush = 0):
-    mcp_handle = w.open('/dev/mcp', 0)
-    print(hex(mcp_handle))
-
-    ret = w.MCP_DeleteTitle(mcp_handle, path, flush)
-    print('delete title : ' + hex(ret))
-
-    ret = w.close(mcp_handle)
-    print(hex(ret))
+    return wupmcpqueue(w).delete(path, flush).run()[0]['ret']
 
 def ios_shutdown():
     w.svc_and_exit(0x72, [0])
@@ -956,16 +3346,11 @@ def ios_reset():
     w.svc_and_exit(0x72, [1])
 
 def get_nim_status():
-    nim_handle = w.open('/dev/nim', 0)
-    print(hex(nim_handle))
-
     inbuffer = buffer(0x80)
-    (ret, data) = w.ioctlv(nim_handle, 0x00, [inbuffer], [0x80])
+    (ret, data) = w.ioctlv(w.nim_handle, 0x00, [inbuffer], [0x80])
 
     print(hex(ret), ''.join('%02X' % v for v in data[0]))
-
-    ret = w.close(nim_handle)
-    print(hex(ret))
+    return ret
 
 def read_and_print(adr, size):
     data = w.read(adr, size)
@@ -973,27 +3358,101 @@ def read_and_print(adr, size):
     for i in range(0, len(data), 4):
         print(' '.join('%08X' % v for v in data[i:i+4]))
 
-def read_and_dump(adr, size):
-    f = open('dump.bin', 'wb')
-    for i in range(0, size, 1024):
-        data = w.read(adr+i, 1024)
-        f.write(data)
-    f.close()
+def read_and_dump(adr, size, filename='dump.bin'):
+    return w.dump(adr, size, filename)
+
+# walks each remote directory into (path, removal order, file count, bytes).
+# the removal order lists files, then subdirectories deepest first, then
+# the directory itself. missing directories are left out of the plan
+def plan_removal(paths):
+    plan = []
+    for path in paths:
+        ret, _ = w.listdir(path)
+        if ret != 0x0:
+            continue
+        dirs, files = w.walk(path)
+        order = [f for (f, _) in files] + dirs[::-1] + [path]
+        plan.append((path, order, len(files), sum(size for (_, size) in files)))
+    return plan
+
+def print_removal_plan(plan):
+    for (path, order, nfiles, nbytes) in plan:
+        print('%s : %d files, %d dirs, %d bytes' % (path, nfiles, len(order) - nfiles, nbytes))
+    print('total : %d titles, %d files, %d entries, %d bytes' % (len(plan), sum(p[2] for p in plan), sum(len(p[1]) for p in plan), sum(p[3] for p in plan)))
 
 def flush_mlc():
     ret = w.FSA_FlushVolume(w.fsa_handle, '/vol/storage_mlc01')
     print(hex(ret))
-
-def remove_system_titles(region, auto_flush=True):
-    if (titles := SYSTEM_TITLES.get(region)) is not None and isinstance(titles, (tuple, list)):
-        for t in titles:
-            w.rmdir(STORAGE_MLC + t.replace('-', '/'))
-        if auto_flush:
-            flush_mlc()
+    return ret
+
+# plans the whole removal first, then removes every title with pipelined
+# FSA_Remove over several connections and flushes the mlc once at the end.
+# finished titles are appended to the checkpoint file so an interrupted run
+# can be started again without walking them, dry_run only prints the plan.
+# the checkpoint is kept with the console's state and named after the
+# region and the title root
+def remove_system_titles(region, auto_flush=True, dry_run=False, connections=4, checkpoint=None):
+    if region not in TITLES.sets:
+        return
+    if checkpoint is None:
+        checkpoint = w.state_path('remove_system_titles-%s-%s.txt' % (region, STORAGE_MLC.strip('/').replace('/', '_')))
+    done = set()
+    if os.path.exists(checkpoint):
+        with open(checkpoint, 'r') as f:
+            done = set(line.strip() for line in f)
+    paths = [title_path(tid) for tid in TITLES.titles(region) if title_name(tid) not in done]
+    plan = plan_removal(paths)
+    print_removal_plan(plan)
+    if dry_run:
+        return plan
+    lock = threading.Lock()
+    completed = []
+
+    def remove_title(c, path, order):
+        start = monotonic()
+        rets = c.remove_all(order)
+        failed = [(p, ret) for (p, ret) in zip(order, rets) if ret != 0x0 and ret != FSA_STATUS_NOT_FOUND]
+        for (p, ret) in failed:
+            print('rm error : ' + p + ' (' + hex(ret if ret is not None else 0) + ')')
+        print('%s : %d entries in %.2fs' % (path, len(order), monotonic() - start))
+        if len(failed) == 0:
+            with lock:
+                completed.append(path)
+                with open(checkpoint, 'a') as f:
+                    f.write(path[len(STORAGE_MLC):].replace('/', '-') + '\n')
+        return -1 if len(failed) > 0 else 0
+
+    jobs = [(nbytes, path, lambda c, path=path, order=order: remove_title(c, path, order)) for (path, order, _, nbytes) in plan]
+    wuptransfer(w, connections).run(jobs)
+    for (path, _, _, _) in plan:
+        w.cache.invalidate(path)
+    if auto_flush:
+        flush_mlc()
+    # everything is gone, a later run has to plan from scratch anyway
+    if len(completed) == len(plan) and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    return plan
+
+# what changing the console from region src to dst involves: the system
+# titles to replace with the dst ones and the ones without a counterpart.
+# with a title catalog (wuptitles) only titles actually installed are listed
+def plan_region_change(src, dst, catalog=None):
+    diff = TITLES.diff(src, dst)
+    installed = (lambda tid: True) if catalog is None else (lambda tid: title_name(tid) in catalog.titles)
+    for (a, b) in diff['replace']:
+        if installed(a):
+            print('replace %s with %s (%s)' % (title_name(a), title_name(b), TITLES.slot_name(a)))
+    for a in diff['remove']:
+        if installed(a):
+            print('remove  %s (no %s title)' % (title_name(a), dst))
+    for b in diff['add']:
+        print('add     %s (no %s title)' % (title_name(b), src))
+    return diff
 
 if __name__ == '__main__':
     w = wupclient()
-    mount_sd()
+    # mounted together with the first /dev/fsa handle
+    mount_sd(True)
     # mount_odd_content()
 
     # print(w.pwd())
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# runs wupclient commands on many consoles at once. every console gets its
+# own process (the wupclient helpers work on the module global w), its own
+# log file and its own output directory:
+#   python3 wupfleet.py consoles.txt -j 8 -c mount_sd -c "remove_system_titles USA"
+#   python3 wupfleet.py consoles.txt -c "dldir /vol/system/config"
+# the inventory has one console per line, "ip[:port] [name]", # comments
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import shlex
+import sys
+import time
+import traceback
+
+import wupclient
+
+def load_inventory(filename):
+    consoles = []
+    with open(filename, 'r') as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if len(line) == 0:
+                continue
+            fields = line.split()
+            address = fields[0]
+            port = 1337
+            if ':' in address:
+                address, port = address.rsplit(':', 1)
+                port = int(port)
+            name = fields[1] if len(fields) > 1 else address if port == 1337 else '%s_%d' % (address, port)
+            consoles.append((name, address, port))
+    return consoles
+
+def parse_argument(a):
+    try:
+        return int(a, 0)
+    except ValueError:
+        return a
+
+# "remove_system_titles USA" -> (name, [args]). module level helpers come
+# first, anything else is looked up on the client (e.g. "dl /vol/...")
+def parse_command(command):
+    fields = shlex.split(command)
+    return (fields[0], [parse_argument(a) for a in fields[1:]])
+
+def resolve(w, name):
+    fn = getattr(wupclient, name, None)
+    if callable(fn) and not isinstance(fn, type):
+        return fn
+    fn = getattr(w, name, None)
+    if callable(fn):
+        return fn
+    raise AttributeError('unknown command ' + name)
+
+# wupclient reports failures as "<op> error : ..." (or "mkdir error (...)")
+ERROR_LINE = re.compile(r'^\w+ error\b')
+
+# writes through to the console's log and keeps the error lines wupclient
+# printed since the last take()
+class errorlog:
+    def __init__(self, f):
+        self.f = f
+        self.line = ''
+        self.errors = []
+
+    def write(self, s):
+        self.f.write(s)
+        lines = (self.line + s).split('\n')
+        self.line = lines.pop()
+        for line in lines:
+            self.check(line)
+        return len(s)
+
+    def check(self, line):
+        # progress output ends in \r, the error is whatever comes after
+        for part in line.split('\r'):
+            if ERROR_LINE.match(part.strip()):
+                self.errors.append(part.strip())
+
+    def flush(self):
+        self.f.flush()
+
+    def take(self):
+        self.check(self.line)
+        self.line = ''
+        errors = self.errors
+        self.errors = []
+        return errors
+
+# -1 from the file helpers, raw IOS/FSA/MCP error codes (0x8xxxxxxx and up)
+# from the rest
+def failed(ret):
+    return isinstance(ret, int) and not isinstance(ret, bool) and (ret < 0 or 0x80000000 <= ret <= 0xFFFFFFFF)
+
+# runs in the console's own process, everything it prints goes to its log.
+# a command that raises, returns an error or prints one fails the console
+# and the commands after it are not run
+def run_console(job):
+    (name, address, port, commands, logdir, outdir, timeout) = job
+    log = os.path.join(logdir, name + '.log')
+    out = os.path.join(outdir, name)
+    os.makedirs(out, exist_ok=True)
+    result = {'name': name, 'address': '%s:%d' % (address, port), 'ok': True, 'error': None, 'commands': [], 'log': log}
+    start = time.monotonic()
+    with open(log, 'a') as f:
+        out_log = errorlog(f)
+        sys.stdout = sys.stderr = out_log
+        print('=== %s %s:%d %s' % (name, address, port, time.strftime('%Y-%m-%d %H:%M:%S')))
+        try:
+            os.chdir(out)
+            # dldir saves next to the running script
+            sys.argv[0] = os.path.join(out, 'wupfleet.py')
+            w = wupclient.wupclient(address, port, timeout=timeout)
+            wupclient.w = w
+            for (command, args) in commands:
+                print('--- %s %s' % (command, ' '.join(str(a) for a in args)))
+                t = time.monotonic()
+                out_log.take()
+                ret = resolve(w, command)(*args)
+                errors = out_log.take()
+                ok = not failed(ret) and len(errors) == 0
+                result['commands'].append({'command': command, 'seconds': time.monotonic() - t, 'ok': ok, 'errors': errors,
+                    'ret': ret if isinstance(ret, (int, str, type(None))) else repr(ret)})
+                if not ok:
+                    result['ok'] = False
+                    result['error'] = '%s: %s' % (command, errors[0] if len(errors) > 0 else 'returned ' + (hex(ret) if ret >= 0 else str(ret)))
+                    print('--- %s failed, skipping the rest' % command)
+                    break
+            wupclient.w = None
+            del w
+        except Exception as e:
+            traceback.print_exc()
+            result['ok'] = False
+            result['error'] = '%s: %s' % (type(e).__name__, e)
+        result['seconds'] = time.monotonic() - start
+        print('=== %s in %.2fs' % ('done' if result['ok'] else 'failed', result['seconds']))
+        f.flush()
+        sys.stdout = sys.__stdout__
+        sys.stderr = sys.__stderr__
+    return result
+
+def run_fleet(consoles, commands, jobs=8, logdir='fleet_logs', outdir='fleet_out', timeout=10.0):
+    logdir = os.path.abspath(logdir)
+    outdir = os.path.abspath(outdir)
+    os.makedirs(logdir, exist_ok=True)
+    commands = [parse_command(c) if isinstance(c, str) else c for c in commands]
+    work = [(name, address, port, commands, logdir, outdir, timeout) for (name, address, port) in consoles]
+    results = []
+    # a fresh process per console so one hung or crashed session can't
+    # leave state behind for the next one
+    with multiprocessing.Pool(max(1, min(jobs, len(work))), maxtasksperchild=1) as pool:
+        for r in pool.imap_unordered(run_console, work):
+            results.append(r)
+            print('[%d/%d] %-20s %s %.2fs%s' % (len(results), len(work), r['name'], 'ok    ' if r['ok'] else 'FAILED', r['seconds'],
+                '' if r['ok'] else ' : ' + r['error']))
+    return results
+
+def print_summary(results):
+    failed = [r for r in results if not r['ok']]
+    print('%d consoles, %d ok, %d failed' % (len(results), len(results) - len(failed), len(failed)))
+    for r in failed:
+        print('  %-20s %-21s %s (%s)' % (r['name'], r['address'], r['error'], r['log']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='run wupclient commands on a fleet of consoles')
+    parser.add_argument('inventory', help='file with one "ip[:port] [name]" per line')
+    parser.add_argument('-c', '--command', action='append', required=True, help='command to run, e.g. "remove_system_titles USA" (repeatable, run in order)')
+    parser.add_argument('-j', '--jobs', type=int, default=8, help='consoles handled at the same time')
+    parser.add_argument('--logs', default='fleet_logs', help='directory for the per-console logs')
+    parser.add_argument('--out', default='fleet_out', help='directory for per-console downloads')
+    parser.add_argument('--timeout', type=float, default=10.0, help='connect timeout in seconds')
+    parser.add_argument('--summary', default=None, help='write the results as JSON to this file')
+    args = parser.parse_args()
+    results = run_fleet(load_inventory(args.inventory), args.command, args.jobs, args.logs, args.out, args.timeout)
+    print_summary(results)
+    if args.summary is not None:
+        with open(args.summary, 'w') as f:
+            json.dump(results, f, indent=2)
+    sys.exit(0 if all(r['ok'] for r in results) else 1)
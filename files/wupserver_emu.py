@@ -0,0 +1,504 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# local stand-in for the recovery_menu wupserver, backed by a host directory.
+# speaks the same protocol as wupclient.send so the client can be tested and
+# benchmarked without a console:
+#   python3 wupserver_emu.py ./nand --port 1337 --rtt 0.002 --bandwidth 2000000
+import argparse
+import heapq
+import os
+import shutil
+import socket
+import stat
+import struct
+import threading
+import time
+
+FRAMED_REQUEST = 0x80000000
+HEAP_BASE = 0x10000000
+HEAP_SIZE = 0x02000000
+PAGE_SIZE = 0x10000
+
+FSA_STATUS_END_OF_DIR = -0x30004
+FSA_STATUS_END_OF_FILE = -0x30005
+FSA_STATUS_ALREADY_EXISTS = -0x30016
+FSA_STATUS_NOT_FOUND = -0x30017
+FSA_STATUS_NOT_EMPTY = -0x30018
+FSA_STATUS_INVALID_HANDLE = -0x30026
+FSA_STATUS_NOT_FILE = -0x30028
+FSA_STATUS_NOT_DIR = -0x30029
+IOS_ERROR_INVALID = -4
+IOS_ERROR_NOEXISTS = -6
+
+def u32(v):
+    return v & 0xFFFFFFFF
+
+def get_string(buffer, offset):
+    s = buffer[offset:]
+    if b'\x00' in s:
+        s = s[:s.index(b'\x00')]
+    return bytes(s).decode('utf-8')
+
+class memory:
+    def __init__(self):
+        self.pages = {}
+
+    def read(self, addr, size):
+        out = bytearray(size)
+        k = 0
+        while k < size:
+            page, offset = divmod(addr + k, PAGE_SIZE)
+            n = min(size - k, PAGE_SIZE - offset)
+            p = self.pages.get(page)
+            if p is not None:
+                out[k:k + n] = p[offset:offset + n]
+            k += n
+        return out
+
+    def write(self, addr, data):
+        k = 0
+        while k < len(data):
+            page, offset = divmod(addr + k, PAGE_SIZE)
+            n = min(len(data) - k, PAGE_SIZE - offset)
+            p = self.pages.get(page)
+            if p is None:
+                p = self.pages[page] = bytearray(PAGE_SIZE)
+            p[offset:offset + n] = data[k:k + n]
+            k += n
+
+class heap:
+    # first fit allocator over [HEAP_BASE, HEAP_BASE + HEAP_SIZE)
+    def __init__(self):
+        self.free_blocks = [(HEAP_BASE, HEAP_SIZE)]
+        self.used = {}
+
+    def alloc(self, size, align=0x20):
+        size = (size + 0x1F) & ~0x1F
+        for i, (addr, block_size) in enumerate(self.free_blocks):
+            start = (addr + align - 1) & ~(align - 1)
+            if start + size <= addr + block_size:
+                del self.free_blocks[i]
+                if start > addr:
+                    self.free_blocks.insert(i, (addr, start - addr))
+                    i += 1
+                if start + size < addr + block_size:
+                    self.free_blocks.insert(i, (start + size, addr + block_size - start - size))
+                self.used[start] = size
+                return start
+        return 0
+
+    def free(self, addr):
+        size = self.used.pop(addr, None)
+        if size is None:
+            return IOS_ERROR_INVALID
+        self.free_blocks.append((addr, size))
+        self.free_blocks.sort()
+        merged = []
+        for a, s in self.free_blocks:
+            if merged and merged[-1][0] + merged[-1][1] == a:
+                merged[-1] = (merged[-1][0], merged[-1][1] + s)
+            else:
+                merged.append((a, s))
+        self.free_blocks = merged
+        return 0
+
+class fsa_device:
+    def __init__(self, root):
+        self.root = root
+        self.files = {}
+        self.dirs = {}
+        self.next_handle = 1
+
+    def host_path(self, path):
+        return os.path.join(self.root, os.path.normpath('/' + path).lstrip('/'))
+
+    def new_handle(self, table, value):
+        handle = self.next_handle
+        self.next_handle += 1
+        table[handle] = value
+        return handle
+
+    def stat_words(self, st):
+        flags = 0x80000000 if stat.S_ISDIR(st.st_mode) else 0
+        size = 0 if stat.S_ISDIR(st.st_mode) else st.st_size
+        words = [0] * 25
+        words[1] = flags
+        words[2] = 0x666
+        words[5] = u32(size)
+        words[9] = u32(st.st_ino)
+        # created/modified as 64-bit microsecond timestamps
+        for (i, ns) in ((10, st.st_ctime_ns), (12, st.st_mtime_ns)):
+            words[i] = u32((ns // 1000) >> 32)
+            words[i + 1] = u32(ns // 1000)
+        return words
+
+    def ioctl(self, mem, cmd, inbuf, out_size):
+        out = bytearray(out_size)
+        if cmd == 0x02 or cmd == 0x1B or cmd == 0x20 or cmd == 0x69:
+            # unmount, flush volume, change mode, format
+            return 0, out
+        if cmd == 0x0A:
+            path = self.host_path(get_string(inbuf, 0x4))
+            if not os.path.isdir(path):
+                return FSA_STATUS_NOT_FOUND, out
+            entries = sorted(os.listdir(path))
+            struct.pack_into('>I', out, 4, self.new_handle(self.dirs, (path, entries, [0])))
+            return 0, out
+        if cmd == 0x0B:
+            d = self.dirs.get(struct.unpack_from('>I', inbuf, 0x4)[0])
+            if d is None:
+                return FSA_STATUS_INVALID_HANDLE, out
+            path, entries, pos = d
+            if pos[0] >= len(entries):
+                return FSA_STATUS_END_OF_DIR, out
+            name = entries[pos[0]]
+            pos[0] += 1
+            st = os.stat(os.path.join(path, name))
+            struct.pack_into('>24I', out, 4, *self.stat_words(st)[1:])
+            name = name.encode('utf-8') + b'\x00'
+            out[0x68:0x68 + len(name)] = name
+            return 0, out
+        if cmd == 0x0D:
+            if self.dirs.pop(struct.unpack_from('>I', inbuf, 0x4)[0], None) is None:
+                return FSA_STATUS_INVALID_HANDLE, out
+            return 0, out
+        if cmd == 0x0E:
+            path = self.host_path(get_string(inbuf, 0x4))
+            mode = get_string(inbuf, 0x284)
+            if os.path.isdir(path):
+                return FSA_STATUS_NOT_FILE, out
+            if 'r' in mode and '+' not in mode and not os.path.isfile(path):
+                return FSA_STATUS_NOT_FOUND, out
+            try:
+                f = open(path, mode.replace('b', '') + 'b')
+            except OSError:
+                return FSA_STATUS_NOT_FOUND, out
+            struct.pack_into('>I', out, 4, self.new_handle(self.files, f))
+            return 0, out
+        if cmd == 0x07:
+            path = self.host_path(get_string(inbuf, 0x4))
+            if os.path.exists(path):
+                return FSA_STATUS_ALREADY_EXISTS, out
+            if not os.path.isdir(os.path.dirname(path)):
+                return FSA_STATUS_NOT_FOUND, out
+            os.mkdir(path)
+            return 0, out
+        if cmd == 0x08:
+            path = self.host_path(get_string(inbuf, 0x4))
+            if os.path.isdir(path):
+                if len(os.listdir(path)) != 0:
+                    return FSA_STATUS_NOT_EMPTY, out
+                os.rmdir(path)
+            elif os.path.exists(path):
+                os.remove(path)
+            else:
+                return FSA_STATUS_NOT_FOUND, out
+            return 0, out
+        if cmd == 0x09:
+            src = self.host_path(get_string(inbuf, 0x4))
+            dst = self.host_path(get_string(inbuf, 0x284))
+            if not os.path.exists(src):
+                return FSA_STATUS_NOT_FOUND, out
+            os.rename(src, dst)
+            return 0, out
+        if cmd == 0x11 or cmd == 0x12:
+            f = self.files.get(struct.unpack_from('>I', inbuf, 0x4)[0])
+            if f is None:
+                return FSA_STATUS_INVALID_HANDLE, out
+            if cmd == 0x12:
+                f.seek(struct.unpack_from('>I', inbuf, 0x8)[0])
+            else:
+                struct.pack_into('>I', out, 4, f.tell())
+            return 0, out
+        if cmd == 0x14:
+            f = self.files.get(struct.unpack_from('>I', inbuf, 0x4)[0])
+            if f is None:
+                return FSA_STATUS_INVALID_HANDLE, out
+            words = self.stat_words(os.fstat(f.fileno()))
+            struct.pack_into('>%dI' % min(25, out_size // 4), out, 0, *words[:out_size // 4])
+            return 0, out
+        if cmd == 0x15:
+            f = self.files.pop(struct.unpack_from('>I', inbuf, 0x4)[0], None)
+            if f is None:
+                return FSA_STATUS_INVALID_HANDLE, out
+            f.close()
+            return 0, out
+        if cmd == 0x18:
+            return 0, out
+        return IOS_ERROR_INVALID, out
+
+    def ioctlv(self, mem, cmd, vecs_in, vecs_out):
+        if cmd == 0x01:
+            return 0
+        if cmd == 0x0F or cmd == 0x10:
+            inbuf = mem.read(vecs_in[0][0], vecs_in[0][1])
+            size, cnt = struct.unpack_from('>II', inbuf, 0x8)
+            f = self.files.get(struct.unpack_from('>I', inbuf, 0x14)[0])
+            if f is None:
+                return FSA_STATUS_INVALID_HANDLE
+            if size == 0:
+                return 0
+            if cmd == 0x0F:
+                addr, length = vecs_out[0]
+                data = f.read(min(size * cnt, length))
+                mem.write(addr, data)
+                return len(data) // size
+            addr, length = vecs_in[1]
+            f.write(mem.read(addr, min(size * cnt, length)))
+            return min(size * cnt, length) // size
+        return IOS_ERROR_INVALID
+
+class mcp_device:
+    def __init__(self, fsa):
+        self.fsa = fsa
+
+    def ioctl(self, mem, cmd, inbuf, out_size):
+        out = bytearray(out_size)
+        if cmd == 0x82:
+            # install progress: nothing is ever in flight
+            return 0, out
+        if cmd == 0x8D or cmd == 0xF1:
+            return 0, out
+        return IOS_ERROR_INVALID, out
+
+    def ioctlv(self, mem, cmd, vecs_in, vecs_out):
+        if cmd == 0x80:
+            if len(vecs_out) > 0:
+                mem.write(vecs_out[0][0], bytearray(vecs_out[0][1]))
+            return 0
+        if cmd == 0x81:
+            return 0
+        if cmd == 0x85:
+            # copy title to mlc (0) or usb (1)
+            path = get_string(mem.read(vecs_in[0][0], vecs_in[0][1]), 0)
+            device = struct.unpack('>I', mem.read(vecs_in[1][0], 4))[0]
+            parts = path.split('/')
+            if len(parts) < 3 or not os.path.isdir(self.fsa.host_path(path)):
+                return FSA_STATUS_NOT_FOUND
+            parts[2] = 'storage_usb01' if device == 1 else 'storage_mlc01'
+            dst = self.fsa.host_path('/'.join(parts))
+            if os.path.exists(dst):
+                return FSA_STATUS_ALREADY_EXISTS
+            shutil.copytree(self.fsa.host_path(path), dst)
+            return 0
+        if cmd == 0x83:
+            path = self.fsa.host_path(get_string(mem.read(vecs_in[0][0], vecs_in[0][1]), 0))
+            if not os.path.isdir(path):
+                return FSA_STATUS_NOT_FOUND
+            shutil.rmtree(path)
+            return 0
+        return IOS_ERROR_INVALID
+
+class nim_device:
+    def ioctl(self, mem, cmd, inbuf, out_size):
+        return 0, bytearray(out_size)
+
+    def ioctlv(self, mem, cmd, vecs_in, vecs_out):
+        for (addr, size) in vecs_out:
+            mem.write(addr, bytearray(size))
+        return 0
+
+class wupserver_emu:
+    def __init__(self, root, rtt=0.0, bandwidth=0, framing=True, serial=False):
+        self.root = root
+        self.serial = serial
+        self.rtt = rtt
+        self.bandwidth = bandwidth
+        self.framing = framing
+        self.mem = memory()
+        self.heap = heap()
+        self.devices = {}
+        self.next_device_handle = 1
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'bytes_in': 0, 'bytes_out': 0}
+
+    # device nodes
+    def open_device(self, name):
+        fsa = fsa_device(self.root)
+        if name == '/dev/fsa':
+            device = fsa
+        elif name == '/dev/mcp':
+            device = mcp_device(fsa)
+        elif name == '/dev/nim':
+            device = nim_device()
+        else:
+            return IOS_ERROR_NOEXISTS
+        handle = self.next_device_handle
+        self.next_device_handle += 1
+        self.devices[handle] = device
+        return handle
+
+    def svc(self, svc_id, args):
+        args = list(args) + [0] * (8 - len(args))
+        if svc_id == 0x27:
+            return self.heap.alloc(args[1])
+        if svc_id == 0x28:
+            return self.heap.alloc(args[1], max(args[2], 0x20))
+        if svc_id == 0x29:
+            return self.heap.free(args[1])
+        if svc_id == 0x33:
+            return self.open_device(get_string(self.mem.read(args[0], 0x40), 0))
+        if svc_id == 0x34:
+            if self.devices.pop(args[0], None) is None:
+                return IOS_ERROR_INVALID
+            return 0
+        if svc_id == 0x38:
+            device = self.devices.get(args[0])
+            if device is None:
+                return IOS_ERROR_INVALID
+            handle, cmd, in_addr, in_size, out_addr, out_size = args[:6]
+            ret, out = device.ioctl(self.mem, cmd, self.mem.read(in_addr, in_size), out_size)
+            if out_size > 0:
+                self.mem.write(out_addr, out)
+            return ret
+        if svc_id == 0x39:
+            device = self.devices.get(args[0])
+            if device is None:
+                return IOS_ERROR_INVALID
+            cmd, in_count, out_count, vec_addr = args[1:5]
+            vecs = self.mem.read(vec_addr, 0xC * (in_count + out_count))
+            vecs = [struct.unpack_from('>II', vecs, 0xC * i) for i in range(in_count + out_count)]
+            return device.ioctlv(self.mem, cmd, vecs[:in_count], vecs[in_count:])
+        return IOS_ERROR_INVALID
+
+    # wupserver commands
+    def handle(self, command, payload):
+        words = lambda n: struct.unpack_from('>%dI' % n, payload.ljust(4 * n, b'\x00'))
+        if command == 0:
+            self.mem.write(words(1)[0], payload[4:])
+            return struct.pack('>I', 0)
+        if command == 1:
+            addr, size = words(2)
+            return struct.pack('>I', 0) + bytes(self.mem.read(addr, size))
+        if command == 2:
+            svc_id = words(1)[0]
+            args = struct.unpack_from('>%dI' % (min(len(payload) - 4, 0x20) // 4), payload, 4)
+            return struct.pack('>II', 0, u32(self.svc(svc_id, args)))
+        if command == 3:
+            return None
+        if command == 4:
+            dst, src, size = words(3)
+            self.mem.write(dst, self.mem.read(src, size))
+            return struct.pack('>I', 0)
+        if command == 5:
+            # the real server keeps rewriting val whenever something else
+            # changes dst, n times. nothing else touches memory here
+            dst, val, n = words(3)
+            self.mem.write(dst, struct.pack('>I', val))
+            return struct.pack('>I', 0)
+        return struct.pack('>i', -2)
+
+    def client(self, conn):
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        replies = []
+        cond = threading.Condition()
+        state = {'done': False, 'free_at': 0.0}
+
+        def sender():
+            while True:
+                with cond:
+                    while len(replies) == 0 and not state['done']:
+                        cond.wait()
+                    if len(replies) == 0:
+                        return
+                    due, _, reply = replies[0]
+                    now = time.monotonic()
+                    if due > now:
+                        cond.wait(due - now)
+                        continue
+                    heapq.heappop(replies)
+                try:
+                    conn.sendall(reply)
+                except OSError:
+                    return
+
+        t = threading.Thread(target=sender, daemon=True)
+        t.start()
+        rx = bytearray()
+        seq = 0
+        try:
+            while True:
+                # stock wupserver semantics: one request per recv()
+                if len(rx) == 0:
+                    chunk = conn.recv(0x600)
+                    if not chunk:
+                        break
+                    rx += chunk
+                command = struct.unpack_from('>I', rx.ljust(4, b'\x00'))[0]
+                if self.framing and command & FRAMED_REQUEST:
+                    size = (command >> 8) & 0xFFFF
+                    while len(rx) < 4 + size:
+                        chunk = conn.recv(0x10000)
+                        if not chunk:
+                            return
+                        rx += chunk
+                    payload = bytes(rx[4:4 + size])
+                    del rx[:4 + size]
+                    command &= 0xFF
+                else:
+                    payload = bytes(rx[4:])
+                    del rx[:]
+                with self.lock:
+                    self.stats['requests'] += 1
+                    self.stats['bytes_in'] += 4 + len(payload)
+                    reply = self.handle(command, payload)
+                    if reply is not None:
+                        self.stats['bytes_out'] += len(reply)
+                if reply is None:
+                    break
+                now = time.monotonic()
+                due = now + self.rtt
+                if self.bandwidth > 0:
+                    state['free_at'] = max(state['free_at'], now) + len(reply) / float(self.bandwidth)
+                    due = max(due, state['free_at'] + self.rtt)
+                with cond:
+                    heapq.heappush(replies, (due, seq, reply))
+                    seq += 1
+                    cond.notify()
+        finally:
+            with cond:
+                state['done'] = True
+                cond.notify()
+            t.join()
+            conn.close()
+
+    def serve(self, host='127.0.0.1', port=1337, ready=None):
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(16)
+        self.port = self.sock.getsockname()[1]
+        if ready is not None:
+            ready.set()
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            if self.serial:
+                # the stock wupserver handles one client at a time
+                self.client(conn)
+            else:
+                threading.Thread(target=self.client, args=(conn,), daemon=True).start()
+
+    def start(self, host='127.0.0.1', port=0):
+        ready = threading.Event()
+        threading.Thread(target=self.serve, args=(host, port, ready), daemon=True).start()
+        ready.wait()
+        return self.port
+
+    def stop(self):
+        self.sock.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='local wupserver stand-in backed by a host directory')
+    parser.add_argument('root', help='host directory mapped to the console root (e.g. ./nand/vol/...)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1337)
+    parser.add_argument('--rtt', type=float, default=0.0, help='injected round trip time in seconds')
+    parser.add_argument('--bandwidth', type=int, default=0, help='reply bandwidth in bytes/s (0 = unlimited)')
+    parser.add_argument('--stock', action='store_true', help='behave like the stock wupserver: no framed requests, one client at a time')
+    args = parser.parse_args()
+    print('serving %s on %s:%d' % (os.path.abspath(args.root), args.host, args.port))
+    wupserver_emu(args.root, args.rtt, args.bandwidth, not args.stock, args.stock).serve(args.host, args.port)